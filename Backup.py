@@ -0,0 +1,201 @@
+import os
+import os.path
+import multiprocessing
+from collections import deque
+
+import msgpack
+
+from CryptoUtils import hmacSha256, seal, unseal, deriveBackupKey
+from constants import BACKUP_CHUNK_SIZE, BACKUP_MAX_IN_FLIGHT
+
+# Backup layout:
+#   chunk   - up to chunkSize bytes of a file, stored under its id:
+#             hmacSha256(backup key, plaintext), sealed with a key derived
+#             from the backup key and the chunk id. Equal chunks get equal
+#             ids and are stored once.
+#   manifest - msgpack list of files: [path, size, [chunk ids]], stored as
+#             ordinary chunks.
+#   root    - msgpack list of the manifest chunk ids, sealed with the backup
+#             key. Small enough to be kept in the node's DHT data record.
+#
+# Recovery after loss of the local disk is out of scope: the DHT data record
+# (DHT.setData) lives only in the node's own journal, it is not replicated
+# to friends, and chunks placed on other nodes (Storage.py) can't be fetched
+# back yet. A restore needs the root and a chunk store that has the chunks.
+
+class BackupError(Exception):
+    pass
+
+class LocalChunkStore:
+    # Chunks in files of a local directory
+    def __init__(self, path):
+        self.__path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def __chunkPath(self, chunkId):
+        return os.path.join(self.__path, chunkId.encode('hex'))
+
+    def has(self, chunkId):
+        return os.path.isfile(self.__chunkPath(chunkId))
+
+    def put(self, chunkId, data):
+        path = self.__chunkPath(chunkId)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.rename(path + '.tmp', path)
+
+    def getUsedSpace(self):
+        return sum(os.path.getsize(os.path.join(self.__path, name))
+                   for name in os.listdir(self.__path) if not name.endswith('.tmp'))
+
+    def get(self, chunkId):
+        # returns None for unknown chunk
+        path = self.__chunkPath(chunkId)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+def _chunkKey(key, chunkId):
+    return hmacSha256(key, 'chunk:' + chunkId)
+
+def _sealChunk(key, data):
+    # returns (chunk id, sealed chunk), runs in pool workers
+    chunkId = hmacSha256(key, data)
+    return chunkId, seal(_chunkKey(key, chunkId), data)
+
+def _sealChunkTask(args):
+    return _sealChunk(*args)
+
+class _InlineResult:
+    def __init__(self, value):
+        self.__value = value
+
+    def get(self):
+        return self.__value
+
+class BackupEngine:
+    # Streams files through fixed size chunks: at most BACKUP_MAX_IN_FLIGHT
+    # chunks are read ahead and sealed in a process pool (or inline, when
+    # processes is 0), so memory use doesn't depend on the file size.
+    def __init__(self, login, password, store, processes = 0, chunkSize = BACKUP_CHUNK_SIZE):
+        self.__key = deriveBackupKey(login, password)
+        self.__store = store
+        self.__chunkSize = chunkSize
+        self.__pool = multiprocessing.Pool(processes) if processes > 0 else None
+        self.__stats = {
+            'files': 0,
+            'bytes': 0,
+            'chunks': 0,
+            'chunks_stored': 0,
+            'chunks_deduplicated': 0,
+        }
+
+    def close(self):
+        if self.__pool is not None:
+            self.__pool.close()
+            self.__pool.join()
+            self.__pool = None
+
+    def getStats(self):
+        return dict(self.__stats)
+
+    def __submit(self, data):
+        if self.__pool is None:
+            return _InlineResult(_sealChunk(self.__key, data))
+        return self.__pool.apply_async(_sealChunkTask, ((self.__key, data),))
+
+    def __storeChunk(self, result, chunkIds):
+        chunkId, sealed = result.get()
+        chunkIds.append(chunkId)
+        self.__stats['chunks'] += 1
+        if self.__store.has(chunkId):
+            self.__stats['chunks_deduplicated'] += 1
+        else:
+            self.__store.put(chunkId, sealed)
+            self.__stats['chunks_stored'] += 1
+
+    def __writeStream(self, stream):
+        # returns ids of stream chunks
+        chunkIds = []
+        inFlight = deque()
+        while True:
+            data = stream.read(self.__chunkSize)
+            if not data:
+                break
+            if len(inFlight) >= BACKUP_MAX_IN_FLIGHT:
+                self.__storeChunk(inFlight.popleft(), chunkIds)
+            inFlight.append(self.__submit(data))
+        while inFlight:
+            self.__storeChunk(inFlight.popleft(), chunkIds)
+        return chunkIds
+
+    def __readChunk(self, chunkId):
+        sealed = self.__store.get(chunkId)
+        if sealed is None:
+            raise BackupError('missing chunk ' + chunkId.encode('hex'))
+        data = unseal(_chunkKey(self.__key, chunkId), sealed)
+        if data is None or hmacSha256(self.__key, data) != chunkId:
+            raise BackupError('corrupted chunk ' + chunkId.encode('hex'))
+        return data
+
+    def backup(self, paths):
+        # paths - files and directories, returns root of the backup
+        files = []
+        for path in paths:
+            path = os.path.abspath(path)
+            base = os.path.dirname(path)
+            if os.path.isdir(path):
+                for dirPath, _, fileNames in os.walk(path):
+                    for fileName in sorted(fileNames):
+                        filePath = os.path.join(dirPath, fileName)
+                        files.append((os.path.relpath(filePath, base), filePath))
+            else:
+                files.append((os.path.basename(path), path))
+
+        manifest = []
+        for name, filePath in files:
+            with open(filePath, 'rb') as f:
+                chunkIds = self.__writeStream(f)
+            size = os.path.getsize(filePath)
+            manifest.append([name, size, chunkIds])
+            self.__stats['files'] += 1
+            self.__stats['bytes'] += size
+
+        manifestChunks = self.__writeStream(_BytesStream(msgpack.packb(manifest)))
+        return seal(self.__key, msgpack.packb(manifestChunks))
+
+    def __readManifest(self, root):
+        data = unseal(self.__key, root)
+        if data is None:
+            raise BackupError('wrong backup root or password')
+        manifestChunks = msgpack.unpackb(data)
+        return msgpack.unpackb(''.join(self.__readChunk(chunkId) for chunkId in manifestChunks))
+
+    def listFiles(self, root):
+        # returns [(path, size)]
+        return [(name, size) for name, size, _ in self.__readManifest(root)]
+
+    def restore(self, root, targetDir):
+        for name, size, chunkIds in self.__readManifest(root):
+            path = os.path.join(targetDir, name)
+            if os.path.isabs(name) or not os.path.abspath(path).startswith(os.path.abspath(targetDir) + os.sep):
+                raise BackupError('wrong file path ' + name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                for chunkId in chunkIds:
+                    f.write(self.__readChunk(chunkId))
+            if os.path.getsize(path) != size:
+                raise BackupError('wrong size of ' + name)
+
+class _BytesStream:
+    def __init__(self, data):
+        self.__data = data
+        self.__pos = 0
+
+    def read(self, size):
+        data = self.__data[self.__pos:self.__pos + size]
+        self.__pos += len(data)
+        return data
@@ -0,0 +1,51 @@
+import hashlib
+import struct
+
+# Bloom filter of short byte strings. Bit positions of an item come from
+# sha256(salt + item); a different salt per filter makes false positives
+# differ between filters of the same items. Friends summaries are salted
+# with the ids of both peers (requester + responder), so the salt is
+# repeatable, but differs for every pair of nodes.
+
+class BloomFilter:
+    def __init__(self, size, hashes, salt, bits = None):
+        # size - in bytes
+        assert 0 < hashes <= 16
+        self.__bitsCount = size * 8
+        self.__hashes = hashes
+        self.__salt = salt
+        self.__bits = bytearray(bits) if bits is not None else bytearray(size)
+        self.__unpack = struct.Struct('!%dH' % hashes).unpack_from
+
+    def __positions(self, item):
+        bitsCount = self.__bitsCount
+        return [value % bitsCount for value in self.__unpack(hashlib.sha256(self.__salt + item).digest())]
+
+    def add(self, item):
+        bits = self.__bits
+        for pos in self.__positions(item):
+            bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        bits = self.__bits
+        for pos in self.__positions(item):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def toBytes(self):
+        return str(self.__bits)
+
+def _UT():
+    items = [str(i) * 3 for i in xrange(100)]
+    bloom = BloomFilter(128, 7, 'salt')
+    for item in items:
+        bloom.add(item)
+    assert all(item in bloom for item in items)
+    loaded = BloomFilter(128, 7, 'salt', bloom.toBytes())
+    assert all(item in loaded for item in items)
+    falsePositives = sum(1 for i in xrange(10000) if 'other' + str(i) in loaded)
+    assert falsePositives < 300
+
+if __name__ == '__main__':
+    _UT()
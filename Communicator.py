@@ -1,4 +1,4 @@
-import msgpack
+from PacketCodec import PacketCodec, PacketError
 
 KEYS = [
     'type',
@@ -15,11 +15,43 @@ KEYS = [
     'exchange_response',
     'ping',
     'pong',
+    'pub_key',
+    'ticket',
+    'resume',
+    'resume_response',
+    'target',
+    'nonce',
+    'space',
+    'space_response',
+    'store',
+    'store_response',
+    'chunk_id',
+    'offset',
+    'size',
+    'data',
+    'free_space',
+    'status',
+    'filter',
+    'radius',
 ]
 KEY_TO_ID = {key: value for (value, key) in enumerate(KEYS)}
 ID_TO_KEY = {key: value for (key, value) in enumerate(KEYS)}
 
+# Authorization and liveness packets, communicators send them before the
+# rest and don't delay them by rate limits
+CONTROL_PACKETS = frozenset([
+    'request_id',
+    'response_id',
+    'confirm',
+    'confirm_confirm',
+    'resume',
+    'resume_response',
+    'ping',
+    'pong',
+])
 
+
+# Legacy dict <=> msgpack list conversion, kept for benchmarks
 def dictToList(packet):
     res = []
     for key, value in packet.iteritems():
@@ -41,25 +73,64 @@ def listToDict(packet):
     return res
 
 
+_g_codec = PacketCodec(KEY_TO_ID)
+
+
 class Communicator:
+    # Subclasses deliver encoded packets (_doSend) and pass received data to
+    # _onReceived. Packets and bytes are counted here, per packet type.
+
+    def __init__(self):
+        self.__stats = {} # packet type => [packets in, bytes in, packets out, bytes out]
+        self.__decodeErrors = 0
+
     def subscribe(self, selfAddress, onDataReceivedCallback):
         pass
 
+    def unsubscribe(self, selfAddress):
+        pass
+
     def send(self, selfAddress, address, packet):
         assert type(address) == type('')
         assert len(address) < 100
         assert len(selfAddress) < 100
 
-        packet = dictToList(packet)
-        data = msgpack.packb(packet)
+        data = _g_codec.encode(packet)
 
-        self._doSend(selfAddress, address, data)
+        stats = self.__stats.get(packet['type'], None)
+        if stats is None:
+            stats = self.__stats[packet['type']] = [0, 0, 0, 0]
+        stats[2] += 1
+        stats[3] += len(data)
+        self._doSend(selfAddress, address, data, packet['type'] in CONTROL_PACKETS)
 
-    def _doSend(self, selfAddress, address, data):
+    def _doSend(self, selfAddress, address, data, control = False):
         pass
 
     def _onReceived(self, address, data, callback):
-        packet = msgpack.unpackb(data)
-        packet = listToDict(packet)
+        try:
+            packet = _g_codec.decode(data)
+        except PacketError:
+            self.__decodeErrors += 1
+            return
 
+        stats = self.__stats.get(packet['type'], None)
+        if stats is None:
+            stats = self.__stats[packet['type']] = [0, 0, 0, 0]
+        stats[0] += 1
+        stats[1] += len(data)
         callback(address, packet)
+
+    def getStatsByType(self):
+        res = {}
+        for packetType, stats in self.__stats.iteritems():
+            res[packetType] = {
+                'packets_in': stats[0],
+                'bytes_in': stats[1],
+                'packets_out': stats[2],
+                'bytes_out': stats[3],
+            }
+        return res
+
+    def getDecodeErrors(self):
+        return self.__decodeErrors
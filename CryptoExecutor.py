@@ -0,0 +1,53 @@
+import multiprocessing
+
+from Crypto import Random
+
+from CryptoUtils import CryptoUtils
+
+
+def _cryptoCall(crypto, method, args):
+    # returns (success, result). Keys and data come from the network, garbage
+    # raises all kinds of errors inside pycrypto (ValueError, IndexError...)
+    try:
+        return True, getattr(crypto, method)(*args)
+    except Exception:
+        return False, None
+
+_g_workerCrypto = None
+
+def _workerInit():
+    global _g_workerCrypto
+    # pycrypto refuses to use random generator, inherited through fork()
+    Random.atfork()
+    _g_workerCrypto = CryptoUtils()
+
+def _workerCryptoCall(method, args):
+    return _cryptoCall(_g_workerCrypto, method, args)
+
+
+class InlineCryptoExecutor:
+    # Runs crypto operations synchronously, in the caller thread
+    def __init__(self, crypto):
+        self.__crypto = crypto
+
+    def submit(self, method, args, callback):
+        callback(*_cryptoCall(self.__crypto, method, args))
+
+    def close(self):
+        pass
+
+class ProcessCryptoExecutor:
+    # Runs crypto operations (CryptoUtils methods) in a process pool, results
+    # are passed to callbacks from the EventLoop thread. Can be shared between
+    # many DHT instances.
+    def __init__(self, loop, processes = None):
+        self.__loop = loop
+        self.__pool = multiprocessing.Pool(processes, _workerInit)
+
+    def submit(self, method, args, callback):
+        self.__pool.apply_async(_workerCryptoCall, (method, args),
+                                callback=lambda result: self.__loop.callSoonThreadsafe(callback, *result))
+
+    def close(self):
+        self.__pool.terminate()
+        self.__pool.join()
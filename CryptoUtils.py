@@ -1,73 +1,141 @@
 from Crypto.PublicKey import RSA
 from Crypto.Protocol.KDF import PBKDF2
-from Crypto.Cipher import PKCS1_OAEP
+from Crypto.Cipher import PKCS1_OAEP, AES
+from Crypto.Util import Counter
 import os, os.path
+import binascii
+import hashlib
+import hmac
+import heapq
 
-def _readFile(fname):
-    with open(fname, 'rb') as f:
-        return f.read()
-
-def _writeFile(fname, data):
-    with open(fname, 'wb') as f:
-        f.write(data)
+from LRUCache import LRUCache
+from constants import DISTANCE_CACHE_SIZE, HASHED_IDS, CIPHERS_CACHE_SIZE, KEYSTORE_TEST_ITERATIONS
 
 class CryptoUtils:
+    def __init__(self):
+        # own private key is parsed once, public keys of peers - via shared _g_ciphersCache
+        self.__privKey = None
+        self.__privCipher = None
+        self.__privKeyParses = 0
 
     def myRand(self, n):
         self.__counter += 1
         return PBKDF2(self.__masterKey, "myRand:%d" % self.__counter, dkLen=n, count=1)
 
     def generateKeys(self, login, password):
-        fname = ''
-        if _g_cache_enabled:
-            fname = 'cache/' + login + '_' + password
-            if os.path.isfile(fname + '_pub'):
-                return (_readFile(fname + '_priv'), _readFile(fname + '_pub'))
+        # keys are taken from the key store (see setKeyStore), if there is one
+        if _g_keyStore is not None:
+            return _g_keyStore.getKeys(login, password)
+        return self.deriveKeys(login, password)
 
+    def deriveKeys(self, login, password):
+        # deterministic rsa keys of login and password, slow
         self.__masterKey = PBKDF2(password, login, count=2500)
         self.__counter = 0
         key = RSA.generate(2048, randfunc=self.myRand)
         privKey = key.exportKey('DER')
         pubKey = key.publickey().exportKey('DER')
-        if _g_cache_enabled:
-            _writeFile(fname + '_priv', privKey)
-            _writeFile(fname + '_pub', pubKey)
         return (privKey, pubKey)
 
     def encrypt(self, pubKey, message):
         if _g_fake_crypto:
             return message
-        key = RSA.importKey(pubKey)
-        key = PKCS1_OAEP.new(key)
-        return key.encrypt(message)
+        cipher = _g_ciphersCache.get(pubKey)
+        if cipher is None:
+            cipher = PKCS1_OAEP.new(RSA.importKey(pubKey))
+            _g_ciphersCache.put(pubKey, cipher)
+        return cipher.encrypt(message)
 
     def decrypt(self, privKey, message):
         if _g_fake_crypto:
             return message
-        key = RSA.importKey(privKey)
-        key = PKCS1_OAEP.new(key)
-        return key.decrypt(message)
+        if privKey != self.__privKey:
+            self.__privCipher = PKCS1_OAEP.new(RSA.importKey(privKey))
+            self.__privKey = privKey
+            self.__privKeyParses += 1
+        return self.__privCipher.decrypt(message)
+
+    def getStats(self):
+        return {
+            'priv_key_parses': self.__privKeyParses,
+            'ciphers_cache': getCiphersCacheStats(),
+        }
+
+def hmacSha256(key, message):
+    return hmac.new(key, message, hashlib.sha256).digest()
+
+def deriveSessionKey(secret):
+    return hmacSha256(secret, 'wasp session key')
+
+def deriveBackupKey(login, password):
+    # separate from the rsa master key of generateKeys, so backup data keys
+    # don't reveal anything about the identity keys
+    return PBKDF2(password, 'wasp backup:' + login, dkLen=32, count=2500)
+
+def _aesCtr(key, nonce):
+    return AES.new(key, AES.MODE_CTR, counter=Counter.new(128, initial_value=long(binascii.hexlify(nonce), 16)))
+
+def seal(key, plaintext):
+    # AES-256-CTR encryption + HMAC-SHA256 of nonce and ciphertext
+    nonce = os.urandom(16)
+    ciphertext = _aesCtr(hmacSha256(key, 'enc'), nonce).encrypt(plaintext)
+    return nonce + ciphertext + hmacSha256(hmacSha256(key, 'mac'), nonce + ciphertext)
+
+def unseal(key, data):
+    # returns None if data was not sealed with given key
+    if len(data) < 48:
+        return None
+    nonce, ciphertext, mac = data[:16], data[16:-32], data[-32:]
+    if not hmac.compare_digest(mac, hmacSha256(hmacSha256(key, 'mac'), nonce + ciphertext)):
+        return None
+    return _aesCtr(hmacSha256(key, 'enc'), nonce).decrypt(ciphertext)
+
+def pubKeyToId(pubKey):
+    if not HASHED_IDS:
+        return pubKey
+    return hashlib.sha256(pubKey).digest()
+
+def idToInt(id):
+    if not id:
+        return 0
+    return int(binascii.hexlify(id), 16)
+
+def intToId(value, length):
+    if length == 0:
+        return ''
+    return binascii.unhexlify('%0*x' % (length * 2, value))
 
 def distance(a, b):
-    global _g_distanceCache
-    if (a, b) in _g_distanceCache:
-        return _g_distanceCache[(a, b)]
-    assert len(a) == len(b)
-    c = ''
-    if b > a:
+    if b < a:
         a, b = b, a
-    carry = False
-    for i in xrange(len(a) - 1, -1, -1):
-        up = ord(a[i])
-        down = ord(b[i])
-        res = up - down - int(carry)
-        carry = res < 0
-        if carry:
-            res += 256
-        c = chr(res) + c
-    _g_distanceCache[(a, b)] = c
+    key = (a, b)
+    c = _g_distanceCache.get(key)
+    if c is not None:
+        return c
+    assert len(a) == len(b)
+    c = intToId(idToInt(b) - idToInt(a), len(a))
+    _g_distanceCache.put(key, c)
     return c
 
+def rankByDistance(target, ids, count = None, reverse = False):
+    # Scores all ids against target in one pass, returns [(distance, id)] sorted by distance
+    targetInt = idToInt(target)
+    scored = [(abs(idToInt(id) - targetInt), id) for id in ids]
+    if count is None:
+        scored.sort(reverse=reverse)
+    elif reverse:
+        scored = heapq.nlargest(count, scored)
+    else:
+        scored = heapq.nsmallest(count, scored)
+    length = len(target)
+    return [(intToId(d, length), id) for d, id in scored]
+
+def getDistanceCacheStats():
+    return _g_distanceCache.getStats()
+
+def getCiphersCacheStats():
+    return _g_ciphersCache.getStats()
+
 def _distanceUT():
     a = ''
     b = ''
@@ -97,6 +165,21 @@ def _distanceUT():
     assert c[2] == chr(246)
     assert c == distance(b, a)
 
+    ids = [chr(255) + chr(10) + chr(10), chr(0) + chr(20) + chr(20), chr(7) + chr(0) + chr(1)]
+    target = chr(8) + chr(0) + chr(0)
+    expected = sorted((distance(target, id), id) for id in ids)
+    assert rankByDistance(target, ids) == expected
+    assert rankByDistance(target, ids, count=2) == expected[:2]
+    assert rankByDistance(target, ids, count=1, reverse=True) == expected[-1:]
+
+
+def _sealUT():
+    key = os.urandom(32)
+    data = seal(key, 'message')
+    assert unseal(key, data) == 'message'
+    assert unseal(os.urandom(32), data) is None
+    assert unseal(key, data[:-1] + chr(ord(data[-1]) ^ 1)) is None
+    assert unseal(key, seal(key, '')) == ''
 
 def _UT():
     crypto = CryptoUtils()
@@ -108,16 +191,36 @@ def _UT():
     assert priv1 != priv2
     assert pub1 != pub2
 
-_g_distanceCache = {}
+    stats = getCiphersCacheStats()
+    for _ in xrange(3):
+        assert crypto.decrypt(priv1, crypto.encrypt(pub1, 'message')) == 'message'
+        assert crypto.decrypt(priv2, crypto.encrypt(pub2, 'message')) == 'message'
+    assert getCiphersCacheStats()['misses'] - stats['misses'] == 2
+    assert getCiphersCacheStats()['hits'] - stats['hits'] == 4
+
+_g_distanceCache = LRUCache(DISTANCE_CACHE_SIZE)
+
+# public key (DER) => PKCS1_OAEP cipher
+_g_ciphersCache = LRUCache(CIPHERS_CACHE_SIZE)
 
-_g_cache_enabled = False
+_g_keyStore = None
 _g_fake_crypto = False
 
+def setKeyStore(keyStore):
+    # KeyStore.KeyStore or None
+    global _g_keyStore
+    _g_keyStore = keyStore
+
+def getKeyStore():
+    return _g_keyStore
+
 def _enableCache():
-    global _g_cache_enabled
-    _g_cache_enabled = True
-    if not os.path.isdir('cache'):
-        os.makedirs('cache')
+    # key store of test and simulation identities - their passwords are
+    # known anyway, so the store key is cheap to derive
+    from KeyStore import KeyStore
+    keyStore = KeyStore('cache', KEYSTORE_TEST_ITERATIONS)
+    keyStore.migrateLegacy('cache')
+    setKeyStore(keyStore)
 
 def _enableFakeCrypto():
     global _g_fake_crypto
@@ -126,3 +229,4 @@ def _enableFakeCrypto():
 if __name__ == '__main__':
     _UT()
     _distanceUT()
+    _sealUT()
@@ -1,30 +1,122 @@
-import pickle
-import os.path
+import os
+import time as walltime
+import bisect
+import struct
+import hmac
+from collections import deque, OrderedDict
 
-from CryptoUtils import CryptoUtils, distance
+from CryptoUtils import CryptoUtils, distance, pubKeyToId, hmacSha256, deriveSessionKey, seal, unseal,\
+    getDistanceCacheStats, rankByDistance
+from BloomFilter import BloomFilter
+from CryptoExecutor import InlineCryptoExecutor
+from LRUCache import LRUCache
+from Journal import Journal
+from Metrics import Metrics, Histogram
 from constants import FRIENDS_PER_REQUEST, MAX_FRIENDS, FRIENDS_EXCHANGE_INTERVAL,\
-    PING_INTERVAL, FRIENDS_TIMEOUT, RAND_SEQ_LENGTH
+    PING_INTERVAL, FRIENDS_TIMEOUT, RAND_SEQ_LENGTH, PUB_KEYS_CACHE_SIZE,\
+    MAX_CRYPTO_IN_FLIGHT, MAX_CRYPTO_BACKLOG, SESSION_TICKET_LIFETIME, MAX_SESSIONS,\
+    JOURNAL_FLUSH_INTERVAL, JOURNAL_COMPACT_MIN_RECORDS, JOURNAL_COMPACT_RATIO,\
+    LIVENESS_SLOTS, LIVENESS_MAX_IDLE, LIVENESS_RELIABILITY_ALPHA, LIVENESS_INITIAL_RELIABILITY,\
+    LOOKUP_ALPHA, LOOKUP_TIMEOUT, LOOKUP_RETRIES, EXCHANGE_TIMEOUT, REQUEST_NONCE_LENGTH,\
+    MAX_HALF_OPEN_AUTH, MAX_AUTH_QUEUE, AUTH_HANDSHAKE_TIMEOUT, AUTH_CONFIRM_TIMEOUT, AUTH_IDLE_TIMEOUT,\
+    AUTH_EXPIRE_INTERVAL, FRIENDS_DELTA_EXCHANGE, FRIENDS_FILTER_BITS_PER_ID, FRIENDS_FILTER_HASHES,\
+    MAX_FILTER_SIZE, ID_SIZE, AUTH_RESEND_INTERVAL, SELF_LOOKUP_INTERVAL
 
 
 class _DHT_Friend:
     def __init__(self, id, address, data = ''):
-        self.id = id                # unique friend id = rsa publick key (2048 length)
+        self.id = id                # unique friend id = sha256(rsa public key)
         self.address = address      # ip address: port
         self.data = data            # friend data - encrypted list of nodes, storing content
+        self.session = None         # _AuthSession, journaled with friend to skip full authorization after restart
 
 class _DHT_FriendDynamic:
-    def __init__(self, lastPingResponse, lastExchange = 0):
-        self.lastPingResponse = lastPingResponse
+    def __init__(self, lastSeen, lastExchange = 0):
+        self.lastSeen = lastSeen            # last authorized packet from friend
         self.lastExchange = lastExchange
+        self.lastProbe = 0                  # last ping, sent to friend
+        self.reliability = LIVENESS_INITIAL_RELIABILITY # moving average of answered pings
 
 class _DHT_FriendFull(_DHT_Friend, _DHT_FriendDynamic):
     def __init__(self, base, dynamic):
         _DHT_Friend.__init__(self, base.id, base.address, base.data)
-        _DHT_FriendDynamic.__init__(self, dynamic.lastPingResponse, dynamic.lastExchange)
+        _DHT_FriendDynamic.__init__(self, dynamic.lastSeen, dynamic.lastExchange)
+
+class _DHT_RoutingTable:
+    # Friend ids kept in ascending order. Distance is the absolute difference
+    # of ids, so the ids nearest to any target lie on both sides of its
+    # insertion point and the farthest ones lie at both ends of the list.
+    def __init__(self, ids = ()):
+        self.__ids = sorted(ids)
+
+    def add(self, id):
+        bisect.insort(self.__ids, id)
+
+    def addMany(self, ids):
+        # sorting two sorted runs is a linear merge
+        if len(ids) == 1:
+            self.add(ids[0])
+        else:
+            self.__ids.extend(sorted(ids))
+            self.__ids.sort()
+
+    def remove(self, id):
+        pos = bisect.bisect_left(self.__ids, id)
+        if pos < len(self.__ids) and self.__ids[pos] == id:
+            del self.__ids[pos]
+
+    def size(self):
+        return len(self.__ids)
+
+    def iterClosest(self, target):
+        # yields (distance, id) in ascending distance order
+        ids = self.__ids
+        right = bisect.bisect_left(ids, target)
+        left = right - 1
+        leftDist = distance(target, ids[left]) if left >= 0 else None
+        rightDist = distance(target, ids[right]) if right < len(ids) else None
+        while leftDist is not None or rightDist is not None:
+            if rightDist is None or (leftDist is not None and leftDist <= rightDist):
+                yield leftDist, ids[left]
+                left -= 1
+                leftDist = distance(target, ids[left]) if left >= 0 else None
+            else:
+                yield rightDist, ids[right]
+                right += 1
+                rightDist = distance(target, ids[right]) if right < len(ids) else None
+
+    def iterFarthest(self, target):
+        # yields (distance, id) in descending distance order
+        ids = self.__ids
+        left = 0
+        right = len(ids) - 1
+        while left <= right:
+            leftDist = distance(target, ids[left])
+            rightDist = distance(target, ids[right])
+            if rightDist >= leftDist:
+                yield rightDist, ids[right]
+                right -= 1
+            else:
+                yield leftDist, ids[left]
+                left += 1
+
+def _livenessSlot(id):
+    return ord(id[-1]) % LIVENESS_SLOTS
 
 class _DHT_Friends:
+    # Friends are persisted in a journal (see Journal.py): adds and removes
+    # are appended as they happen, liveness of changed friends and new
+    # authorization sessions - on every flush. When the journal grows far
+    # beyond the table size, it is replaced by a snapshot.
+    #
+    # Journal records:
+    #   ('a', id, address)                             - friend added
+    #   ('r', id)                                      - friend removed
+    #   ('l', id, lastSeen, lastExchange)              - friend liveness
+    #   ('s', id, sessionId, ticket, key, expiry)      - friend auth session
+    #   ('t', timestamp)                               - time of flush
+    #   ('d', data)                                    - own data record
     def __init__(self, stateFile, time, authorizator):
-        self.__stateFile = stateFile
         self.__time = time
         self.__authorizator = authorizator
 
@@ -34,26 +126,153 @@ class _DHT_Friends:
         # friend_id => _DHT_FriendDynamic
         self.__friendsDynamic = {}
 
-        self.__initialized = False
+        # ordered friend ids, used for closest friends lookup
+        self.__table = _DHT_RoutingTable()
+
+        # friend ids with liveness, changed since the last flush
+        self.__dirty = set()
+
+        # own data record - encrypted root of the content, stored by this node
+        self.__data = ''
+
+        # friend ids, split into LIVENESS_SLOTS groups, checked one by one
+        self.__slots = [set() for _ in xrange(LIVENESS_SLOTS)]
+
+        self.__journal = Journal(stateFile) if stateFile else None
         self.__load()
 
     def __load(self):
-        if os.path.isfile(self.__stateFile):
-            with open(self.__stateFile, 'rb') as f:
-                self.__friends = pickle.loads(f.read())
+        if self.__journal is None:
+            return
+        records = self.__journal.load()
+        friends = self.__friends
+        dynamic = {}
+        lastTs = None
+        for record in records:
+            kind = record[0]
+            if kind == 'a':
+                _, id, address = record
+                friends[id] = _DHT_Friend(id, address)
+            elif kind == 'r':
+                friends.pop(record[1], None)
+                dynamic.pop(record[1], None)
+            elif kind == 'l':
+                _, id, lastSeen, lastExchange = record
+                if id in friends:
+                    dynamic[id] = (lastSeen, lastExchange)
+            elif kind == 's':
+                _, id, sessionId, ticket, key, expiry = record
+                if id in friends:
+                    friends[id].session = _AuthSession(sessionId, ticket, key, expiry)
+            elif kind == 't':
+                lastTs = record[1]
+            elif kind == 'd':
+                self.__data = record[1]
 
-    def __save(self):
-        data = pickle.dumps(self.__friends, -1)
-        with open(self.__stateFile, 'wb') as f:
-            f.write(data)
+        # Node was offline since the last flush, this time doesn't count
+        # against its friends: their liveness is shifted to now.
+        now = self.__time.getCurrentTimestamp()
+        shift = now - lastTs if lastTs is not None else 0
+        for friendId, friend in friends.iteritems():
+            if friendId in dynamic:
+                lastSeen, lastExchange = dynamic[friendId]
+                self.__friendsDynamic[friendId] = _DHT_FriendDynamic(lastSeen + shift, lastExchange + shift)
+            else:
+                self.__friendsDynamic[friendId] = _DHT_FriendDynamic(now, now - FRIENDS_EXCHANGE_INTERVAL + 15)
+            if friend.session is not None:
+                self.__authorizator.addSession(friend.address, friend.session)
+        self.__table = _DHT_RoutingTable(friends)
+        for friendId in friends:
+            self.__slots[_livenessSlot(friendId)].add(friendId)
+        self.__dirty.update(friends)
+        if self.__needsCompaction():
+            self.__compact()
+
+    def __snapshot(self):
+        records = []
+        for friendId, friend in self.__friends.iteritems():
+            dynamic = self.__friendsDynamic[friendId]
+            records.append(('a', friendId, friend.address))
+            records.append(('l', friendId, dynamic.lastSeen, dynamic.lastExchange))
+            session = friend.session
+            if session is not None:
+                records.append(('s', friendId, session.id, session.ticket, session.key, session.expiry))
+        if self.__data:
+            records.append(('d', self.__data))
+        records.append(('t', self.__time.getCurrentTimestamp()))
+        return records
+
+    def __needsCompaction(self):
+        return self.__journal.getRecords() > max(JOURNAL_COMPACT_MIN_RECORDS, JOURNAL_COMPACT_RATIO * len(self.__friends))
+
+    def __compact(self):
+        self.__dirty.clear()
+        self.__journal.compact(self.__snapshot())
+
+    def flush(self):
+        if self.__journal is None:
+            return
+        changed = False
+        for friendId in self.__dirty:
+            dynamic = self.__friendsDynamic.get(friendId, None)
+            if dynamic is not None:
+                self.__journal.append(('l', friendId, dynamic.lastSeen, dynamic.lastExchange))
+                changed = True
+        self.__dirty.clear()
+        for friendId, friend in self.__friends.iteritems():
+            session = self.__authorizator.getSession(friend.address)
+            if session is not None and session is not friend.session:
+                friend.session = session
+                self.__journal.append(('s', friendId, session.id, session.ticket, session.key, session.expiry))
+                changed = True
+        if changed:
+            self.__journal.append(('t', self.__time.getCurrentTimestamp()))
+        if self.__needsCompaction():
+            self.__compact()
+        else:
+            self.__journal.flush()
+
+    def close(self):
+        if self.__journal is not None:
+            self.flush()
+            self.__journal.close()
+            self.__journal = None
+
+    def getJournalStats(self):
+        if self.__journal is None:
+            return None
+        return self.__journal.getStats()
+
+    def getData(self):
+        return self.__data
+
+    def setData(self, data):
+        self.__data = data
+        if self.__journal is not None:
+            self.__journal.append(('d', data))
 
     def empty(self):
         return len(self.__friends) == 0
 
     def add(self, friendId, friendAddress):
-        if not friendId in self.__friends:
-            self.__friends[friendId] = _DHT_Friend(friendId, friendAddress)
-            self.__friendsDynamic[friendId] = _DHT_FriendDynamic(self.__time.getCurrentTimestamp(), self.__time.getCurrentTimestamp() - FRIENDS_EXCHANGE_INTERVAL + 15)
+        self.addMany(((friendId, friendAddress),))
+
+    def addMany(self, friends):
+        # friends - [(id, address)], unknown ones are added, returns their number
+        now = self.__time.getCurrentTimestamp()
+        added = []
+        for friendId, friendAddress in friends:
+            if not friendId in self.__friends:
+                self.__friends[friendId] = _DHT_Friend(friendId, friendAddress)
+                self.__friendsDynamic[friendId] = _DHT_FriendDynamic(now, now - FRIENDS_EXCHANGE_INTERVAL + 15)
+                self.__slots[_livenessSlot(friendId)].add(friendId)
+                self.__dirty.add(friendId)
+                if self.__journal is not None:
+                    self.__journal.append(('a', friendId, friendAddress))
+                added.append(friendId)
+        if added:
+            self.__table.addMany(added)
+        return len(added)
 
     def size(self):
         return len(self.__friends)
@@ -61,6 +280,11 @@ class _DHT_Friends:
     def remove(self, id):
         del self.__friends[id]
         del self.__friendsDynamic[id]
+        self.__table.remove(id)
+        self.__slots[_livenessSlot(id)].discard(id)
+        self.__dirty.discard(id)
+        if self.__journal is not None:
+            self.__journal.append(('r', id))
 
     def has(self, id):
         return id in self.__friends
@@ -69,13 +293,23 @@ class _DHT_Friends:
         return len(self.__friends) >= MAX_FRIENDS
 
     def findClosest(self, id, count = FRIENDS_PER_REQUEST, reverse = False, onlyAuthorized = False):
+        count = int(count)
         closestFriends = []
-        for frnd in self.__friends.itervalues():
-            if not onlyAuthorized or self.__authorizator.isAuthorized(frnd.id):
-                closestFriends.append((distance(id, frnd.id), frnd.id, frnd.address))
-                if len(closestFriends) > count:
+        if count <= 0:
+            return closestFriends
+        if reverse:
+            candidates = self.__table.iterFarthest(id)
+        else:
+            candidates = self.__table.iterClosest(id)
+        for friendDistance, friendId in candidates:
+            if not onlyAuthorized or self.__authorizator.isAuthorized(friendId):
+                closestFriends.append((friendDistance, friendId, self.__friends[friendId].address))
+                if len(closestFriends) >= count:
                     break
-        return sorted(closestFriends, reverse=reverse)
+        return closestFriends
+
+    def getIds(self):
+        return self.__friends.keys()
 
     def getAll(self):
         res = []
@@ -88,12 +322,36 @@ class _DHT_Friends:
 
     def markExchanged(self, id):
         self.__friendsDynamic[id].lastExchange = self.__time.getCurrentTimestamp()
+        self.__dirty.add(id)
+
+    def getLastSeen(self, id):
+        return self.__friendsDynamic[id].lastSeen
+
+    def markSeen(self, id):
+        dynamic = self.__friendsDynamic[id]
+        if dynamic.lastProbe > dynamic.lastSeen:
+            # answer to our ping
+            dynamic.reliability += LIVENESS_RELIABILITY_ALPHA * (1.0 - dynamic.reliability)
+        dynamic.lastSeen = self.__time.getCurrentTimestamp()
+        self.__dirty.add(id)
 
-    def getLastPingResponse(self, id):
-        return self.__friendsDynamic[id].lastPingResponse
+    def markProbed(self, id):
+        dynamic = self.__friendsDynamic[id]
+        if dynamic.lastProbe > dynamic.lastSeen:
+            # previous ping was not answered
+            dynamic.reliability -= LIVENESS_RELIABILITY_ALPHA * dynamic.reliability
+        dynamic.lastProbe = self.__time.getCurrentTimestamp()
 
-    def markPingResponse(self, id):
-        self.__friendsDynamic[id].lastPingResponse = self.__time.getCurrentTimestamp()
+    def getMaxIdle(self, id):
+        # reliable friends are pinged less often
+        reliability = self.__friendsDynamic[id].reliability
+        return PING_INTERVAL + reliability * (LIVENESS_MAX_IDLE - PING_INTERVAL)
+
+    def getAddress(self, id):
+        return self.__friends[id].address
+
+    def getSlot(self, slot):
+        return list(self.__slots[slot])
 
     def dump(self):
         for friend in self.__friends.values():
@@ -112,6 +370,15 @@ class _AuthStatusTypes:
     WAITING_ID = 1
     WAITING_CONFIRM = 2
     AUTHORIZED = 3
+    WAITING_RESUME = 4
+
+# Seconds, a peer may stay in the given state without sending the next packet
+_AUTH_TIMEOUTS = {
+    _AuthStatusTypes.WAITING_ID: AUTH_HANDSHAKE_TIMEOUT,
+    _AuthStatusTypes.WAITING_CONFIRM: AUTH_CONFIRM_TIMEOUT,
+    _AuthStatusTypes.WAITING_RESUME: AUTH_HANDSHAKE_TIMEOUT,
+    _AuthStatusTypes.AUTHORIZED: AUTH_IDLE_TIMEOUT,
+}
 
 class _AuthStatus:
     def __init__(self, address, selfAddress):
@@ -120,14 +387,239 @@ class _AuthStatus:
         self.commandsQueue = []
         self.address = address
         self.id = None
+        self.pubKey = None
+        self.encrypting = False
+        self.lastStep = None    # last handshake packet, sent to the peer
+        self.lastStepTime = 0
+        self.deadline = 0       # status is dropped, if nothing happens till this time
+        self.started = 0        # authorization start time
+
+class _AuthSession:
+    # Result of successful authorization of a peer: its id, the session key,
+    # derived from the shared random sequence, and the peer's ticket
+    def __init__(self, id, ticket, key, expiry):
+        self.id = id
+        self.ticket = ticket
+        self.key = key
+        self.expiry = expiry
+
+_TICKET_HEADER = struct.Struct('!dB') # expiry, address length
+
+def _packTicket(expiry, address, key):
+    return _TICKET_HEADER.pack(expiry, len(address)) + address + key
+
+def _confirmProof(randSeq):
+    # sent back instead of the random sequence itself: the sequence is the
+    # secret, the session key is derived from
+    return hmacSha256(randSeq, 'wasp confirm')
+
+def _unpackTicket(data):
+    # returns (expiry, address, key) or None
+    if data is None or len(data) < _TICKET_HEADER.size:
+        return None
+    expiry, addressLength = _TICKET_HEADER.unpack_from(data)
+    address = data[_TICKET_HEADER.size:_TICKET_HEADER.size + addressLength]
+    key = data[_TICKET_HEADER.size + addressLength:]
+    if len(address) != addressLength or len(key) != 32:
+        return None
+    return expiry, address, key
 
 class _Authorizator():
-    def __init__(self, communicator, dht, crypto):
+    # RSA operations go through cryptoExecutor: they are either done inline
+    # or in a process pool, in which case the state machine continues when
+    # the result arrives. At most MAX_CRYPTO_IN_FLIGHT operations run at
+    # once, MAX_CRYPTO_BACKLOG more wait in a queue, the rest are dropped.
+    #
+    # With confirm_confirm a peer also sends a session ticket: the session
+    # key, sealed with the peer's ticket key (derived from its private key,
+    # so it survives restarts). Later the peer is authorized again with a
+    # single resume => resume_response round trip, proving it can open the
+    # ticket, instead of the full rsa handshake.
+    #
+    # Every state has a deadline (see _AUTH_TIMEOUTS), expired statuses are
+    # dropped by expire(). Peers in the middle of authorization are also
+    # kept in creation order, at most MAX_HALF_OPEN_AUTH of them, the oldest
+    # are dropped first. Each of them queues at most MAX_AUTH_QUEUE packets.
+    #
+    # Public keys are verified against ids before they are cached, so the
+    # cache can be shared by authorizators of many identities (see Host.py).
+    # A cached key is not verified again, and when the peer at an address is
+    # known (a stale session) and its key is cached, request_id carries the
+    # expected id and a peer with this id doesn't send its public key.
+    def __init__(self, communicator, dht, crypto, time, cryptoExecutor = None, pubKeys = None):
         self.__statuses = {} # address => _AuthStatus
+        self.__halfOpen = OrderedDict() # address => _AuthStatus, not yet authorized
         self.__idToStatus = {} # id => _AuthStatus
+        self.__pubKeys = pubKeys if pubKeys is not None else LRUCache(PUB_KEYS_CACHE_SIZE) # id => public key
+        self.__sessions = LRUCache(MAX_SESSIONS) # address => _AuthSession
+        self.__ticketKey = None
         self.__communicator = communicator
         self.__dht = dht
         self.__crypto = crypto
+        self.__time = time
+        self.__stats = {
+            'handshakes': 0,
+            'resumed': 0,
+            'resume_failed': 0,
+            'evicted': 0,
+            'expired': 0,
+            'queue_dropped': 0,
+            'resent': 0,
+            'known_keys': 0,
+            'authorized': 0,
+            'failed': 0,
+        }
+        self.__handshakeTime = Histogram()
+        self.__resumeTime = Histogram()
+        self.__cryptoExecutor = cryptoExecutor or InlineCryptoExecutor(crypto)
+        self.__cryptoInFlight = 0
+        self.__cryptoBacklog = deque() # [(method, args, callback)]
+        self.__cryptoDropped = 0
+
+    def __runCrypto(self, method, args, callback):
+        # returns False if operation was dropped
+        if self.__cryptoInFlight >= MAX_CRYPTO_IN_FLIGHT:
+            if len(self.__cryptoBacklog) >= MAX_CRYPTO_BACKLOG:
+                self.__cryptoDropped += 1
+                return False
+            self.__cryptoBacklog.append((method, args, callback))
+            return True
+        self.__cryptoInFlight += 1
+        done = []
+        def onDone(success, result):
+            done.append(True)
+            self.__onCryptoDone(callback, success, result)
+        submitted = False
+        try:
+            self.__cryptoExecutor.submit(method, args, onDone)
+            submitted = True
+        finally:
+            # the slot is released by onDone, unless submit failed before it
+            if not submitted and not done:
+                self.__cryptoInFlight -= 1
+        return True
+
+    def __onCryptoDone(self, callback, success, result):
+        self.__cryptoInFlight -= 1
+        callback(success, result)
+        if self.__cryptoBacklog and self.__cryptoInFlight < MAX_CRYPTO_IN_FLIGHT:
+            self.__runCrypto(*self.__cryptoBacklog.popleft())
+
+    def getCryptoStats(self):
+        return {
+            'in_flight': self.__cryptoInFlight,
+            'backlog': len(self.__cryptoBacklog),
+            'dropped': self.__cryptoDropped,
+        }
+
+    def getStats(self):
+        stats = dict(self.__stats)
+        stats['statuses'] = len(self.__statuses)
+        stats['half_open'] = len(self.__halfOpen)
+        stats['handshake_seconds'] = self.__handshakeTime.getSnapshot()
+        stats['resume_seconds'] = self.__resumeTime.getSnapshot()
+        return stats
+
+    def __setStatus(self, status, statusType):
+        status.status = statusType
+        status.deadline = self.__time.getCurrentTimestamp() + _AUTH_TIMEOUTS[statusType]
+
+    def __createStatus(self, address):
+        if len(self.__halfOpen) >= MAX_HALF_OPEN_AUTH:
+            oldestAddress, _ = self.__halfOpen.popitem(last=False)
+            del self.__statuses[oldestAddress]
+            self.__stats['evicted'] += 1
+        status = _AuthStatus(address, self.__dht.getAddress())
+        status.started = self.__time.getCurrentTimestamp()
+        self.__statuses[address] = status
+        self.__halfOpen[address] = status
+        return status
+
+    def __sendStep(self, status, packet):
+        status.lastStep = packet
+        status.lastStepTime = self.__time.getCurrentTimestamp()
+        self.__communicator.send(self.__dht.getAddress(), status.address, packet)
+
+    def __resendStep(self, status):
+        # the peer keeps sending, while we wait for its answer - the answer
+        # or our packet was lost, the peer retries only the original request
+        if status.encrypting or status.lastStep is None:
+            return
+        if self.__time.getCurrentTimestamp() - status.lastStepTime < AUTH_RESEND_INTERVAL:
+            return
+        self.__stats['resent'] += 1
+        self.__sendStep(status, status.lastStep)
+
+    def __queuePacket(self, status, packet):
+        if len(status.commandsQueue) < MAX_AUTH_QUEUE:
+            status.commandsQueue.append(packet)
+        else:
+            self.__stats['queue_dropped'] += 1
+
+    def expire(self):
+        now = self.__time.getCurrentTimestamp()
+        expired = [address for address, status in self.__statuses.iteritems() if status.deadline < now]
+        for address in expired:
+            self.remove(address)
+        self.__stats['expired'] += len(expired)
+
+    def __getTicketKey(self):
+        if self.__ticketKey is None:
+            self.__ticketKey = hmacSha256(self.__dht.getPrivKey(), 'wasp ticket key')
+        return self.__ticketKey
+
+    def __openTicket(self, requesterAddress, ticket):
+        # returns session key from our own ticket, if it is valid for requester
+        ticket = _unpackTicket(unseal(self.__getTicketKey(), ticket))
+        if ticket is None:
+            return None
+        expiry, address, key = ticket
+        if address != requesterAddress or expiry < self.__time.getCurrentTimestamp():
+            return None
+        return key
+
+    def __onConfirmDecrypted(self, requesterAddress, success, randSeq):
+        if not success or not randSeq.startswith(requesterAddress):
+            # todo: process hacking attempt
+            self.__stats['failed'] += 1
+            self.remove(requesterAddress)
+            return
+        expiry = self.__time.getCurrentTimestamp() + SESSION_TICKET_LIFETIME
+        response = {
+            'type': 'confirm_confirm',
+            'rand_seq': _confirmProof(randSeq),
+            'ticket': seal(self.__getTicketKey(), _packTicket(expiry, requesterAddress, deriveSessionKey(randSeq))),
+        }
+        self.__communicator.send(self.__dht.getAddress(), requesterAddress, response)
+
+    def __onAuthorized(self, status):
+        duration = self.__time.getCurrentTimestamp() - status.started
+        if status.status == _AuthStatusTypes.WAITING_RESUME:
+            self.__resumeTime.observe(duration)
+        else:
+            self.__handshakeTime.observe(duration)
+        self.__stats['authorized'] += 1
+        self.__setStatus(status, _AuthStatusTypes.AUTHORIZED)
+        self.__halfOpen.pop(status.address, None)
+        self.__idToStatus[status.id] = status
+        for cmd in status.commandsQueue:
+            self.__dht._onPacketReceived(status.address, status.id, cmd)
+        status.commandsQueue = []
+
+    def __onRandSeqEncrypted(self, status, success, randSeq):
+        if self.__statuses.get(status.address, None) is not status:
+            return
+        status.encrypting = False
+        if not success:
+            self.__stats['failed'] += 1
+            self.remove(status.address)
+            return
+        self.__setStatus(status, _AuthStatusTypes.WAITING_CONFIRM)
+        response = {
+            'type': 'confirm',
+            'rand_seq': randSeq,
+        }
+        self.__sendStep(status, response)
 
     def onPacketReceived(self, requesterAddress, packet):
         if packet['type'] == 'request_id':
@@ -135,59 +627,122 @@ class _Authorizator():
                 'type': 'response_id',
                 'id': self.__dht.getId(),
             }
+            if self.__dht.getId() != self.__dht.getPubKey() and packet.get('id') != self.__dht.getId():
+                response['pub_key'] = self.__dht.getPubKey()
             self.__communicator.send(self.__dht.getAddress(), requesterAddress, response)
             return
         if packet['type'] == 'confirm':
-            randSeq = self.__crypto.decrypt(self.__dht.getPrivKey(), packet['rand_seq'])
-            if not randSeq.startswith(requesterAddress):
-                # todo: process hacking attempt
-                if requesterAddress in self.__statuses:
-                    del self.__statuses[requesterAddress]
-                return
+            self.__runCrypto('decrypt', (self.__dht.getPrivKey(), packet['rand_seq']),
+                             lambda success, randSeq: self.__onConfirmDecrypted(requesterAddress, success, randSeq))
+            return
+        if packet['type'] == 'resume':
             response = {
-                'type': 'confirm_confirm',
-                'rand_seq': randSeq,
+                'type': 'resume_response',
             }
+            key = self.__openTicket(requesterAddress, packet['ticket'])
+            if key is not None:
+                response['rand_seq'] = hmacSha256(key, packet['rand_seq'])
             self.__communicator.send(self.__dht.getAddress(), requesterAddress, response)
             return
 
-        status = self.__statuses.setdefault(requesterAddress, _AuthStatus(requesterAddress, self.__dht.getAddress()))
+        status = self.__statuses.get(requesterAddress, None)
+        if status is None:
+            status = self.__createStatus(requesterAddress)
+        if status.status == _AuthStatusTypes.AUTHORIZED:
+            status.deadline = self.__time.getCurrentTimestamp() + AUTH_IDLE_TIMEOUT
+            self.__dht._onPacketReceived(status.address, status.id, packet)
+            return
         if status.status == _AuthStatusTypes.UNAUTHORIZED:
-            status.commandsQueue.append(packet)
-            response = {
-                'type': 'request_id',
-            }
-            status.status = _AuthStatusTypes.WAITING_ID
-            self.__communicator.send(self.__dht.getAddress(), requesterAddress, response)
+            self.__queuePacket(status, packet)
+            session = self.__sessions.get(requesterAddress)
+            if session is not None and session.expiry > self.__time.getCurrentTimestamp():
+                response = {
+                    'type': 'resume',
+                    'ticket': session.ticket,
+                    'rand_seq': status.randSeq,
+                }
+                self.__setStatus(status, _AuthStatusTypes.WAITING_RESUME)
+            else:
+                response = self.__requestId(session)
+                self.__setStatus(status, _AuthStatusTypes.WAITING_ID)
+                self.__stats['handshakes'] += 1
+            self.__sendStep(status, response)
+            return
+        if status.status == _AuthStatusTypes.WAITING_RESUME:
+            if packet['type'] == 'resume_response':
+                session = self.__sessions.get(requesterAddress)
+                proof = packet.get('rand_seq', None)
+                if session is not None and proof is not None and \
+                        hmac.compare_digest(proof, hmacSha256(session.key, status.randSeq)):
+                    self.__stats['resumed'] += 1
+                    status.id = session.id
+                    self.__onAuthorized(status)
+                else:
+                    # ticket expired or peer lost its keys - fall back to the full handshake
+                    self.__stats['resume_failed'] += 1
+                    self.__sessions.remove(requesterAddress)
+                    self.__setStatus(status, _AuthStatusTypes.WAITING_ID)
+                    self.__stats['handshakes'] += 1
+                    self.__sendStep(status, self.__requestId(session))
+            else:
+                self.__queuePacket(status, packet)
+                self.__resendStep(status)
             return
         if status.status == _AuthStatusTypes.WAITING_ID:
             if packet['type'] == 'response_id':
-                status.status = _AuthStatusTypes.WAITING_CONFIRM
+                if status.encrypting:
+                    return
+                pubKey = packet.get('pub_key', None)
+                knownKey = self.__pubKeys.get(packet['id'])
+                if knownKey is not None and pubKey in (None, knownKey):
+                    self.__stats['known_keys'] += 1
+                    pubKey = knownKey
+                else:
+                    if pubKey is None:
+                        pubKey = packet['id']
+                    if pubKeyToId(pubKey) != packet['id']:
+                        # todo: process hacking attempt
+                        self.__stats['failed'] += 1
+                        # the key may have left the cache, don't ask to omit it again
+                        self.__sessions.remove(requesterAddress)
+                        self.remove(requesterAddress)
+                        return
+                    self.__pubKeys.put(packet['id'], pubKey)
                 status.id = packet['id']
-                response = {
-                    'type': 'confirm',
-                    'rand_seq': self.__crypto.encrypt(status.id, status.randSeq),
-                }
-                self.__communicator.send(self.__dht.getAddress(), requesterAddress, response)
+                status.pubKey = pubKey
+                status.encrypting = True
+                if not self.__runCrypto('encrypt', (status.pubKey, status.randSeq),
+                                        lambda success, randSeq: self.__onRandSeqEncrypted(status, success, randSeq)):
+                    self.remove(requesterAddress)
             else:
-                status.commandsQueue.append(packet)
+                self.__queuePacket(status, packet)
+                self.__resendStep(status)
             return
         if status.status == _AuthStatusTypes.WAITING_CONFIRM:
             if packet['type'] == 'confirm_confirm':
-                if packet['rand_seq'] == status.randSeq:
-                    status.status = _AuthStatusTypes.AUTHORIZED
-                    self.__idToStatus[status.id] = status
-                    for cmd in status.commandsQueue:
-                        self.__dht._onPacketReceived(status.address, status.id, cmd)
-                    status.commandsQueue = []
+                if hmac.compare_digest(packet['rand_seq'], _confirmProof(status.randSeq)):
+                    if 'ticket' in packet:
+                        expiry = self.__time.getCurrentTimestamp() + SESSION_TICKET_LIFETIME
+                        session = _AuthSession(status.id, packet['ticket'], deriveSessionKey(status.randSeq), expiry)
+                        self.__sessions.put(status.address, session)
+                    self.__onAuthorized(status)
                 else:
                     # todo: process hacking attempt
-                    del self.__statuses[requesterAddress]
+                    self.__stats['failed'] += 1
+                    self.remove(requesterAddress)
             else:
-                status.commandsQueue.append(packet)
+                self.__queuePacket(status, packet)
+                self.__resendStep(status)
             return
-        if status.status == _AuthStatusTypes.AUTHORIZED:
-            self.__dht._onPacketReceived(status.address, status.id, packet)
+
+    def __requestId(self, session):
+        # session - stale session with the peer or None
+        response = {
+            'type': 'request_id',
+        }
+        if session is not None and self.__pubKeys.get(session.id) is not None:
+            response['id'] = session.id
+        return response
 
     def isAuthorized(self, id):
         status = self.__idToStatus.get(id, None)
@@ -195,17 +750,134 @@ class _Authorizator():
             return False
         return status.status == _AuthStatusTypes.AUTHORIZED
 
+    def getSession(self, address):
+        return self.__sessions.get(address)
+
+    def addSession(self, address, session):
+        self.__sessions.put(address, session)
+
     def remove(self, addr):
         status = self.__statuses.get(addr, None)
         if status is None:
             return
         id = status.id
-        if id in self.__idToStatus:
+        if self.__idToStatus.get(id, None) is status:
             del self.__idToStatus[id]
         del self.__statuses[addr]
+        self.__halfOpen.pop(addr, None)
+
+class _DHT_PendingRequest:
+    def __init__(self, address, responseType, context, timer):
+        self.address = address
+        self.responseType = responseType
+        self.context = context
+        self.timer = timer
+
+class _DHT_PendingRequests:
+    # Requests waiting for a response: nonce => _DHT_PendingRequest. A
+    # response is accepted once, only with the nonce of a request, sent to
+    # its address and of the matching type. Anything else is dropped before
+    # the rest of the packet is even decoded.
+    def __init__(self, time):
+        self.__time = time
+        self.__requests = {}
+        self.__stats = {
+            'sent': 0,
+            'answered': 0,
+            'expired': 0,
+            'unsolicited': 0,
+        }
+
+    def add(self, address, responseType, context, timeout, onTimeout = None):
+        # returns nonce for the request, onTimeout(context) is called, when
+        # there is no response in timeout seconds
+        nonce = os.urandom(REQUEST_NONCE_LENGTH)
+        timer = self.__time.scheduleOnce(lambda: self.__onTimeout(nonce, onTimeout), timeout)
+        self.__requests[nonce] = _DHT_PendingRequest(address, responseType, context, timer)
+        self.__stats['sent'] += 1
+        return nonce
+
+    def __onTimeout(self, nonce, onTimeout):
+        request = self.__requests.pop(nonce, None)
+        if request is None:
+            return
+        self.__stats['expired'] += 1
+        if onTimeout is not None:
+            onTimeout(request.context)
+
+    def pop(self, address, packet):
+        # returns context of the request, answered by packet, or None
+        nonce = packet.get('nonce', None)
+        request = self.__requests.get(nonce, None)
+        if request is None or request.address != address or request.responseType != packet['type']:
+            self.__stats['unsolicited'] += 1
+            return None
+        del self.__requests[nonce]
+        self.__time.cancelFunc(request.timer)
+        self.__stats['answered'] += 1
+        return request.context
+
+    def cancelAll(self):
+        for request in self.__requests.itervalues():
+            self.__time.cancelFunc(request.timer)
+        self.__requests = {}
+
+    def getStats(self):
+        stats = dict(self.__stats)
+        stats['pending'] = len(self.__requests)
+        return stats
+
+class _LookupStates:
+    NEW = 0
+    WAITING = 1
+    RESPONDED = 2
+    FAILED = 3
+
+class _DHT_LookupCandidate:
+    def __init__(self, distance, id, address):
+        self.distance = distance    # to lookup target, -1 for initial nodes with unknown id
+        self.id = id
+        self.address = address
+        self.state = _LookupStates.NEW
+        self.retries = 0
+
+class _DHT_Lookup:
+    # Iterative search of the nodes closest to target, kademlia style: up to
+    # LOOKUP_ALPHA closest candidates are queried in parallel, each response
+    # brings new candidates. Lookup is finished, when count closest known
+    # candidates have responded (failed ones are skipped).
+    def __init__(self, target, count, callback):
+        self.target = target
+        self.count = count
+        self.callbacks = [callback] if callback is not None else []
+        self.candidates = {} # address => _DHT_LookupCandidate
+        self.waiting = 0
+
+    def addCandidate(self, id, address):
+        if address in self.candidates:
+            return
+        candidateDistance = distance(self.target, id) if id is not None else -1
+        self.candidates[address] = _DHT_LookupCandidate(candidateDistance, id, address)
+
+    def addCandidates(self, friends):
+        # friends - [(id, address)] of a response, scored in one pass; these
+        # one-off target pairs would only churn the distance cache
+        addresses = {}
+        for id, address in friends:
+            addresses.setdefault(id, address)
+        for candidateDistance, id in rankByDistance(self.target, addresses.keys()):
+            address = addresses[id]
+            if address not in self.candidates:
+                self.candidates[address] = _DHT_LookupCandidate(candidateDistance, id, address)
+
+    def getClosest(self):
+        candidates = [c for c in self.candidates.itervalues() if c.state != _LookupStates.FAILED]
+        candidates.sort(key=lambda c: c.distance)
+        return candidates[:self.count]
 
 class DHT:
-    def __init__(self, login, password, stateFile, communicator, selfAddress, initialAddress, time):
+    def __init__(self, login, password, stateFile, communicator, selfAddress, initialAddress, time,
+                 cryptoExecutor = None, pubKeys = None):
         self.__login = login
         self.__password = password
         self.__address = selfAddress
@@ -215,19 +887,51 @@ class DHT:
         self.__generateKeys()
 
         self.__communicator = communicator
-        self.__authorizator = _Authorizator(self.__communicator, self, self.__crypto)
-        self.__communicator.subscribe(selfAddress, self.__authorizator.onPacketReceived)
         self.__time = time
+        self.__metrics = Metrics()
+        self.__handlerTimes = {} # packet type => Histogram
+        self.__authorizator = _Authorizator(self.__communicator, self, self.__crypto, time, cryptoExecutor, pubKeys)
+        self.__communicator.subscribe(selfAddress, self.__authorizator.onPacketReceived)
 
+        self.__livenessSlot = 0
+        self.__requests = _DHT_PendingRequests(time)
+        self.__handlers = {} # packet type => handler of services on top of DHT
+        self.__friendRemovedHandlers = []
+        self.__selfLookup = None
+        self.__initialAddress = initialAddress
         self.__friends = _DHT_Friends(stateFile, time, self.__authorizator)
         if self.__friends.empty() and initialAddress:
             self.sendSearchRequest(initialAddress)
-        self.__time.scheduleFunc(self.__exchangeFriends, FRIENDS_EXCHANGE_INTERVAL / MAX_FRIENDS)
-        self.__time.scheduleFunc(self.__pingFriends, PING_INTERVAL)
+        self.__timers = [
+            self.__time.scheduleFunc(self.__exchangeFriends, FRIENDS_EXCHANGE_INTERVAL / MAX_FRIENDS),
+            self.__time.scheduleFunc(self.__checkLiveness, float(PING_INTERVAL) / LIVENESS_SLOTS),
+            self.__time.scheduleFunc(self.__friends.flush, JOURNAL_FLUSH_INTERVAL),
+            self.__time.scheduleFunc(self.__authorizator.expire, AUTH_EXPIRE_INTERVAL),
+            self.__time.scheduleFunc(self.__refreshSelfLookup, SELF_LOOKUP_INTERVAL),
+        ]
+        self.__metrics.addSource('communicator', lambda: {
+            'by_type': self.__communicator.getStatsByType(),
+            'decode_errors': self.__communicator.getDecodeErrors(),
+        })
+        self.__metrics.addSource('auth', self.__authorizator.getStats)
+        self.__metrics.addSource('crypto', self.__authorizator.getCryptoStats)
+        self.__metrics.addSource('crypto.keys', self.__crypto.getStats)
+        self.__metrics.addSource('requests', self.__requests.getStats)
+        self.__metrics.addSource('routing_table', lambda: {'size': self.__friends.size()})
+        self.__metrics.addSource('journal', self.__friends.getJournalStats)
+        self.__metrics.addSource('distance_cache', getDistanceCacheStats)
+
+    def stop(self):
+        for timer in self.__timers:
+            self.__time.cancelFunc(timer)
+        self.__timers = []
+        self.__requests.cancelAll()
+        self.__friends.close()
+        self.__communicator.unsubscribe(self.__address)
 
     def __removeFriendsIfRequired(self):
         if self.__friends.size() > 1.3 * MAX_FRIENDS:
-            requiredToRemove = 0.15 * MAX_FRIENDS
+            requiredToRemove = self.__friends.size() - 1.15 * MAX_FRIENDS
             farthestFriends = self.__friends.findClosest(self.__id, count=requiredToRemove, reverse=True)
             for f in farthestFriends:
                 self.__authorizator.remove(f[2])
@@ -240,40 +944,171 @@ class DHT:
             if now - self.__friends.getLastExchange(id) > FRIENDS_EXCHANGE_INTERVAL:
                 packet = {
                     'type': 'exchange',
+                    'nonce': self.__requests.add(address, 'exchange_response', id, EXCHANGE_TIMEOUT),
                 }
+                if FRIENDS_DELTA_EXCHANGE:
+                    self.__addFriendsSummary(packet, id)
                 self.__friends.markExchanged(id)
                 self.__communicator.send(self.__address, address, packet)
                 break
 
-    def __pingFriends(self):
-        allFriends = self.__friends.getAll()
+    def __addFriendsSummary(self, packet, friendId):
+        # bloom filter of known friends, salted with both ids, so each friend
+        # gets its own false positives (and the simulation stays deterministic,
+        # unlike with the random nonce)
+        ids = self.__friends.getIds()
+        size = min(MAX_FILTER_SIZE, max(8, (len(ids) * FRIENDS_FILTER_BITS_PER_ID + 7) / 8))
+        bloom = BloomFilter(size, FRIENDS_FILTER_HASHES, self.__id + friendId)
+        for id in ids:
+            bloom.add(id)
+        packet['filter'] = bloom.toBytes()
+        if len(ids) >= MAX_FRIENDS:
+            farthest = self.__friends.findClosest(self.__id, 1, reverse=True)
+            packet['radius'] = farthest[0][0]
+
+    def __filterKnownFriends(self, requesterId, packet, closestFriends):
+        # drops friends, the requester already has or wouldn't keep
+        filterData = packet['filter']
+        bloom = BloomFilter(len(filterData), FRIENDS_FILTER_HASHES, requesterId + self.__id, filterData)
+        radius = packet.get('radius')
+        return [f for f in closestFriends
+                if f[1] != requesterId and (radius is None or f[0] < radius) and not f[1] in bloom]
+
+    def __checkLiveness(self):
+        # Any authorized packet from a friend proves it is alive, only idle
+        # friends are pinged. Friends are checked one slot per call, so pings
+        # are spread over PING_INTERVAL instead of being sent all at once.
+        slot = self.__livenessSlot
+        self.__livenessSlot = (slot + 1) % LIVENESS_SLOTS
         packet = {
             'type': 'ping',
         }
         now = self.__time.getCurrentTimestamp()
-        for friend in allFriends:
-            interval = now - friend.lastPingResponse
-            if interval > PING_INTERVAL:
-                if interval > FRIENDS_TIMEOUT:
-                    self.__authorizator.remove(friend.address)
-                    self.__friends.remove(friend.id)
-                else:
-                    self.__communicator.send(self.__address, friend.address, packet)
+        for id in self.__friends.getSlot(slot):
+            idle = now - self.__friends.getLastSeen(id)
+            if idle > FRIENDS_TIMEOUT:
+                address = self.__friends.getAddress(id)
+                self.__authorizator.remove(address)
+                self.__friends.remove(id)
+                for handler in self.__friendRemovedHandlers:
+                    handler(id, address)
+            elif idle > self.__friends.getMaxIdle(id):
+                self.__friends.markProbed(id)
+                self.__communicator.send(self.__address, self.__friends.getAddress(id), packet)
 
     def __generateKeys(self):
-        self.__privateKey, self.__id = self.__crypto.generateKeys(self.__login, self.__password)
+        self.__privateKey, self.__pubKey = self.__crypto.generateKeys(self.__login, self.__password)
+        self.__id = pubKeyToId(self.__pubKey)
+        assert len(self.__id) == ID_SIZE
 
     def sendSearchRequest(self, address):
-        searchPacket = {
+        # look for own closest nodes, starting from a node with unknown id
+        if self.__selfLookup is None:
+            self.__selfLookup = _DHT_Lookup(self.__id, FRIENDS_PER_REQUEST, self.__onSelfLookupDone)
+        self.__selfLookup.addCandidate(None, address)
+        self.__continueLookup(self.__selfLookup)
+
+    def __onSelfLookupDone(self, nodes):
+        self.__selfLookup = None
+
+    def __refreshSelfLookup(self):
+        # a joining node may stay with few (or no) friends after lost packets
+        # (or in a small island of such nodes), so own id is looked up again,
+        # starting from the closest friends and the initial node, until the
+        # table is filled
+        if self.__selfLookup is not None or self.__friends.size() >= MAX_FRIENDS:
+            return
+        lookup = _DHT_Lookup(self.__id, FRIENDS_PER_REQUEST, self.__onSelfLookupDone)
+        for _, id, address in self.__friends.findClosest(self.__id, FRIENDS_PER_REQUEST):
+            lookup.addCandidate(id, address)
+        if self.__initialAddress:
+            lookup.addCandidate(None, self.__initialAddress)
+        if lookup.candidates:
+            self.__selfLookup = lookup
+            self.__continueLookup(lookup)
+
+    def lookup(self, target, callback, count = FRIENDS_PER_REQUEST):
+        # callback([(id, address)]) is called with up to count nodes closest
+        # to target, ordered by distance
+        lookup = _DHT_Lookup(target, count, callback)
+        for _, id, address in self.__friends.findClosest(target, count):
+            lookup.addCandidate(id, address)
+        self.__continueLookup(lookup)
+
+    def __continueLookup(self, lookup):
+        closest = lookup.getClosest()
+        for candidate in closest:
+            if lookup.waiting >= LOOKUP_ALPHA:
+                break
+            if candidate.state == _LookupStates.NEW:
+                self.__sendLookupRequest(lookup, candidate)
+        if lookup.waiting == 0:
+            nodes = [(c.id, c.address) for c in closest if c.state == _LookupStates.RESPONDED]
+            callbacks = lookup.callbacks
+            lookup.callbacks = []
+            for callback in callbacks:
+                callback(nodes)
+
+    def __sendLookupRequest(self, lookup, candidate):
+        nonce = self.__requests.add(candidate.address, 'search_response', (lookup, candidate),
+                                    LOOKUP_TIMEOUT, self.__onLookupTimeout)
+        candidate.state = _LookupStates.WAITING
+        lookup.waiting += 1
+        packet = {
             'type': 'search',
+            'target': lookup.target,
+            'nonce': nonce,
         }
-        self.__communicator.send(self.__address, address, searchPacket)
+        self.__communicator.send(self.__address, candidate.address, packet)
+
+    def __onLookupTimeout(self, request):
+        lookup, candidate = request
+        lookup.waiting -= 1
+        if candidate.retries < LOOKUP_RETRIES:
+            candidate.retries += 1
+            self.__sendLookupRequest(lookup, candidate)
+        else:
+            candidate.state = _LookupStates.FAILED
+            self.__continueLookup(lookup)
+
+    def __onSearchResponse(self, requesterAddress, requesterId, packet):
+        request = self.__requests.pop(requesterAddress, packet)
+        if request is None:
+            return
+        lookup, candidate = request
+        lookup.waiting -= 1
+        candidate.state = _LookupStates.RESPONDED
+        candidate.id = requesterId
+        candidate.distance = distance(lookup.target, requesterId)
+        closestFriends = packet['closest_friends']
+        if len(closestFriends) <= FRIENDS_PER_REQUEST:
+            closestFriends = [f for f in closestFriends if f[0] != self.__id]
+            lookup.addCandidates(closestFriends)
+            if lookup is self.__selfLookup:
+                self.__addFriends(closestFriends)
+        self.__continueLookup(lookup)
+
+    def __addFriends(self, friends):
+        if self.__friends.addMany(friends):
+            self.__removeFriendsIfRequired()
 
 
     def _onPacketReceived(self, requesterAddress, requesterId, packet):
+        start = walltime.time()
+        self.__handlePacket(requesterAddress, requesterId, packet)
+        histogram = self.__handlerTimes.get(packet['type'], None)
+        if histogram is None:
+            histogram = self.__handlerTimes[packet['type']] = self.__metrics.getHistogram('handler_seconds.' + packet['type'])
+        histogram.observe(walltime.time() - start)
+
+    def __handlePacket(self, requesterAddress, requesterId, packet):
+        if self.__friends.has(requesterId):
+            self.__friends.markSeen(requesterId)
+
         if packet['type'] == 'search':
-            closestFriends = self.__friends.findClosest(requesterId, onlyAuthorized=True)
-            closestFriends.append((distance(self.__id, requesterId), self.__id, self.__address))
+            target = packet.get('target', requesterId)
+            closestFriends = self.__friends.findClosest(target, onlyAuthorized=True)
+            closestFriends.append((distance(self.__id, target), self.__id, self.__address))
             closestFriends = sorted(closestFriends)[:FRIENDS_PER_REQUEST]
             newClosestFriends = []
             for _, id, address in closestFriends:
@@ -282,24 +1117,19 @@ class DHT:
                 'type' : 'search_response',
                 'closest_friends': newClosestFriends,
             }
+            if 'nonce' in packet:
+                response['nonce'] = packet['nonce']
             self.__communicator.send(self.__address, requesterAddress, response)
             if self.__friends.size() == 0:
                 self.sendSearchRequest(requesterAddress)
 
         elif packet['type'] == 'search_response':
-            # todo: check that u really requested this
-            prevClosest = self.__friends.findClosest(self.__id, 1)[0] if self.__friends.size() > 0 else None
-            for closestFriend in packet['closest_friends']:
-                id, address = closestFriend
-                if id != self.__id:
-                    self.__friends.add(id, address)
-                    self.__removeFriendsIfRequired()
-            newClosest = self.__friends.findClosest(self.__id, 1)[0] if self.__friends.size() > 0 else None
-            if newClosest != prevClosest:
-                self.sendSearchRequest(newClosest[2])
+            self.__onSearchResponse(requesterAddress, requesterId, packet)
 
         elif packet['type'] == 'exchange':
             closestFriends = self.__friends.findClosest(requesterId, MAX_FRIENDS, onlyAuthorized=True)
+            if packet.get('filter'):
+                closestFriends = self.__filterKnownFriends(requesterId, packet, closestFriends)
             newClosestFriends = []
             for _, id, address in closestFriends:
                 newClosestFriends.append((id, address))
@@ -307,22 +1137,18 @@ class DHT:
                 'type': 'exchange_response',
                 'closest_friends': newClosestFriends,
             }
+            if 'nonce' in packet:
+                response['nonce'] = packet['nonce']
             self.__communicator.send(self.__address, requesterAddress, response)
             if self.__friends.size() == 0:
                 self.sendSearchRequest(requesterAddress)
 
         elif packet['type'] == 'exchange_response':
-            # todo: check that u really requested this
-            for closestFriend in packet['closest_friends']:
-                id, address = closestFriend
-                if id != self.__id:
-                    self.__friends.add(id, address)
-                    self.__removeFriendsIfRequired()
+            if self.__requests.pop(requesterAddress, packet) is not None:
+                self.__addFriends([f for f in packet['closest_friends'] if f[0] != self.__id])
 
         elif packet['type'] == 'ping':
-            if self.__friends.has(requesterId):
-                self.__friends.markPingResponse(requesterId)
-            else:
+            if not self.__friends.has(requesterId):
                 self.__friends.add(requesterId, requesterAddress)
                 self.__removeFriendsIfRequired()
             packet = {
@@ -333,8 +1159,63 @@ class DHT:
                 self.sendSearchRequest(requesterAddress)
 
         elif packet['type'] == 'pong':
-            if self.__friends.has(requesterId):
-                self.__friends.markPingResponse(requesterId)
+            pass # friend is already marked as seen
+
+        else:
+            handler = self.__handlers.get(packet['type'], None)
+            if handler is not None:
+                handler(requesterAddress, requesterId, packet)
+
+    def registerHandler(self, packetType, handler):
+        # handler(address, id, packet) of authorized packets of packetType
+        self.__handlers[packetType] = handler
+
+    def addFriendRemovedHandler(self, handler):
+        # handler(id, address) of friends, dropped by liveness checks
+        self.__friendRemovedHandlers.append(handler)
+
+    def addMetricsSource(self, prefix, func):
+        self.__metrics.addSource(prefix, func)
+
+    def send(self, address, packet):
+        self.__communicator.send(self.__address, address, packet)
+
+    def sendRequest(self, address, packet, responseType, context, timeout, onTimeout = None):
+        # packet gets a nonce, its response is accepted by popResponse only
+        # once, see _DHT_PendingRequests
+        packet['nonce'] = self.__requests.add(address, responseType, context, timeout, onTimeout)
+        self.__communicator.send(self.__address, address, packet)
+
+    def popResponse(self, address, packet):
+        # returns context of the request, answered by packet, or None
+        return self.__requests.pop(address, packet)
+
+    def getCryptoStats(self):
+        return self.__authorizator.getCryptoStats()
+
+    def getAuthStats(self):
+        return self.__authorizator.getStats()
+
+    def getRequestStats(self):
+        return self.__requests.getStats()
+
+    def getMetrics(self):
+        # snapshot of all node metrics, see Metrics.getSnapshot()
+        return self.__metrics.getSnapshot()
+
+    def saveState(self):
+        self.__friends.flush()
+
+    def getData(self):
+        return self.__friends.getData()
+
+    def setData(self, data):
+        # own data record, e.g. root of a backup (see Backup.py). Kept only
+        # in the local journal, it is not published to friends.
+        self.__friends.setData(data)
+
+    def getJournalStats(self):
+        return self.__friends.getJournalStats()
 
     def getFriendsSize(self):
         return self.__friends.size()
@@ -345,6 +1226,9 @@ class DHT:
     def getAddress(self):
         return self.__address
 
+    def getPubKey(self):
+        return self.__pubKey
+
     def getPrivKey(self):
         return self.__privateKey
 
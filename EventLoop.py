@@ -0,0 +1,96 @@
+import select
+import errno
+import socket
+from collections import deque
+
+
+class EventLoop:
+    # Single threaded select() loop: socket readiness callbacks, timers of
+    # the attached timer source (RealTime) plus callbacks, deferred to the
+    # end of the current loop iteration (tick).
+
+    def __init__(self):
+        self.__readers = {} # fd => callback
+        self.__writers = {} # fd => callback
+        self.__ready = []   # [(func, args)], executed at the end of the tick
+        self.__running = False
+        self.__timerSource = None
+
+        # callbacks from other threads and a socket pair to wake up select()
+        self.__threadsafeReady = deque()
+        self.__wakeupReader, self.__wakeupWriter = socket.socketpair()
+        self.__wakeupReader.setblocking(False)
+        self.__wakeupWriter.setblocking(False)
+        self.addReader(self.__wakeupReader, self.__onWakeup)
+
+    def setTimerSource(self, timerSource):
+        # timerSource provides getNextTimeout() and advance()
+        self.__timerSource = timerSource
+
+    def addReader(self, sock, callback):
+        self.__readers[sock.fileno()] = callback
+
+    def removeReader(self, sock):
+        self.__readers.pop(sock.fileno(), None)
+
+    def addWriter(self, sock, callback):
+        self.__writers[sock.fileno()] = callback
+
+    def removeWriter(self, sock):
+        self.__writers.pop(sock.fileno(), None)
+
+    def callSoon(self, func, *args):
+        self.__ready.append((func, args))
+
+    def callSoonThreadsafe(self, func, *args):
+        self.__threadsafeReady.append((func, args))
+        try:
+            self.__wakeupWriter.send('x')
+        except socket.error:
+            pass # wakeup is already pending
+
+    def __onWakeup(self):
+        try:
+            while self.__wakeupReader.recv(4096):
+                pass
+        except socket.error:
+            pass
+        while self.__threadsafeReady:
+            self.__ready.append(self.__threadsafeReady.popleft())
+
+    def runOnce(self, timeout = None):
+        if self.__ready:
+            timeout = 0
+        if self.__timerSource is not None:
+            timerTimeout = self.__timerSource.getNextTimeout()
+            if timerTimeout is not None and (timeout is None or timerTimeout < timeout):
+                timeout = timerTimeout
+        try:
+            readable, writable, _ = select.select(self.__readers.keys(), self.__writers.keys(), [], timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable, writable = [], []
+        for fd in readable:
+            callback = self.__readers.get(fd, None)
+            if callback is not None:
+                callback()
+        for fd in writable:
+            callback = self.__writers.get(fd, None)
+            if callback is not None:
+                callback()
+        if self.__timerSource is not None:
+            self.__timerSource.advance()
+        while self.__ready:
+            ready = self.__ready
+            self.__ready = []
+            for func, args in ready:
+                func(*args)
+
+    def run(self):
+        self.__running = True
+        while self.__running:
+            self.runOnce()
+
+    def stop(self):
+        self.__running = False
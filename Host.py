@@ -0,0 +1,55 @@
+from DHT import DHT
+from UdpCommunicator import UdpCommunicator
+from LRUCache import LRUCache
+from CryptoUtils import getDistanceCacheStats, getCiphersCacheStats
+from constants import PUB_KEYS_CACHE_SIZE
+
+
+class Host:
+    # Many DHT identities in one process, on one event loop, one timer wheel
+    # and one UDP socket: identity with tag T has address 'host:port/T',
+    # datagrams are routed to it by the tag (see UdpCommunicator).
+    #
+    # Identities share the public keys cache: a key verified by one of them
+    # is used by the others without verifying it again (see _Authorizator).
+    # Distance and rsa ciphers caches are per process (CryptoUtils) and
+    # shared anyway.
+    def __init__(self, loop, time, address, cryptoExecutor = None):
+        self.__time = time
+        self.__address = address
+        self.__cryptoExecutor = cryptoExecutor
+        self.__communicator = UdpCommunicator(loop, time)
+        self.__pubKeys = LRUCache(PUB_KEYS_CACHE_SIZE)
+        self.__identities = {} # tag => DHT
+
+    def addIdentity(self, tag, login, password, stateFile, initialAddress):
+        assert tag and not '/' in tag and not tag in self.__identities
+        dht = DHT(login, password, stateFile, self.__communicator, self.__address + '/' + tag,
+                  initialAddress, self.__time, self.__cryptoExecutor, self.__pubKeys)
+        self.__identities[tag] = dht
+        return dht
+
+    def removeIdentity(self, tag):
+        self.__identities.pop(tag).stop()
+
+    def getIdentity(self, tag):
+        return self.__identities.get(tag, None)
+
+    def getIdentities(self):
+        return self.__identities.values()
+
+    def getCommunicator(self):
+        return self.__communicator
+
+    def stop(self):
+        for tag in self.__identities.keys():
+            self.removeIdentity(tag)
+
+    def getStats(self):
+        return {
+            'identities': len(self.__identities),
+            'communicator': self.__communicator.getStats(),
+            'pub_keys_cache': self.__pubKeys.getStats(),
+            'distance_cache': getDistanceCacheStats(),
+            'ciphers_cache': getCiphersCacheStats(),
+        }
@@ -0,0 +1,98 @@
+import os
+import struct
+import zlib
+
+import msgpack
+
+# Journal file is a sequence of records:
+#   uint32 payload size, uint32 crc32 of payload, payload (msgpack)
+# A record, torn by a crash in the middle of a write, fails the size or
+# crc check; it and everything after it are discarded on load.
+
+_RECORD_HEADER = struct.Struct('!II')
+
+def _packRecord(record):
+    payload = msgpack.packb(record)
+    return _RECORD_HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+def _unpackRecords(data):
+    # returns ([records], size of valid data)
+    records = []
+    offset = 0
+    while offset + _RECORD_HEADER.size <= len(data):
+        size, crc = _RECORD_HEADER.unpack_from(data, offset)
+        start = offset + _RECORD_HEADER.size
+        payload = data[start:start + size]
+        if len(payload) != size or zlib.crc32(payload) & 0xffffffff != crc:
+            break
+        try:
+            records.append(msgpack.unpackb(payload))
+        except Exception:
+            break
+        offset = start + size
+    return records, offset
+
+class Journal:
+    # Append-only log of state changes. Records are buffered and written
+    # out by flush(); compact() atomically replaces the whole journal with
+    # a snapshot (written to a temporary file, synced and renamed).
+
+    def __init__(self, path):
+        self.__path = path
+        self.__file = None
+        self.__records = 0  # records in the file, since the last snapshot
+        self.__stats = {
+            'appended': 0,
+            'flushes': 0,
+            'compactions': 0,
+            'discarded_bytes': 0,
+        }
+
+    def load(self):
+        # returns all valid records, cuts off a torn tail
+        records = []
+        if os.path.isfile(self.__path):
+            with open(self.__path, 'rb') as f:
+                data = f.read()
+            records, validSize = _unpackRecords(data)
+            if validSize != len(data):
+                self.__stats['discarded_bytes'] += len(data) - validSize
+                with open(self.__path, 'r+b') as f:
+                    f.truncate(validSize)
+        self.__records = len(records)
+        self.__file = open(self.__path, 'ab')
+        return records
+
+    def append(self, record):
+        self.__file.write(_packRecord(record))
+        self.__records += 1
+        self.__stats['appended'] += 1
+
+    def flush(self):
+        self.__file.flush()
+        self.__stats['flushes'] += 1
+
+    def compact(self, records):
+        tmpPath = self.__path + '.tmp'
+        with open(tmpPath, 'wb') as f:
+            f.write(''.join(_packRecord(record) for record in records))
+            f.flush()
+            os.fsync(f.fileno())
+        self.__file.close()
+        os.rename(tmpPath, self.__path)
+        self.__file = open(self.__path, 'ab')
+        self.__records = len(records)
+        self.__stats['compactions'] += 1
+
+    def getRecords(self):
+        return self.__records
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+    def getStats(self):
+        stats = dict(self.__stats)
+        stats['records'] = self.__records
+        return stats
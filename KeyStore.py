@@ -0,0 +1,106 @@
+import os
+import os.path
+import hashlib
+import multiprocessing
+
+import msgpack
+
+from CryptoUtils import CryptoUtils, hmacSha256, seal, unseal
+from constants import KEYSTORE_KDF_ITERATIONS
+
+# Key files in a directory, one per (login, password):
+#   store key - pbkdf2_hmac(sha256, password, login, iterations)
+#   file name - hex of hmacSha256(store key, 'index')
+#   content   - seal(hmacSha256(store key, 'keys'), msgpack [private key, public key])
+# Neither the password nor the login can be read from the directory, a
+# wrong password just finds no file.
+
+class KeyStore:
+    def __init__(self, path, iterations = KEYSTORE_KDF_ITERATIONS):
+        self.__path = path
+        self.__iterations = iterations
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def __storeKey(self, login, password):
+        return hashlib.pbkdf2_hmac('sha256', password, 'wasp keystore:' + login, self.__iterations)
+
+    def __keyPath(self, storeKey):
+        return os.path.join(self.__path, hmacSha256(storeKey, 'index').encode('hex'))
+
+    def load(self, login, password):
+        # returns (private key, public key) or None
+        storeKey = self.__storeKey(login, password)
+        path = self.__keyPath(storeKey)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            data = unseal(hmacSha256(storeKey, 'keys'), f.read())
+        if data is None:
+            return None
+        privKey, pubKey = msgpack.unpackb(data)
+        return privKey, pubKey
+
+    def save(self, login, password, privKey, pubKey):
+        storeKey = self.__storeKey(login, password)
+        path = self.__keyPath(storeKey)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(seal(hmacSha256(storeKey, 'keys'), msgpack.packb([privKey, pubKey])))
+        os.rename(path + '.tmp', path)
+
+    def getKeys(self, login, password):
+        # keys are derived (slow) only if they are not stored yet
+        keys = self.load(login, password)
+        if keys is None:
+            keys = CryptoUtils().deriveKeys(login, password)
+            self.save(login, password, *keys)
+        return keys
+
+    def prederive(self, credentials, processes = None, wait = True):
+        # derives and stores keys of [(login, password)] in a process pool.
+        # With wait=False returns at once - the result (AsyncResult) may be
+        # ignored, getKeys of a pending identity just derives it again.
+        pool = multiprocessing.Pool(processes)
+        tasks = [(self.__path, self.__iterations, login, password) for login, password in credentials]
+        result = pool.map_async(_prederiveTask, tasks, chunksize=max(1, len(tasks) / 64))
+        pool.close()
+        if wait:
+            result.get()
+            pool.join()
+        return result
+
+    def migrateLegacy(self, path):
+        # imports plaintext '<login>_<password>_priv/_pub' files of the old
+        # key cache and removes them. When login or password contain '_',
+        # the name is split where re-derived keys match the stored ones;
+        # files that can't be attributed to one (login, password) are kept.
+        migrated = 0
+        for name in os.listdir(path):
+            if not name.endswith('_pub') or not '_' in name[:-len('_pub')]:
+                continue
+            credentials = name[:-len('_pub')]
+            prefix = os.path.join(path, credentials)
+            if not os.path.isfile(prefix + '_priv'):
+                continue
+            with open(prefix + '_priv', 'rb') as f:
+                privKey = f.read()
+            with open(prefix + '_pub', 'rb') as f:
+                pubKey = f.read()
+            splits = [(credentials[:i], credentials[i + 1:]) for i, c in enumerate(credentials) if c == '_']
+            if len(splits) > 1:
+                splits = [(login, password) for login, password in splits
+                          if CryptoUtils().deriveKeys(login, password) == (privKey, pubKey)]
+            if len(splits) != 1:
+                continue
+            login, password = splits[0]
+            self.save(login, password, privKey, pubKey)
+            if self.load(login, password) != (privKey, pubKey):
+                continue
+            os.remove(prefix + '_priv')
+            os.remove(prefix + '_pub')
+            migrated += 1
+        return migrated
+
+def _prederiveTask(args):
+    path, iterations, login, password = args
+    KeyStore(path, iterations).getKeys(login, password)
@@ -0,0 +1,82 @@
+class LRUCache:
+    # Size-bounded mapping, evicting least recently used entries first.
+    # Entries are kept in a circular doubly linked list: [prev, next, key, value]
+
+    def __init__(self, maxSize):
+        assert maxSize > 0
+        self.__maxSize = maxSize
+        self.__map = {}
+        self.__root = []
+        self.__root[:] = [self.__root, self.__root, None, None]
+        self.__hits = 0
+        self.__misses = 0
+
+    def get(self, key, default = None):
+        link = self.__map.get(key, None)
+        if link is None:
+            self.__misses += 1
+            return default
+        self.__hits += 1
+        prevLink, nextLink, _, value = link
+        prevLink[1] = nextLink
+        nextLink[0] = prevLink
+        root = self.__root
+        last = root[0]
+        last[1] = root[0] = link
+        link[0] = last
+        link[1] = root
+        return value
+
+    def put(self, key, value):
+        link = self.__map.get(key, None)
+        if link is not None:
+            link[3] = value
+            return
+        root = self.__root
+        if len(self.__map) >= self.__maxSize:
+            oldest = root[1]
+            root[1] = oldest[1]
+            oldest[1][0] = root
+            del self.__map[oldest[2]]
+        last = root[0]
+        link = [last, root, key, value]
+        last[1] = root[0] = self.__map[key] = link
+
+    def remove(self, key):
+        link = self.__map.pop(key, None)
+        if link is None:
+            return
+        prevLink, nextLink, _, _ = link
+        prevLink[1] = nextLink
+        nextLink[0] = prevLink
+
+    def clear(self):
+        self.__map.clear()
+        self.__root[:] = [self.__root, self.__root, None, None]
+
+    def has(self, key):
+        return key in self.__map
+
+    def size(self):
+        return len(self.__map)
+
+    def getHits(self):
+        return self.__hits
+
+    def getMisses(self):
+        return self.__misses
+
+    def getHitRate(self):
+        total = self.__hits + self.__misses
+        if total == 0:
+            return 0.0
+        return float(self.__hits) / total
+
+    def getStats(self):
+        return {
+            'size': len(self.__map),
+            'max_size': self.__maxSize,
+            'hits': self.__hits,
+            'misses': self.__misses,
+            'hit_rate': self.getHitRate(),
+        }
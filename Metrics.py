@@ -0,0 +1,160 @@
+import bisect
+import socket
+import errno
+
+from constants import METRICS_LATENCY_BUCKETS
+
+
+class Histogram:
+    # Counts of observed values in buckets with the given upper bounds,
+    # plus one bucket for values above the last bound
+    def __init__(self, bounds = METRICS_LATENCY_BUCKETS):
+        self.__bounds = list(bounds)
+        self.__counts = [0] * (len(self.__bounds) + 1)
+        self.__sum = 0.0
+        self.__count = 0
+
+    def observe(self, value):
+        self.__counts[bisect.bisect_left(self.__bounds, value)] += 1
+        self.__sum += value
+        self.__count += 1
+
+    def getSnapshot(self):
+        buckets = [[bound, count] for bound, count in zip(self.__bounds, self.__counts)]
+        buckets.append(['inf', self.__counts[-1]])
+        return {
+            'count': self.__count,
+            'sum': self.__sum,
+            'buckets': buckets,
+        }
+
+class Metrics:
+    # Registry of named counters and histograms. Stats of other components
+    # are attached as sources - functions, returning (nested) dicts of
+    # numbers, evaluated only when a snapshot is taken.
+    def __init__(self):
+        self.__counters = {}
+        self.__histograms = {}
+        self.__sources = [] # [(prefix, func)]
+
+    def inc(self, name, value = 1):
+        self.__counters[name] = self.__counters.get(name, 0) + value
+
+    def getHistogram(self, name, bounds = METRICS_LATENCY_BUCKETS):
+        histogram = self.__histograms.get(name, None)
+        if histogram is None:
+            histogram = self.__histograms[name] = Histogram(bounds)
+        return histogram
+
+    def observe(self, name, value):
+        self.getHistogram(name).observe(value)
+
+    def addSource(self, prefix, func):
+        self.__sources.append((prefix, func))
+
+    def getSnapshot(self):
+        # returns {name: number or histogram snapshot}, names are dotted paths
+        snapshot = dict(self.__counters)
+        for name, histogram in self.__histograms.iteritems():
+            snapshot[name] = histogram.getSnapshot()
+        for prefix, func in self.__sources:
+            _flatten(prefix, func(), snapshot)
+        return snapshot
+
+def _flatten(prefix, value, res):
+    if isinstance(value, dict) and not 'buckets' in value:
+        for key, subValue in value.iteritems():
+            _flatten(prefix + '.' + str(key), subValue, res)
+    elif value is not None:
+        res[prefix] = value
+
+def _metricName(name):
+    return 'wasp_' + ''.join(c if c.isalnum() else '_' for c in name)
+
+def formatText(snapshot):
+    # prometheus text format
+    lines = []
+    for name in sorted(snapshot):
+        value = snapshot[name]
+        metricName = _metricName(name)
+        if isinstance(value, dict):
+            total = 0
+            for bound, count in value['buckets']:
+                total += count
+                bound = '+Inf' if bound == 'inf' else repr(bound)
+                lines.append('%s_bucket{le="%s"} %d' % (metricName, bound, total))
+            lines.append('%s_sum %r' % (metricName, value['sum']))
+            lines.append('%s_count %d' % (metricName, value['count']))
+        elif isinstance(value, (int, long, float)):
+            lines.append('%s %r' % (metricName, value))
+    return '\n'.join(lines) + '\n'
+
+class MetricsHttpServer:
+    # Minimal http server on EventLoop, answering any request with
+    # formatText(getSnapshot()). Meant for local scraping only. Responses
+    # are buffered and written when the socket is writable, so a slow
+    # client doesn't stall the loop.
+    def __init__(self, loop, address, getSnapshot):
+        self.__loop = loop
+        self.__getSnapshot = getSnapshot
+        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__sock.bind(address)
+        self.__sock.listen(8)
+        self.__sock.setblocking(False)
+        self.__connections = {} # conn => unsent response
+        self.__loop.addReader(self.__sock, self.__onAccept)
+
+    def getAddress(self):
+        return self.__sock.getsockname()
+
+    def __onAccept(self):
+        try:
+            conn, _ = self.__sock.accept()
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        conn.setblocking(False)
+        self.__connections[conn] = None
+        self.__loop.addReader(conn, lambda: self.__onRequest(conn))
+
+    def __onRequest(self, conn):
+        try:
+            conn.recv(4096)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.__closeConnection(conn)
+            return
+        self.__loop.removeReader(conn)
+        body = formatText(self.__getSnapshot())
+        self.__connections[conn] = ('HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                                    'Content-Length: %d\r\n\r\n%s' % (len(body), body))
+        self.__loop.addWriter(conn, lambda: self.__onWritable(conn))
+
+    def __onWritable(self, conn):
+        response = self.__connections[conn]
+        try:
+            sent = conn.send(response)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.__closeConnection(conn)
+            return
+        if sent < len(response):
+            self.__connections[conn] = response[sent:]
+            return
+        self.__closeConnection(conn)
+
+    def __closeConnection(self, conn):
+        self.__loop.removeReader(conn)
+        self.__loop.removeWriter(conn)
+        del self.__connections[conn]
+        conn.close()
+
+    def close(self):
+        for conn in self.__connections.keys():
+            self.__closeConnection(conn)
+        self.__loop.removeReader(self.__sock)
+        self.__sock.close()
@@ -0,0 +1,306 @@
+import struct
+
+from constants import MAX_FRIENDS, ID_SIZE, MAX_ADDRESS_SIZE, MAX_RAND_SEQ_SIZE, MAX_PUB_KEY_SIZE,\
+    MAX_TICKET_SIZE, MAX_NONCE_SIZE, STORAGE_BLOCK_SIZE, MAX_FILTER_SIZE
+
+# Binary packet layout:
+#   header, packed with a single precompiled struct per packet type:
+#     uint8 type id (index in Communicator.KEYS)
+#     uint8 bitmask of present optional fields (only if packet type has optional fields)
+#     per field, in schema order:
+#       bytes   - uint16 size
+#       friends - uint8 count, uint16 id size, uint16 addresses size
+#       uint    - uint64 value (no field data)
+#   field data, in schema order:
+#       bytes   - data
+#       friends - count * id, addresses joined by zero bytes
+# Ids (and chunk ids) have a fixed size - they are compared by distance
+# with each other.
+
+class PacketError(Exception):
+    pass
+
+class _BytesField:
+    format = 'H'
+    headerItems = 1
+
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+
+    def encode(self, value, header, parts):
+        if type(value) is not str or len(value) > self.maxSize:
+            raise PacketError('wrong bytes field')
+        header.append(len(value))
+        parts.append(value)
+
+    def getSize(self, header, pos):
+        # validates field header and returns field data size
+        size = header[pos]
+        if size > self.maxSize:
+            raise PacketError('wrong bytes field')
+        return size
+
+    def decode(self, data, header, pos, start, end):
+        value = data[start:end]
+        if type(value) is not str:
+            value = value.tobytes()
+        return value
+
+class _FixedBytesField(_BytesField):
+    def encode(self, value, header, parts):
+        if type(value) is not str or len(value) != self.maxSize:
+            raise PacketError('wrong bytes field')
+        header.append(len(value))
+        parts.append(value)
+
+    def getSize(self, header, pos):
+        size = header[pos]
+        if size != self.maxSize:
+            raise PacketError('wrong bytes field')
+        return size
+
+class _FriendsField:
+    # All friend ids of a packet have the same length, so they are stored as
+    # a single blob; addresses are joined with zero bytes. Both are split
+    # with a couple of C-level calls instead of walking entries one by one.
+    # Every address is shorter than MAX_ADDRESS_SIZE, as Communicator.send
+    # expects for the addresses we'll talk to.
+
+    format = 'BHH'
+    headerItems = 3
+
+    def __init__(self, maxCount):
+        self.maxCount = maxCount
+
+    def encode(self, value, header, parts):
+        count = len(value)
+        if count > self.maxCount:
+            raise PacketError('too many friends')
+        ids = [id for id, _ in value]
+        addresses = '\0'.join([address for _, address in value])
+        idSize = ID_SIZE if ids else 0
+        if any(type(id) is not str or len(id) != ID_SIZE for id in ids) or \
+                addresses.count('\0') != max(count - 1, 0) or \
+                any(len(address) >= MAX_ADDRESS_SIZE for _, address in value):
+            raise PacketError('wrong friend')
+        header.append(count)
+        header.append(idSize)
+        header.append(len(addresses))
+        parts.extend(ids)
+        parts.append(addresses)
+
+    def getSize(self, header, pos):
+        count, idSize, addressesSize = header[pos:pos + 3]
+        if count > self.maxCount or idSize != (ID_SIZE if count else 0) or \
+                addressesSize > count * (MAX_ADDRESS_SIZE + 1) or (count == 0) != (addressesSize == 0):
+            raise PacketError('wrong friend')
+        return count * idSize + addressesSize
+
+    def decode(self, data, header, pos, start, end):
+        count, idSize, addressesSize = header[pos:pos + 3]
+        if count == 0:
+            return []
+        ids = data[start:start + count * idSize]
+        addresses = data[end - addressesSize:end]
+        if type(ids) is not str:
+            ids = ids.tobytes()
+            addresses = addresses.tobytes()
+        addresses = addresses.split('\0')
+        if len(addresses) != count or max(map(len, addresses)) >= MAX_ADDRESS_SIZE:
+            raise PacketError('wrong friend')
+        return [(ids[i * idSize:(i + 1) * idSize], addresses[i]) for i in xrange(count)]
+
+class _UIntField:
+    format = 'Q'
+    headerItems = 1
+
+    def encode(self, value, header, parts):
+        if type(value) not in (int, long) or value < 0 or value >= 1 << 64:
+            raise PacketError('wrong uint field')
+        header.append(value)
+
+    def getSize(self, header, pos):
+        return 0
+
+    def decode(self, data, header, pos, start, end):
+        return header[pos]
+
+_ID = _FixedBytesField(ID_SIZE)
+_CHUNK_ID = _FixedBytesField(32) # hmacSha256 digest
+_RAND_SEQ = _BytesField(MAX_RAND_SEQ_SIZE)
+_PUB_KEY = _BytesField(MAX_PUB_KEY_SIZE)
+_TICKET = _BytesField(MAX_TICKET_SIZE)
+_NONCE = _BytesField(MAX_NONCE_SIZE)
+_FILTER = _BytesField(MAX_FILTER_SIZE)
+_BLOCK = _BytesField(STORAGE_BLOCK_SIZE)
+_UINT = _UIntField()
+_FRIENDS = _FriendsField(MAX_FRIENDS)
+
+# packet type => [(field name, field type, optional)]
+SCHEMAS = {
+    'request_id': [
+        ('id', _ID, True), # expected id of the peer, its public key is known
+    ],
+    'response_id': [
+        ('id', _ID, False),
+        ('pub_key', _PUB_KEY, True),
+    ],
+    'confirm': [
+        ('rand_seq', _RAND_SEQ, False),
+    ],
+    'confirm_confirm': [
+        ('rand_seq', _RAND_SEQ, False),
+        ('ticket', _TICKET, True),
+    ],
+    'resume': [
+        ('ticket', _TICKET, False),
+        ('rand_seq', _RAND_SEQ, False),
+    ],
+    'resume_response': [
+        ('rand_seq', _RAND_SEQ, True),
+    ],
+    'search': [
+        ('target', _ID, True),
+        ('nonce', _NONCE, True),
+    ],
+    'search_response': [
+        ('closest_friends', _FRIENDS, False),
+        ('nonce', _NONCE, True),
+    ],
+    'exchange': [
+        ('nonce', _NONCE, True),
+        ('filter', _FILTER, True),
+        ('radius', _ID, True),
+    ],
+    'exchange_response': [
+        ('closest_friends', _FRIENDS, False),
+        ('nonce', _NONCE, True),
+    ],
+    'ping': [],
+    'pong': [],
+    'space': [
+        ('nonce', _NONCE, False),
+    ],
+    'space_response': [
+        ('free_space', _UINT, False),
+        ('nonce', _NONCE, False),
+    ],
+    'store': [
+        ('chunk_id', _CHUNK_ID, False),
+        ('offset', _UINT, False),
+        ('size', _UINT, False),
+        ('data', _BLOCK, False),
+        ('nonce', _NONCE, False),
+    ],
+    'store_response': [
+        ('status', _UINT, False),
+        ('free_space', _UINT, False),
+        ('nonce', _NONCE, False),
+    ],
+}
+
+class _Schema:
+    def __init__(self, typeName, typeId, fields):
+        self.typeName = typeName
+        self.typeId = typeId
+        self.fields = fields
+        self.hasOptional = any(optional for _, _, optional in fields)
+        self.allowedKeys = frozenset(['type'] + [name for name, _, _ in fields])
+        self.typeItems = (('type', typeName),)
+        self.header = struct.Struct('!B' + ('B' if self.hasOptional else '') + ''.join(f.format for _, f, _ in fields))
+        # (name, field, optional, mask bit, position in unpacked header)
+        self.layout = []
+        pos = 2 if self.hasOptional else 1
+        for i, (name, field, optional) in enumerate(fields):
+            self.layout.append((name, field, optional, 1 << i, pos))
+            pos += field.headerItems
+
+class Packet(dict):
+    # Received packet. Fields were validated on decode, but their values are
+    # extracted from the underlying buffer only on first access.
+
+    __slots__ = ('_data', '_header', '_fields')
+
+    def __missing__(self, key):
+        field, pos, start, end = self._fields[key]
+        value = field.decode(self._data, self._header, pos, start, end)
+        self[key] = value
+        return value
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self._fields
+
+    def get(self, key, default = None):
+        if key in self:
+            return self[key]
+        return default
+
+    def toDict(self):
+        for key in self._fields:
+            self[key]
+        return dict(self)
+
+class PacketCodec:
+    def __init__(self, keyToId):
+        self.__byName = {}
+        self.__byId = {}
+        for typeName, fields in SCHEMAS.iteritems():
+            schema = _Schema(typeName, keyToId[typeName], fields)
+            self.__byName[typeName] = schema
+            self.__byId[schema.typeId] = schema
+
+    def encode(self, packet):
+        schema = self.__byName.get(packet['type'], None)
+        if schema is None:
+            raise PacketError('unknown packet type')
+        if not schema.allowedKeys.issuperset(packet):
+            raise PacketError('unknown packet field')
+        if not schema.layout:
+            return schema.header.pack(schema.typeId)
+        header = [schema.typeId]
+        if schema.hasOptional:
+            header.append(0)
+        parts = [None]
+        for name, field, optional, bit, _ in schema.layout:
+            value = packet.get(name, None)
+            if value is None:
+                if not optional:
+                    raise PacketError('missing field ' + name)
+                header.extend((0,) * field.headerItems)
+                continue
+            if optional:
+                header[1] |= bit
+            field.encode(value, header, parts)
+        parts[0] = schema.header.pack(*header)
+        return ''.join(parts)
+
+    def decode(self, data):
+        # data - str or memoryview
+        if len(data) == 0:
+            raise PacketError('empty packet')
+        schema = self.__byId.get(ord(data[0]), None)
+        if schema is None:
+            raise PacketError('unknown packet type')
+        packet = Packet(schema.typeItems)
+        if not schema.layout:
+            if len(data) != 1:
+                raise PacketError('trailing data')
+            packet._fields = {}
+            return packet
+        if len(data) < schema.header.size:
+            raise PacketError('truncated packet')
+        header = schema.header.unpack_from(data)
+        fields = {}
+        offset = schema.header.size
+        for name, field, optional, bit, pos in schema.layout:
+            if optional and not header[1] & bit:
+                continue
+            end = offset + field.getSize(header, pos)
+            fields[name] = (field, pos, offset, end)
+            offset = end
+        if offset != len(data):
+            raise PacketError('wrong packet size')
+        packet._data = data
+        packet._header = header
+        packet._fields = fields
+        return packet
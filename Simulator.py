@@ -0,0 +1,538 @@
+import sys
+import time as walltime
+import json
+import heapq
+import random
+import zlib
+from collections import deque
+import argparse
+import multiprocessing
+
+from DHT import DHT
+from Time import Time
+from Communicator import Communicator
+from CryptoUtils import _enableCache, _enableFakeCrypto, getKeyStore
+
+import constants
+
+
+class MockTime(Time):
+    # Simulated clock. Events are kept in a heap ordered by (timestamp, sequence
+    # number), so events with equal timestamps fire in the order they were
+    # scheduled. Periodic events may be jittered by a seeded random generator.
+
+    def __init__(self, seed = 0, jitter = 0.0):
+        self.__ts = 12345678.0
+        self.__seq = 0
+        self.__random = random.Random(seed)
+        self.__jitter = jitter
+        self.__firedEvents = 0
+
+        # [(func_ts, seq, [func, interval, cancelled])]
+        self.__events = []
+
+    def getCurrentTimestamp(self):
+        return self.__ts
+
+    def getRandom(self):
+        return self.__random
+
+    def scheduleFunc(self, func, interval):
+        handle = [func, interval, False]
+        self.__push(self.__ts + self.__jittered(interval), handle)
+        return handle
+
+    def scheduleOnce(self, func, delay):
+        handle = [func, None, False]
+        self.__push(self.__ts + delay, handle)
+        return handle
+
+    def cancelFunc(self, handle):
+        handle[2] = True
+
+    def __jittered(self, interval):
+        if not self.__jitter:
+            return interval
+        return interval * (1.0 + self.__random.uniform(-self.__jitter, self.__jitter))
+
+    def __push(self, ts, handle):
+        self.__seq += 1
+        heapq.heappush(self.__events, (ts, self.__seq, handle))
+
+    def pendingEvents(self):
+        return len(self.__events)
+
+    def getFiredEvents(self):
+        return self.__firedEvents
+
+    def scroll(self, interval):
+        nextTs = self.__ts + interval
+        events = self.__events
+        while events and events[0][0] <= nextTs:
+            ts, _, handle = heapq.heappop(events)
+            func, interval, cancelled = handle
+            if cancelled:
+                continue
+            self.__ts = ts
+            if interval is not None:
+                self.__push(ts + self.__jittered(interval), handle)
+            self.__firedEvents += 1
+            func()
+        self.__ts = nextTs
+
+class MockCommunicator(Communicator):
+    # Delivers packets synchronously, or after link latency of simulated time.
+    # Packets, sent while delivering another one, are queued and delivered
+    # by the outermost send, so long message chains don't grow the stack.
+    # Every (from, to) link gets its own fixed latency in
+    # [latency, latency * (1 + latencySpread)], packets are randomly lost
+    # with probability loss.
+    #
+    # With remote set, packets to addresses not subscribed here are passed
+    # to remote(selfAddress, address, data, deliveryTs) instead (used by
+    # shards of ShardedSimulator, which deliver them with scheduleDelivery).
+
+    def __init__(self, time = None, latency = 0, latencySpread = 0.0, loss = 0.0, remote = None):
+        Communicator.__init__(self)
+        self.__addressToCallback = {}
+        self.__traffic = 0
+        self.__time = time
+        self.__latency = latency
+        self.__latencySpread = latencySpread
+        self.__loss = loss
+        self.__delivered = 0
+        self.__lost = 0
+        self.__delivering = False
+        self.__deliveryQueue = deque()
+        self.__remote = remote
+
+    def subscribe(self, selfAddress, onDataReceivedCallback):
+        self.__addressToCallback[selfAddress] = onDataReceivedCallback
+
+    def unsubscribe(self, selfAddress):
+        del self.__addressToCallback[selfAddress]
+
+    def _doSend(self, selfAddress, address, data, control = False):
+        self.__traffic += len(data)
+        if self.__loss and self.__time.getRandom().random() < self.__loss:
+            self.__lost += 1
+            return
+        latency = self.__getLinkLatency(selfAddress, address)
+        if self.__remote is not None and address not in self.__addressToCallback:
+            self.__remote(selfAddress, address, data, self.__time.getCurrentTimestamp() + latency)
+            return
+        if latency:
+            self.__time.scheduleOnce(lambda: self.__deliver(selfAddress, address, data), latency)
+            return
+        self.__deliveryQueue.append((selfAddress, address, data))
+        if self.__delivering:
+            return
+        self.__delivering = True
+        try:
+            while self.__deliveryQueue:
+                self.__deliver(*self.__deliveryQueue.popleft())
+        finally:
+            self.__delivering = False
+
+    def __getLinkLatency(self, selfAddress, address):
+        if not self.__latencySpread:
+            return self.__latency
+        linkHash = zlib.crc32(selfAddress + '>' + address) & 0xffffffff
+        return self.__latency * (1.0 + self.__latencySpread * linkHash / float(0xffffffff))
+
+    def scheduleDelivery(self, selfAddress, address, data, deliveryTs):
+        delay = max(deliveryTs - self.__time.getCurrentTimestamp(), 0.0)
+        self.__time.scheduleOnce(lambda: self.__deliver(selfAddress, address, data), delay)
+
+    def __deliver(self, selfAddress, address, data):
+        callback = self.__addressToCallback.get(address, None)
+        if callback is not None:
+            self.__delivered += 1
+            self._onReceived(selfAddress, data, callback)
+
+    def getTraffic(self):
+        return self.__traffic
+
+    def getTrafficByType(self):
+        return dict((packetType, {'packets': s['packets_out'], 'bytes': s['bytes_out']})
+                    for packetType, s in self.getStatsByType().iteritems() if s['packets_out'])
+
+    def getDelivered(self):
+        return self.__delivered
+
+    def getLost(self):
+        return self.__lost
+
+class Simulator:
+    # Discrete event simulation of a DHT network over MockCommunicator
+
+    def __init__(self, seed = 0, latency = 0.0, latencySpread = 0.0, loss = 0.0, log = False):
+        self.__time = MockTime(seed)
+        self.__random = self.__time.getRandom()
+        self.__communicator = MockCommunicator(self.__time, latency, latencySpread, loss)
+        self.__nodes = []
+        self.__nextNodeNum = 0
+        self.__startWallTime = walltime.time()
+        self.__startTs = self.__time.getCurrentTimestamp()
+        self.__log = log
+        self.__samples = []
+        self.__convergenceTime = None
+
+    def getTime(self):
+        return self.__time
+
+    def getCommunicator(self):
+        return self.__communicator
+
+    def getNodes(self):
+        return self.__nodes
+
+    def addNode(self):
+        num = self.__nextNodeNum
+        self.__nextNodeNum += 1
+        if self.__nodes:
+            initialAddress = self.__random.choice(self.__nodes).getAddress()
+        else:
+            initialAddress = ''
+        node = DHT('login' + str(num), 'password' + str(num), '', self.__communicator,
+                   'addr' + str(num), initialAddress, self.__time)
+        self.__nodes.append(node)
+        return node
+
+    def removeNode(self, num):
+        node = self.__nodes.pop(num)
+        node.stop()
+
+    def removeRandomNodes(self, count):
+        for _ in xrange(count):
+            self.removeNode(self.__random.randint(0, len(self.__nodes) - 1))
+
+    def addNodes(self, count, joinRate):
+        for _ in xrange(count):
+            if self.__nodes:
+                self.__time.scroll(1.0 / joinRate)
+            self.addNode()
+            if self.__log and len(self.__nodes) % 100 == 0:
+                print '[STATUS] added', len(self.__nodes), 'nodes'
+
+    def run(self, duration, sampleInterval = 10, churnRate = 0.0, targetFriends = None):
+        # churnRate - nodes per second, leaving the network and replaced by new ones
+        churn = [0.0]
+        def churnStep():
+            churn[0] += churnRate
+            count = int(churn[0])
+            churn[0] -= count
+            self.removeRandomNodes(min(count, len(self.__nodes) - 1))
+            for _ in xrange(count):
+                self.addNode()
+        churnTimer = self.__time.scheduleFunc(churnStep, 1.0) if churnRate else None
+
+        if targetFriends is None:
+            targetFriends = constants.MAX_FRIENDS
+        elapsed = 0
+        while elapsed < duration:
+            step = min(sampleInterval, duration - elapsed)
+            self.__time.scroll(step)
+            elapsed += step
+            sample = self.sample()
+            if self.__convergenceTime is None and \
+                    sample['avg_friends'] >= min(targetFriends, len(self.__nodes) - 1):
+                self.__convergenceTime = sample['time']
+            if self.__log:
+                print '[STATUS] modeled', int(sample['time']), 'seconds, avg friends:', sample['avg_friends'], \
+                    'traffic:', sample['traffic']
+
+        if churnTimer is not None:
+            self.__time.cancelFunc(churnTimer)
+
+    def getFriendsStats(self):
+        sizes = [node.getFriendsSize() for node in self.__nodes]
+        if not sizes:
+            return {'avg_friends': 0.0, 'min_friends': 0, 'max_friends': 0}
+        return {
+            'avg_friends': float(sum(sizes)) / len(sizes),
+            'min_friends': min(sizes),
+            'max_friends': max(sizes),
+        }
+
+    def sample(self):
+        sample = self.getFriendsStats()
+        sample['time'] = self.__time.getCurrentTimestamp() - self.__startTs
+        sample['nodes'] = len(self.__nodes)
+        sample['traffic'] = self.__communicator.getTraffic()
+        self.__samples.append(sample)
+        return sample
+
+    def getReport(self):
+        wallTime = walltime.time() - self.__startWallTime
+        events = self.__time.getFiredEvents() + self.__communicator.getDelivered()
+        report = self.getFriendsStats()
+        report.update({
+            'nodes': len(self.__nodes),
+            'simulated_time': self.__time.getCurrentTimestamp() - self.__startTs,
+            'convergence_time': self.__convergenceTime,
+            'traffic': self.__communicator.getTraffic(),
+            'traffic_by_type': self.__communicator.getTrafficByType(),
+            'packets_lost': self.__communicator.getLost(),
+            'events': events,
+            'wall_time': wallTime,
+            'events_per_sec': events / wallTime if wallTime > 0 else 0.0,
+            'samples': self.__samples,
+        })
+        return report
+
+def _addressShard(address, shards):
+    return int(address[len('addr'):]) % shards
+
+def _shardWorker(conn, shard, shards, seed, latency, latencySpread, loss, realCrypto):
+    # Nodes of a ShardedSimulator shard. Commands:
+    #   ('step', endTs, inbound packets, joins, sample) => (outbox batches per shard, sample or None)
+    #   ('stats',) => counters for the report
+    #   ('stop',)
+    _enableCache()
+    if not realCrypto:
+        _enableFakeCrypto()
+    time = MockTime(seed * 1000003 + shard)
+    outbox = [[] for _ in xrange(shards)]
+    def remote(selfAddress, address, data, deliveryTs):
+        outbox[_addressShard(address, shards)].append((deliveryTs, selfAddress, address, data))
+    communicator = MockCommunicator(time, latency, latencySpread, loss, remote)
+    nodes = []
+    def addNode(num, initialAddress):
+        nodes.append(DHT('login' + str(num), 'password' + str(num), '', communicator,
+                         'addr' + str(num), initialAddress, time))
+
+    while True:
+        command = conn.recv()
+        if command[0] == 'step':
+            _, endTs, inbound, joins, sample = command
+            now = time.getCurrentTimestamp()
+            for deliveryTs, selfAddress, address, data in inbound:
+                communicator.scheduleDelivery(selfAddress, address, data, deliveryTs)
+            for num, ts, initialAddress in joins:
+                time.scheduleOnce(lambda num=num, initialAddress=initialAddress: addNode(num, initialAddress),
+                                  max(ts - now, 0.0))
+            time.scroll(endTs - now)
+            batches = outbox[:]
+            outbox[:] = [[] for _ in xrange(shards)]
+            stats = None
+            if sample:
+                sizes = [node.getFriendsSize() for node in nodes]
+                stats = {
+                    'nodes': len(sizes),
+                    'friends': sum(sizes),
+                    'min_friends': min(sizes) if sizes else None,
+                    'max_friends': max(sizes) if sizes else None,
+                    'traffic': communicator.getTraffic(),
+                }
+            conn.send((batches, stats))
+        elif command[0] == 'stats':
+            conn.send({
+                'traffic': communicator.getTraffic(),
+                'traffic_by_type': communicator.getTrafficByType(),
+                'packets_lost': communicator.getLost(),
+                'events': time.getFiredEvents() + communicator.getDelivered(),
+            })
+        elif command[0] == 'stop':
+            conn.close()
+            return
+
+class ShardedSimulator:
+    # Simulation, split into shards by node number, every shard runs in its
+    # own process with its own MockTime and MockCommunicator. Shards advance
+    # in windows of the min link latency: a packet, sent to another shard
+    # during a window, is not delivered before the window ends, so shards
+    # exchange such packets in one batch per window and never have to roll
+    # back. Results depend only on the seed and the number of shards.
+    # Interface and report follow Simulator (no churn).
+
+    def __init__(self, shards, seed = 0, latency = 0.05, latencySpread = 0.0, loss = 0.0, log = False,
+                 realCrypto = False):
+        assert shards > 0 and latency > 0
+        self.__window = latency
+        self.__random = random.Random(seed)
+        self.__startTs = MockTime().getCurrentTimestamp()
+        self.__ts = self.__startTs
+        self.__workers = [] # [(process, connection)]
+        for shard in xrange(shards):
+            parentConn, childConn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_shardWorker, args=(childConn, shard, shards, seed, latency,
+                                                                         latencySpread, loss, realCrypto))
+            process.daemon = True
+            process.start()
+            childConn.close()
+            self.__workers.append((process, parentConn))
+        self.__inbound = [[] for _ in xrange(shards)]
+        self.__joins = deque() # [(ts, node num, initial address)]
+        self.__addresses = []
+        self.__joinTs = None
+        self.__windows = 0
+        self.__crossShard = 0
+        self.__log = log
+        self.__startWallTime = walltime.time()
+        self.__samples = []
+        self.__friendsStats = {'avg_friends': 0.0, 'min_friends': 0, 'max_friends': 0}
+        self.__convergenceTime = None
+
+    def __step(self, sample = False):
+        shards = len(self.__workers)
+        endTs = self.__ts + self.__window
+        joins = [[] for _ in xrange(shards)]
+        while self.__joins and self.__joins[0][0] < endTs:
+            ts, num, initialAddress = self.__joins.popleft()
+            joins[num % shards].append((num, ts, initialAddress))
+        for shard, (_, conn) in enumerate(self.__workers):
+            inbound = self.__inbound[shard]
+            inbound.sort(key=lambda packet: packet[0])
+            conn.send(('step', endTs, inbound, joins[shard], sample))
+        self.__inbound = [[] for _ in xrange(shards)]
+        stats = []
+        for _, conn in self.__workers:
+            batches, shardStats = conn.recv()
+            for shard, batch in enumerate(batches):
+                self.__inbound[shard].extend(batch)
+                self.__crossShard += len(batch)
+            stats.append(shardStats)
+        self.__ts = endTs
+        self.__windows += 1
+        return stats
+
+    def addNodes(self, count, joinRate):
+        for _ in xrange(count):
+            if self.__joinTs is None:
+                self.__joinTs = self.__ts
+            else:
+                self.__joinTs += 1.0 / joinRate
+            num = len(self.__addresses)
+            initialAddress = self.__random.choice(self.__addresses) if self.__addresses else ''
+            self.__joins.append((self.__joinTs, num, initialAddress))
+            self.__addresses.append('addr' + str(num))
+        while self.__joins:
+            self.__step()
+        if self.__log:
+            print '[STATUS] added', len(self.__addresses), 'nodes'
+
+    def run(self, duration, sampleInterval = 10, targetFriends = None):
+        if targetFriends is None:
+            targetFriends = constants.MAX_FRIENDS
+        endTs = self.__ts + duration
+        nextSampleTs = self.__ts + sampleInterval
+        while self.__ts < endTs - 1e-9:
+            windowEnd = self.__ts + self.__window
+            sample = windowEnd >= nextSampleTs - 1e-9 or windowEnd >= endTs - 1e-9
+            stats = self.__step(sample)
+            if not sample:
+                continue
+            nextSampleTs += sampleInterval
+            sample = self.__sample(stats)
+            if self.__convergenceTime is None and \
+                    sample['avg_friends'] >= min(targetFriends, sample['nodes'] - 1):
+                self.__convergenceTime = sample['time']
+            if self.__log:
+                print '[STATUS] modeled', int(sample['time']), 'seconds, avg friends:', sample['avg_friends'], \
+                    'traffic:', sample['traffic']
+
+    def __sample(self, stats):
+        nodes = sum(s['nodes'] for s in stats)
+        sizes = [s for s in stats if s['nodes']]
+        self.__friendsStats = {
+            'avg_friends': float(sum(s['friends'] for s in stats)) / nodes if nodes else 0.0,
+            'min_friends': min(s['min_friends'] for s in sizes) if sizes else 0,
+            'max_friends': max(s['max_friends'] for s in sizes) if sizes else 0,
+        }
+        sample = dict(self.__friendsStats)
+        sample['time'] = self.__ts - self.__startTs
+        sample['nodes'] = nodes
+        sample['traffic'] = sum(s['traffic'] for s in stats)
+        self.__samples.append(sample)
+        return sample
+
+    def getFriendsStats(self):
+        # as of the last sample
+        return dict(self.__friendsStats)
+
+    def getReport(self):
+        for _, conn in self.__workers:
+            conn.send(('stats',))
+        shardStats = [conn.recv() for _, conn in self.__workers]
+        trafficByType = {}
+        for stats in shardStats:
+            for packetType, traffic in stats['traffic_by_type'].iteritems():
+                total = trafficByType.setdefault(packetType, {'packets': 0, 'bytes': 0})
+                total['packets'] += traffic['packets']
+                total['bytes'] += traffic['bytes']
+        wallTime = walltime.time() - self.__startWallTime
+        events = sum(stats['events'] for stats in shardStats)
+        report = self.getFriendsStats()
+        report.update({
+            'nodes': len(self.__addresses),
+            'shards': len(self.__workers),
+            'windows': self.__windows,
+            'cross_shard_packets': self.__crossShard,
+            'simulated_time': self.__ts - self.__startTs,
+            'convergence_time': self.__convergenceTime,
+            'traffic': sum(stats['traffic'] for stats in shardStats),
+            'traffic_by_type': trafficByType,
+            'packets_lost': sum(stats['packets_lost'] for stats in shardStats),
+            'events': events,
+            'wall_time': wallTime,
+            'events_per_sec': events / wallTime if wallTime > 0 else 0.0,
+            'samples': self.__samples,
+        })
+        return report
+
+    def stop(self):
+        for process, conn in self.__workers:
+            conn.send(('stop',))
+            process.join()
+        self.__workers = []
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='wasp DHT network simulator')
+    parser.add_argument('--nodes', type=int, default=1000, help='number of nodes')
+    parser.add_argument('--join-rate', type=float, default=100.0, help='nodes joining per simulated second')
+    parser.add_argument('--duration', type=float, default=300.0, help='simulated seconds after all nodes joined')
+    parser.add_argument('--churn', type=float, default=0.0, help='nodes per second, replaced by new ones')
+    parser.add_argument('--latency', type=float, default=0.0, help='min link latency, seconds')
+    parser.add_argument('--latency-spread', type=float, default=0.0, help='max extra link latency, part of latency')
+    parser.add_argument('--loss', type=float, default=0.0, help='packet loss probability')
+    parser.add_argument('--sample-interval', type=float, default=10.0, help='simulated seconds between samples')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--shards', type=int, default=0,
+                        help='run nodes in this many processes (needs --latency, no --churn)')
+    parser.add_argument('--real-crypto', action='store_true', help='use real rsa encryption')
+    parser.add_argument('--output', default='', help='json report file (stdout if empty)')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    _enableCache()
+    if not args.real_crypto:
+        _enableFakeCrypto()
+    # keys of new identities are derived on all cores, before the simulation
+    getKeyStore().prederive([('login' + str(i), 'password' + str(i)) for i in xrange(args.nodes)])
+
+    if args.shards:
+        if args.latency <= 0 or args.churn:
+            parser.error('--shards needs --latency > 0 and no --churn')
+        sim = ShardedSimulator(args.shards, args.seed, args.latency, args.latency_spread, args.loss,
+                               log=args.verbose, realCrypto=args.real_crypto)
+        sim.addNodes(args.nodes, args.join_rate)
+        sim.run(args.duration, args.sample_interval)
+        report = sim.getReport()
+        sim.stop()
+    else:
+        sim = Simulator(args.seed, args.latency, args.latency_spread, args.loss, log=args.verbose)
+        sim.addNodes(args.nodes, args.join_rate)
+        sim.run(args.duration, args.sample_interval, args.churn)
+        report = sim.getReport()
+
+    report['config'] = vars(args)
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data)
+    else:
+        print data
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
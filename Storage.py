@@ -0,0 +1,364 @@
+from collections import deque, OrderedDict
+
+from LRUCache import LRUCache
+from constants import STORAGE_REPLICAS, STORAGE_BLOCK_SIZE, STORAGE_WINDOW, STORAGE_MAX_PLACEMENTS,\
+    STORAGE_BLOCK_TIMEOUT, STORAGE_BLOCK_RETRIES, STORAGE_MAX_CHUNK_SIZE, STORAGE_MAX_INCOMING,\
+    STORAGE_INCOMING_TIMEOUT, STORAGE_CHECK_INTERVAL, STORAGE_PROBE_TIMEOUT, STORAGE_PROBE_FAILURES,\
+    STORAGE_PEERS_CACHE_SIZE
+
+# Chunk placement on top of DHT: every chunk of the own store is uploaded
+# to STORAGE_REPLICAS nodes closest to the chunk id, which have free space.
+#
+#   space          -> space_response(free_space)        - capacity probe
+#   store(chunk_id, offset, size, data) -> store_response(status, free_space)
+#
+# A chunk is sent in STORAGE_BLOCK_SIZE blocks, every block is acknowledged.
+# Blocks of all uploads to a node share its window of STORAGE_WINDOW
+# unacknowledged blocks, uploads to different nodes go in parallel.
+
+class _StoreStatus:
+    OK = 0
+    NO_SPACE = 1
+    REJECTED = 2
+
+def _blockCount(size):
+    return (size + STORAGE_BLOCK_SIZE - 1) / STORAGE_BLOCK_SIZE
+
+class _IncomingChunk:
+    def __init__(self, size, deadline):
+        self.size = size
+        self.blocks = {} # offset => data
+        self.deadline = deadline
+
+class _Peer:
+    def __init__(self, address):
+        self.address = address
+        self.inFlight = 0
+        self.queue = deque() # (upload, offset, attempt)
+        self.pumping = False
+
+class _Upload:
+    # replica of a chunk, sent to one node
+    def __init__(self, placement, id, address, blocks):
+        self.placement = placement
+        self.id = id
+        self.address = address
+        self.remaining = blocks # not acknowledged blocks
+        self.failed = False
+
+class _Placement:
+    def __init__(self, chunkId, data):
+        self.chunkId = chunkId
+        self.data = data
+        self.candidates = deque() # (id, address), closest to chunk id first
+        self.uploads = {} # address => _Upload
+        self.repeat = False # holder was lost during placement
+        self.finished = False
+
+class Storage:
+    def __init__(self, dht, time, ownStore, hostedStore, capacity):
+        # ownStore - chunks of this node to place, hostedStore - chunks of
+        # other nodes, up to capacity bytes
+        self.__dht = dht
+        self.__time = time
+        self.__ownStore = ownStore
+        self.__hostedStore = hostedStore
+        self.__capacity = capacity
+        self.__used = hostedStore.getUsedSpace()
+        self.__reserved = 0 # by partially received chunks
+        self.__incoming = OrderedDict() # (owner id, chunk id) => _IncomingChunk
+
+        self.__holders = {} # chunk id => {holder address: holder id}
+        self.__holderChunks = {} # holder address => set(chunk id)
+        self.__probeFailures = {} # holder address => failed probes in a row
+        self.__freeSpace = LRUCache(STORAGE_PEERS_CACHE_SIZE) # address => free space, advertised by node
+        self.__peers = {} # address => _Peer, with blocks in flight or queued
+        self.__placements = {} # chunk id => _Placement
+        self.__queue = deque() # chunk ids, waiting for placement
+        self.__queued = set()
+        self.__starting = False
+
+        self.__stats = {
+            'placed': 0,
+            'under_replicated': 0,
+            'replicas': 0,
+            'uploads_failed': 0,
+            'blocks_sent': 0,
+            'blocks_resent': 0,
+            'rejected': 0,
+            'rebalanced': 0,
+            'hosted_chunks': 0,
+            'incoming_evicted': 0,
+            'incoming_expired': 0,
+        }
+
+        dht.registerHandler('space', self.__onSpace)
+        dht.registerHandler('space_response', self.__onSpaceResponse)
+        dht.registerHandler('store', self.__onStore)
+        dht.registerHandler('store_response', self.__onStoreResponse)
+        dht.addFriendRemovedHandler(self.__onFriendRemoved)
+        dht.addMetricsSource('storage', self.getStats)
+        self.__timer = time.scheduleFunc(self.__check, STORAGE_CHECK_INTERVAL)
+
+    def stop(self):
+        self.__time.cancelFunc(self.__timer)
+
+    def getFreeSpace(self):
+        return max(self.__capacity - self.__used - self.__reserved, 0)
+
+    def getHolders(self, chunkId):
+        # returns [(id, address)] of nodes, storing the chunk
+        return sorted((id, address) for address, id in self.__holders.get(chunkId, {}).iteritems())
+
+    def getStats(self):
+        stats = dict(self.__stats)
+        stats['capacity'] = self.__capacity
+        stats['used'] = self.__used
+        stats['reserved'] = self.__reserved
+        stats['placing'] = len(self.__placements)
+        stats['queued'] = len(self.__queue)
+        return stats
+
+    # hosting chunks of other nodes
+
+    def __onSpace(self, address, id, packet):
+        response = {
+            'type': 'space_response',
+            'free_space': self.getFreeSpace(),
+            'nonce': packet['nonce'],
+        }
+        self.__dht.send(address, response)
+
+    def __respondStore(self, address, packet, status):
+        response = {
+            'type': 'store_response',
+            'status': status,
+            'free_space': self.getFreeSpace(),
+            'nonce': packet['nonce'],
+        }
+        self.__dht.send(address, response)
+
+    def __dropIncoming(self, key):
+        incoming = self.__incoming.pop(key)
+        self.__reserved -= incoming.size
+
+    def __onStore(self, address, id, packet):
+        chunkId = packet['chunk_id']
+        size = packet['size']
+        key = (id, chunkId)
+        incoming = self.__incoming.get(key, None)
+        if incoming is None:
+            if self.__hostedStore.has(chunkId):
+                self.__respondStore(address, packet, _StoreStatus.OK)
+                return
+            if size == 0 or size > STORAGE_MAX_CHUNK_SIZE:
+                self.__respondStore(address, packet, _StoreStatus.REJECTED)
+                return
+            if size > self.getFreeSpace():
+                self.__respondStore(address, packet, _StoreStatus.NO_SPACE)
+                return
+            if len(self.__incoming) >= STORAGE_MAX_INCOMING:
+                self.__dropIncoming(next(iter(self.__incoming)))
+                self.__stats['incoming_evicted'] += 1
+            incoming = self.__incoming[key] = _IncomingChunk(size, 0)
+            self.__reserved += size
+
+        offset = packet['offset']
+        data = packet['data']
+        if size != incoming.size or offset % STORAGE_BLOCK_SIZE or offset >= size or \
+                len(data) != min(STORAGE_BLOCK_SIZE, size - offset):
+            self.__respondStore(address, packet, _StoreStatus.REJECTED)
+            return
+        incoming.blocks[offset] = data
+        incoming.deadline = self.__time.getCurrentTimestamp() + STORAGE_INCOMING_TIMEOUT
+        if len(incoming.blocks) == _blockCount(size):
+            self.__dropIncoming(key)
+            self.__hostedStore.put(chunkId, ''.join(incoming.blocks[o] for o in sorted(incoming.blocks)))
+            self.__used += size
+            self.__stats['hosted_chunks'] += 1
+        self.__respondStore(address, packet, _StoreStatus.OK)
+
+    # placing own chunks
+
+    def place(self, chunkId):
+        # chunk of ownStore is uploaded to STORAGE_REPLICAS nodes, in background
+        placement = self.__placements.get(chunkId, None)
+        if placement is not None:
+            placement.repeat = True
+            return
+        if chunkId in self.__queued:
+            return
+        self.__queue.append(chunkId)
+        self.__queued.add(chunkId)
+        self.__startPlacements()
+
+    def __startPlacements(self):
+        # lookups may complete synchronously and finish placements, which
+        # start next ones - only the outermost call runs the loop
+        if self.__starting:
+            return
+        self.__starting = True
+        try:
+            while self.__queue and len(self.__placements) < STORAGE_MAX_PLACEMENTS:
+                chunkId = self.__queue.popleft()
+                self.__queued.discard(chunkId)
+                data = self.__ownStore.get(chunkId)
+                if data is None:
+                    continue
+                placement = self.__placements[chunkId] = _Placement(chunkId, data)
+                self.__dht.lookup(chunkId, lambda nodes, p=placement: self.__onLookupDone(p, nodes),
+                                  STORAGE_REPLICAS * 2)
+        finally:
+            self.__starting = False
+
+    def __onLookupDone(self, placement, nodes):
+        holders = self.__holders.get(placement.chunkId, {})
+        placement.candidates.extend((id, address) for id, address in nodes if address not in holders)
+        self.__fillReplicas(placement)
+
+    def __fillReplicas(self, placement):
+        # uploads may complete while being started, and finish the placement
+        if placement.finished:
+            return
+        holders = self.__holders.get(placement.chunkId, {})
+        size = len(placement.data)
+        while len(holders) + len(placement.uploads) < STORAGE_REPLICAS and placement.candidates:
+            id, address = placement.candidates.popleft()
+            if address in holders or address in placement.uploads:
+                continue
+            freeSpace = self.__freeSpace.get(address)
+            if freeSpace is not None and freeSpace < size:
+                continue
+            self.__startUpload(placement, id, address)
+        if not placement.uploads and not placement.finished:
+            self.__finish(placement)
+
+    def __finish(self, placement):
+        placement.finished = True
+        placement.data = None
+        del self.__placements[placement.chunkId]
+        if len(self.__holders.get(placement.chunkId, {})) < STORAGE_REPLICAS:
+            self.__stats['under_replicated'] += 1
+        else:
+            self.__stats['placed'] += 1
+        if placement.repeat:
+            self.place(placement.chunkId)
+        self.__startPlacements()
+
+    def __startUpload(self, placement, id, address):
+        upload = placement.uploads[address] = _Upload(placement, id, address, _blockCount(len(placement.data)))
+        peer = self.__peers.get(address, None)
+        if peer is None:
+            peer = self.__peers[address] = _Peer(address)
+        for offset in xrange(0, len(placement.data), STORAGE_BLOCK_SIZE):
+            peer.queue.append((upload, offset, 0))
+        self.__pump(peer)
+
+    def __pump(self, peer):
+        # responses may be delivered while sending, the outermost call sends
+        if peer.pumping:
+            return
+        peer.pumping = True
+        while peer.inFlight < STORAGE_WINDOW and peer.queue:
+            upload, offset, attempt = peer.queue.popleft()
+            if upload.failed:
+                continue
+            data = upload.placement.data
+            packet = {
+                'type': 'store',
+                'chunk_id': upload.placement.chunkId,
+                'offset': offset,
+                'size': len(data),
+                'data': data[offset:offset + STORAGE_BLOCK_SIZE],
+            }
+            peer.inFlight += 1
+            self.__stats['blocks_sent'] += 1
+            self.__dht.sendRequest(peer.address, packet, 'store_response', (upload, offset, attempt),
+                                   STORAGE_BLOCK_TIMEOUT, self.__onBlockTimeout)
+        peer.pumping = False
+        if peer.inFlight == 0 and not peer.queue:
+            del self.__peers[peer.address]
+
+    def __onStoreResponse(self, address, id, packet):
+        request = self.__dht.popResponse(address, packet)
+        if request is None:
+            return
+        upload, offset, attempt = request
+        self.__freeSpace.put(address, packet['free_space'])
+        peer = self.__peers[address]
+        peer.inFlight -= 1
+        if not upload.failed:
+            if packet['status'] == _StoreStatus.OK:
+                upload.remaining -= 1
+                if upload.remaining == 0:
+                    self.__onUploaded(upload)
+            else:
+                self.__stats['rejected'] += 1
+                self.__failUpload(upload)
+        self.__pump(peer)
+
+    def __onBlockTimeout(self, request):
+        upload, offset, attempt = request
+        peer = self.__peers[upload.address]
+        peer.inFlight -= 1
+        if not upload.failed:
+            if attempt < STORAGE_BLOCK_RETRIES:
+                self.__stats['blocks_resent'] += 1
+                peer.queue.appendleft((upload, offset, attempt + 1))
+            else:
+                self.__failUpload(upload)
+        self.__pump(peer)
+
+    def __onUploaded(self, upload):
+        placement = upload.placement
+        del placement.uploads[upload.address]
+        self.__holders.setdefault(placement.chunkId, {})[upload.address] = upload.id
+        self.__holderChunks.setdefault(upload.address, set()).add(placement.chunkId)
+        self.__stats['replicas'] += 1
+        self.__fillReplicas(placement)
+
+    def __failUpload(self, upload):
+        upload.failed = True
+        placement = upload.placement
+        del placement.uploads[upload.address]
+        self.__stats['uploads_failed'] += 1
+        self.__fillReplicas(placement)
+
+    # holders liveness
+
+    def __dropHolder(self, address):
+        # chunks of the lost holder are placed again, to other nodes
+        self.__probeFailures.pop(address, None)
+        for chunkId in self.__holderChunks.pop(address, ()):
+            del self.__holders[chunkId][address]
+            self.__stats['rebalanced'] += 1
+            self.place(chunkId)
+
+    def __onFriendRemoved(self, id, address):
+        if address in self.__holderChunks:
+            self.__dropHolder(address)
+
+    def __check(self):
+        now = self.__time.getCurrentTimestamp()
+        for key, incoming in self.__incoming.items():
+            if incoming.deadline < now:
+                self.__dropIncoming(key)
+                self.__stats['incoming_expired'] += 1
+        for address in self.__holderChunks.keys():
+            self.__dht.sendRequest(address, {'type': 'space'}, 'space_response', address,
+                                   STORAGE_PROBE_TIMEOUT, self.__onProbeTimeout)
+
+    def __onSpaceResponse(self, address, id, packet):
+        if self.__dht.popResponse(address, packet) is None:
+            return
+        self.__freeSpace.put(address, packet['free_space'])
+        self.__probeFailures.pop(address, None)
+
+    def __onProbeTimeout(self, address):
+        if address not in self.__holderChunks:
+            return
+        failures = self.__probeFailures.get(address, 0) + 1
+        if failures >= STORAGE_PROBE_FAILURES:
+            self.__dropHolder(address)
+        else:
+            self.__probeFailures[address] = failures
@@ -1,4 +1,8 @@
- 
+import time
+import random
+
+from constants import TIMER_WHEEL_TICK, TIMER_WHEEL_BITS, TIMER_WHEEL_LEVELS, TIMER_JITTER
+
 
 class Time:
     def getCurrentTimestamp(self):
@@ -6,3 +10,155 @@ class Time:
 
     def scheduleFunc(self, func, interval):
         pass
+
+    def scheduleOnce(self, func, delay):
+        pass
+
+    def cancelFunc(self, handle):
+        pass
+
+class _Timer:
+    def __init__(self, func, period, expireTick):
+        self.func = func
+        self.period = period        # returns delay till the next call, None for one-shot timers
+        self.expireTick = expireTick
+        self.cancelled = False
+
+class TimerWheel:
+    # Hierarchical timer wheel: TIMER_WHEEL_LEVELS wheels of 2^TIMER_WHEEL_BITS
+    # slots each, level N slot covers 2^(N * TIMER_WHEEL_BITS) ticks. Arming
+    # a timer and firing it are O(1), timers from upper levels are cascaded
+    # down when the lower wheel wraps around. Cancelled timers are dropped
+    # lazily when their slot is reached.
+
+    def __init__(self, startTs, tick = TIMER_WHEEL_TICK):
+        self.__tick = float(tick)
+        self.__startTs = startTs
+        self.__currentTick = 0
+        self.__slots = 1 << TIMER_WHEEL_BITS
+        self.__mask = self.__slots - 1
+        self.__wheels = [[[] for _ in xrange(self.__slots)] for _ in xrange(TIMER_WHEEL_LEVELS)]
+        self.__maxDelta = (1 << (TIMER_WHEEL_BITS * TIMER_WHEEL_LEVELS)) - 1
+        self.__count = 0
+
+    def add(self, func, delay, period = None):
+        expireTick = self.__currentTick + self.__delayToTicks(delay)
+        timer = _Timer(func, period, expireTick)
+        self.__place(timer, self.__currentTick + 1)
+        self.__count += 1
+        return timer
+
+    def cancel(self, timer):
+        if not timer.cancelled:
+            timer.cancelled = True
+            self.__count -= 1
+
+    def size(self):
+        return self.__count
+
+    def __delayToTicks(self, delay):
+        return max(1, int(round(delay / self.__tick)))
+
+    def __place(self, timer, minTick):
+        expireTick = max(timer.expireTick, minTick)
+        delta = min(expireTick - self.__currentTick, self.__maxDelta)
+        level = 0
+        while delta >> (TIMER_WHEEL_BITS * (level + 1)):
+            level += 1
+        # timers beyond the top wheel wait in its farthest slot and are placed again on cascade
+        slotTick = min(expireTick, self.__currentTick + self.__maxDelta)
+        slot = (slotTick >> (TIMER_WHEEL_BITS * level)) & self.__mask
+        self.__wheels[level][slot].append(timer)
+
+    def __cascade(self, level):
+        slot = (self.__currentTick >> (TIMER_WHEEL_BITS * level)) & self.__mask
+        timers = self.__wheels[level][slot]
+        self.__wheels[level][slot] = []
+        for timer in timers:
+            if not timer.cancelled:
+                self.__place(timer, self.__currentTick)
+
+    def __doTick(self):
+        self.__currentTick += 1
+        level = 1
+        while level < TIMER_WHEEL_LEVELS and \
+                (self.__currentTick >> (TIMER_WHEEL_BITS * (level - 1))) & self.__mask == 0:
+            self.__cascade(level)
+            level += 1
+        slot = self.__currentTick & self.__mask
+        timers = self.__wheels[0][slot]
+        self.__wheels[0][slot] = []
+        for timer in timers:
+            if timer.cancelled:
+                continue
+            if timer.expireTick > self.__currentTick:
+                self.__place(timer, self.__currentTick + 1)
+                continue
+            if timer.period is None:
+                timer.cancelled = True
+                self.__count -= 1
+            else:
+                timer.expireTick = self.__currentTick + self.__delayToTicks(timer.period())
+                self.__place(timer, self.__currentTick + 1)
+            timer.func()
+
+    def __nextEventTick(self):
+        # Nearest tick, having timers to fire or to cascade
+        wheel = self.__wheels[0]
+        for i in xrange(1, self.__slots - (self.__currentTick & self.__mask)):
+            if wheel[(self.__currentTick + i) & self.__mask]:
+                return self.__currentTick + i
+        return ((self.__currentTick >> TIMER_WHEEL_BITS) + 1) << TIMER_WHEEL_BITS
+
+    def advance(self, now):
+        targetTick = int((now - self.__startTs) / self.__tick)
+        while self.__currentTick < targetTick:
+            if self.__count == 0:
+                self.__currentTick = targetTick
+                break
+            nextTick = self.__nextEventTick()
+            if nextTick > targetTick:
+                self.__currentTick = targetTick
+                break
+            # nothing happens on the ticks in between
+            self.__currentTick = nextTick - 1
+            self.__doTick()
+
+    def getNextTimeout(self, now):
+        # Seconds until the next tick, having timers to fire or to cascade
+        if self.__count == 0:
+            return None
+        return max(0.0, self.__startTs + self.__nextEventTick() * self.__tick - now)
+
+class RealTime(Time):
+    # Wall clock time, firing scheduled functions from the EventLoop. Every
+    # period is randomly stretched or shrunk by up to TIMER_JITTER, so nodes
+    # started together don't fire their timers in lockstep.
+
+    def __init__(self, loop, jitter = TIMER_JITTER, seed = None):
+        self.__wheel = TimerWheel(time.time())
+        self.__jitter = jitter
+        self.__random = random.Random(seed)
+        loop.setTimerSource(self)
+
+    def getCurrentTimestamp(self):
+        return time.time()
+
+    def __jittered(self, interval):
+        return lambda: interval * (1.0 + self.__random.uniform(-self.__jitter, self.__jitter))
+
+    def scheduleFunc(self, func, interval):
+        period = self.__jittered(interval)
+        return self.__wheel.add(func, period(), period)
+
+    def scheduleOnce(self, func, delay):
+        return self.__wheel.add(func, delay)
+
+    def cancelFunc(self, handle):
+        self.__wheel.cancel(handle)
+
+    def getNextTimeout(self):
+        return self.__wheel.getNextTimeout(time.time())
+
+    def advance(self):
+        self.__wheel.advance(time.time())
@@ -0,0 +1,314 @@
+import socket
+import errno
+import struct
+from collections import deque, OrderedDict
+
+from Communicator import Communicator
+from LRUCache import LRUCache
+from constants import UDP_SEND_QUEUE_LIMIT, UDP_RECV_BATCH, UDP_MAX_DATAGRAM, UDP_MTU, UDP_PEER_RATE,\
+    UDP_PEER_BURST, UDP_PEER_BUCKETS
+
+
+def splitAddress(address):
+    # 'host:port/tag' => ('host:port', 'tag'), tag is '' for plain addresses
+    base, _, tag = address.partition('/')
+    return base, tag
+
+def parseAddress(address):
+    # 'host:port' => ('host', port), raises ValueError for malformed addresses
+    host, port = address.rsplit(':', 1)
+    port = int(port)
+    if not 0 <= port <= 65535:
+        raise ValueError('bad port %d' % port)
+    return (host, port)
+
+def formatAddress(address):
+    return '%s:%d' % address
+
+# Every packet starts with the routing header:
+#   uint8 size, destination tag, uint8 size, source tag
+# Identities with addresses 'host:port/tag' share the socket of 'host:port',
+# received packets are routed to them by the destination tag.
+#
+# A datagram is either a single packet, or a batch of packets to the same
+# socket address:
+#   _BATCH_MARKER, [uint16 size, packet]...
+# (tags are shorter than 100 bytes, so the marker is never a tag size)
+
+_BATCH_MARKER = chr(255)
+_BATCH_ENTRY = struct.Struct('!H')
+
+def _packRoute(dstTag, srcTag):
+    return chr(len(dstTag)) + dstTag + chr(len(srcTag)) + srcTag
+
+def _unpackRoute(data, pos, end):
+    # returns (destination tag, source tag, header end), None for broken header
+    if pos >= end:
+        return None
+    srcPos = pos + 1 + ord(data[pos])
+    if srcPos >= end:
+        return None
+    headerEnd = srcPos + 1 + ord(data[srcPos])
+    if headerEnd > end:
+        return None
+    return data[pos + 1:srcPos], data[srcPos + 1:headerEnd], headerEnd
+
+def _packBatch(packets):
+    if len(packets) == 1:
+        return packets[0]
+    return _BATCH_MARKER + ''.join(_BATCH_ENTRY.pack(len(packet)) + packet for packet in packets)
+
+def _unpackBatch(data):
+    # returns [(start, end)] of packets in a datagram, None for broken batch
+    if data[0] != _BATCH_MARKER:
+        return [(0, len(data))]
+    packets = []
+    pos = 1
+    while pos < len(data):
+        if pos + _BATCH_ENTRY.size > len(data):
+            return None
+        size, = _BATCH_ENTRY.unpack_from(data, pos)
+        pos += _BATCH_ENTRY.size
+        if pos + size > len(data):
+            return None
+        packets.append((pos, pos + size))
+        pos += size
+    return packets
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+class _UdpEndpoint:
+    def __init__(self, address):
+        self.address = address
+        self.callbacks = {} # tag => callback
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.sock.bind(parseAddress(address))
+        self.destinations = OrderedDict() # destination socket address => _UdpDestination
+        self.queued = 0 # packets in destinations
+        self.sendQueue = deque() # [(address tuple, datagram, packets)]
+        self.waitingWritable = False
+        self.retryTimer = None
+
+class _UdpDestination:
+    def __init__(self, address):
+        self.address = address # parsed socket address
+        self.control = deque() # [packet], sent first and never rate limited
+        self.bulk = deque()
+
+class UdpCommunicator(Communicator):
+    # Communicator over UDP sockets, driven by EventLoop. Every subscribed
+    # 'host:port' gets its own non-blocking socket, shared by all its
+    # 'host:port/tag' identities. Outgoing packets are queued per destination
+    # and flushed once per loop tick: packets to the same socket address are
+    # coalesced into datagrams of up to UDP_MTU bytes, control packets first.
+    # With time set, bulk packets to a destination are limited by a token
+    # bucket (UDP_PEER_RATE, UDP_PEER_BURST) and wait for tokens in the
+    # queue. When the socket buffer is full the datagrams wait for
+    # writability; packets above UDP_SEND_QUEUE_LIMIT are dropped.
+
+    def __init__(self, loop, time = None):
+        Communicator.__init__(self)
+        self.__loop = loop
+        self.__time = time
+        self.__endpoints = {} # socket address => _UdpEndpoint
+        self.__pendingFlush = set() # socket addresses with queued packets
+        self.__flushScheduled = False
+        self.__buckets = LRUCache(UDP_PEER_BUCKETS) # destination socket address => [tokens, timestamp]
+        self.__stats = {
+            'packets_sent': 0,
+            'datagrams_sent': 0,
+            'bytes_sent': 0,
+            'packets_received': 0,
+            'datagrams_received': 0,
+            'bytes_received': 0,
+            'send_dropped': 0,
+            'send_errors': 0,
+            'receive_errors': 0,
+            'unroutable': 0,
+            'backpressure_events': 0,
+            'rate_limited': 0,
+            'flushes': 0,
+        }
+
+    def subscribe(self, selfAddress, onDataReceivedCallback):
+        base, tag = splitAddress(selfAddress)
+        endpoint = self.__endpoints.get(base, None)
+        if endpoint is None:
+            endpoint = self.__endpoints[base] = _UdpEndpoint(base)
+            self.__loop.addReader(endpoint.sock, lambda: self.__onReadable(endpoint))
+        endpoint.callbacks[tag] = onDataReceivedCallback
+
+    def unsubscribe(self, selfAddress):
+        base, tag = splitAddress(selfAddress)
+        endpoint = self.__endpoints[base]
+        del endpoint.callbacks[tag]
+        if endpoint.callbacks:
+            return
+        del self.__endpoints[base]
+        self.__pendingFlush.discard(base)
+        if endpoint.retryTimer is not None:
+            self.__time.cancelFunc(endpoint.retryTimer)
+        self.__loop.removeReader(endpoint.sock)
+        self.__loop.removeWriter(endpoint.sock)
+        endpoint.sock.close()
+
+    def _doSend(self, selfAddress, address, data, control = False):
+        base, srcTag = splitAddress(selfAddress)
+        dstBase, dstTag = splitAddress(address)
+        endpoint = self.__endpoints.get(base, None)
+        data = _packRoute(dstTag, srcTag) + data
+        if endpoint is None or len(data) > UDP_MAX_DATAGRAM:
+            self.__stats['send_errors'] += 1
+            return
+        if endpoint.queued + len(endpoint.sendQueue) >= UDP_SEND_QUEUE_LIMIT:
+            self.__stats['send_dropped'] += 1
+            return
+        destination = endpoint.destinations.get(dstBase, None)
+        if destination is None:
+            # addresses come from the network (closest_friends), check them once here
+            try:
+                dstAddress = parseAddress(dstBase)
+            except ValueError:
+                self.__stats['send_errors'] += 1
+                return
+            destination = endpoint.destinations[dstBase] = _UdpDestination(dstAddress)
+        if control:
+            destination.control.append(data)
+        else:
+            destination.bulk.append(data)
+        endpoint.queued += 1
+        if endpoint.waitingWritable:
+            return
+        self.__pendingFlush.add(base)
+        if not self.__flushScheduled:
+            self.__flushScheduled = True
+            self.__loop.callSoon(self.__flush)
+
+    def __flush(self):
+        self.__flushScheduled = False
+        self.__stats['flushes'] += 1
+        pending = self.__pendingFlush
+        self.__pendingFlush = set()
+        for base in pending:
+            endpoint = self.__endpoints.get(base, None)
+            if endpoint is not None:
+                self.__flushEndpoint(endpoint)
+
+    def __refillBucket(self, dstBase, now):
+        # returns [tokens, timestamp] bucket of the destination, refilled
+        bucket = self.__buckets.get(dstBase)
+        if bucket is None:
+            bucket = [UDP_PEER_BURST, now]
+            self.__buckets.put(dstBase, bucket)
+        else:
+            bucket[0] = min(UDP_PEER_BURST, bucket[0] + (now - bucket[1]) * UDP_PEER_RATE)
+            bucket[1] = now
+        return bucket
+
+    def __buildDatagrams(self, endpoint):
+        # moves queued packets to the send queue, returns the delay until
+        # rate limited packets get tokens (None if there are no such packets)
+        now = self.__time.getCurrentTimestamp() if self.__time is not None else None
+        retryDelay = None
+        for dstBase in endpoint.destinations.keys():
+            destination = endpoint.destinations[dstBase]
+            bucket = self.__refillBucket(dstBase, now) if now is not None else None
+            packets = []
+            size = 1
+            while destination.control or (destination.bulk and (bucket is None or bucket[0] > 0)):
+                queue = destination.control or destination.bulk
+                packet = queue.popleft()
+                endpoint.queued -= 1
+                if packets and size + _BATCH_ENTRY.size + len(packet) > UDP_MTU:
+                    endpoint.sendQueue.append((destination.address, _packBatch(packets), len(packets)))
+                    packets = []
+                    size = 1
+                packets.append(packet)
+                size += _BATCH_ENTRY.size + len(packet)
+                if bucket is not None:
+                    bucket[0] -= len(packet)
+            if packets:
+                endpoint.sendQueue.append((destination.address, _packBatch(packets), len(packets)))
+            if destination.bulk:
+                self.__stats['rate_limited'] += 1
+                delay = max(-bucket[0], 1.0) / UDP_PEER_RATE
+                retryDelay = delay if retryDelay is None else min(retryDelay, delay)
+            else:
+                del endpoint.destinations[dstBase]
+        return retryDelay
+
+    def __onRetry(self, endpoint):
+        endpoint.retryTimer = None
+        if self.__endpoints.get(endpoint.address, None) is endpoint and not endpoint.waitingWritable:
+            self.__flushEndpoint(endpoint)
+
+    def __flushEndpoint(self, endpoint):
+        retryDelay = self.__buildDatagrams(endpoint)
+        if retryDelay is not None and endpoint.retryTimer is None:
+            endpoint.retryTimer = self.__time.scheduleOnce(lambda: self.__onRetry(endpoint), retryDelay)
+        queue = endpoint.sendQueue
+        sock = endpoint.sock
+        while queue:
+            address, data, packets = queue[0]
+            try:
+                sock.sendto(data, address)
+            except (socket.error, OverflowError, TypeError) as e:
+                if isinstance(e, socket.error) and e.args and e.args[0] in _WOULD_BLOCK:
+                    if not endpoint.waitingWritable:
+                        endpoint.waitingWritable = True
+                        self.__stats['backpressure_events'] += 1
+                        self.__loop.addWriter(sock, lambda: self.__onWritable(endpoint))
+                    return
+                # unresolvable hosts etc, the datagram is dropped
+                self.__stats['send_errors'] += 1
+                queue.popleft()
+                continue
+            queue.popleft()
+            self.__stats['packets_sent'] += packets
+            self.__stats['datagrams_sent'] += 1
+            self.__stats['bytes_sent'] += len(data)
+
+    def __onWritable(self, endpoint):
+        endpoint.waitingWritable = False
+        self.__loop.removeWriter(endpoint.sock)
+        self.__flushEndpoint(endpoint)
+
+    def __onReadable(self, endpoint):
+        for _ in xrange(UDP_RECV_BATCH):
+            try:
+                data, address = endpoint.sock.recvfrom(UDP_MAX_DATAGRAM)
+            except socket.error as e:
+                if e.args[0] in _WOULD_BLOCK:
+                    return
+                # icmp errors from previous sends (ECONNREFUSED etc)
+                self.__stats['receive_errors'] += 1
+                continue
+            self.__stats['datagrams_received'] += 1
+            self.__stats['bytes_received'] += len(data)
+            packets = _unpackBatch(data) if data else None
+            if packets is None:
+                self.__stats['unroutable'] += 1
+                continue
+            view = memoryview(data)
+            for start, end in packets:
+                self.__stats['packets_received'] += 1
+                route = _unpackRoute(data, start, end)
+                callback = endpoint.callbacks.get(route[0], None) if route is not None else None
+                if callback is None:
+                    self.__stats['unroutable'] += 1
+                    continue
+                _, srcTag, headerEnd = route
+                source = formatAddress(address)
+                if srcTag:
+                    source += '/' + srcTag
+                self._onReceived(source, view[headerEnd:end], callback)
+
+    def getTraffic(self):
+        return self.__stats['bytes_sent']
+
+    def getStats(self):
+        stats = dict(self.__stats)
+        stats['send_queue'] = sum(e.queued + len(e.sendQueue) for e in self.__endpoints.itervalues())
+        return stats
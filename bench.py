@@ -0,0 +1,281 @@
+import os
+import sys
+import time
+import json
+import argparse
+import tempfile
+import shutil
+import atexit
+
+import msgpack
+
+from Communicator import dictToList, listToDict, KEY_TO_ID
+from PacketCodec import PacketCodec
+from CryptoUtils import CryptoUtils, distance, pubKeyToId
+from DHT import _DHT_Friends, _Authorizator
+from Simulator import MockTime, MockCommunicator
+from KeyStore import KeyStore
+
+import constants
+
+# Micro-benchmarks of the hot paths. Every benchmark is a function, which
+# prepares its data and returns (func, count): func is timed for count
+# calls in several rounds, the result is relative to a reference workload
+# (see runBenchmarks).
+#
+#   python bench.py                               - run and print results
+#   python bench.py --save bench_baseline.json    - store results as a baseline
+#   python bench.py --compare bench_baseline.json - fail if any benchmark is
+#                                                   slower than its baseline by
+#                                                   more than --threshold percent
+
+def _opsPerSec(func, count):
+    start = time.time()
+    for _ in xrange(count):
+        func()
+    return count / (time.time() - start)
+
+def _samplePackets():
+    friends = [(os.urandom(32), 'addr' + str(i)) for i in xrange(constants.MAX_FRIENDS)]
+    return [
+        {'type': 'ping'},
+        {'type': 'response_id', 'id': os.urandom(32), 'pub_key': os.urandom(294)},
+        {'type': 'confirm', 'rand_seq': os.urandom(256)},
+        {'type': 'search_response', 'closest_friends': friends[:constants.FRIENDS_PER_REQUEST]},
+        {'type': 'exchange_response', 'closest_friends': friends},
+    ]
+
+def _legacyRoundTrip(packet):
+    packet = listToDict(msgpack.unpackb(msgpack.packb(dictToList(packet))))
+    for key in packet:
+        packet[key]
+
+def _codecRoundTrip(codec, packet):
+    decoded = codec.decode(codec.encode(packet))
+    for key in packet:
+        decoded[key]
+
+def codecBench(count = 20000):
+    codec = PacketCodec(KEY_TO_ID)
+    print '%-20s %14s %14s %10s %10s' % ('packet', 'legacy ops/s', 'codec ops/s', 'legacy B', 'codec B')
+    for packet in _samplePackets():
+        legacy = _opsPerSec(lambda: _legacyRoundTrip(packet), count)
+        compiled = _opsPerSec(lambda: _codecRoundTrip(codec, packet), count)
+        legacySize = len(msgpack.packb(dictToList(packet)))
+        codecSize = len(codec.encode(packet))
+        print '%-20s %14d %14d %10d %10d' % (packet['type'], legacy, compiled, legacySize, codecSize)
+
+def _cycle(items):
+    # returns function, returning next item on every call
+    state = [0]
+    def nextItem():
+        state[0] = (state[0] + 1) % len(items)
+        return items[state[0]]
+    return nextItem
+
+def _benchDistance():
+    pairs = _cycle([(os.urandom(32), os.urandom(32)) for _ in xrange(1000)])
+    return lambda: distance(*pairs()), 200000
+
+def _benchDistanceMiss():
+    # pairs are not repeated during the first 10 rounds
+    count = 10000
+    pairs = _cycle([(os.urandom(32), os.urandom(32)) for _ in xrange(count * 10)])
+    return lambda: distance(*pairs()), count
+
+class _AllAuthorized:
+    def isAuthorized(self, id):
+        return True
+
+def _benchFindClosest(size):
+    def bench():
+        friends = _DHT_Friends('', MockTime(), _AllAuthorized())
+        friends.addMany([(os.urandom(32), 'addr' + str(i)) for i in xrange(size)])
+        targets = _cycle([os.urandom(32) for _ in xrange(1000)])
+        return lambda: friends.findClosest(targets()), 20000
+    return bench
+
+def _benchLegacyRoundTrip():
+    packet = _samplePackets()[3]
+    return lambda: _legacyRoundTrip(packet), 20000
+
+def _benchCodecRoundTrip():
+    codec = PacketCodec(KEY_TO_ID)
+    packet = _samplePackets()[3]
+    return lambda: _codecRoundTrip(codec, packet), 20000
+
+_g_keys = []
+
+def _getKeys(num):
+    # rsa keys generation is slow, keys are shared between benchmarks
+    while len(_g_keys) <= num:
+        _g_keys.append(CryptoUtils().generateKeys('bench' + str(len(_g_keys)), 'password'))
+    return _g_keys[num]
+
+def _benchEncrypt():
+    crypto = CryptoUtils()
+    _, pubKey = _getKeys(0)
+    return lambda: crypto.encrypt(pubKey, os.urandom(constants.RAND_SEQ_LENGTH)), 300
+
+def _benchDecrypt():
+    crypto = CryptoUtils()
+    privKey, pubKey = _getKeys(0)
+    message = crypto.encrypt(pubKey, os.urandom(constants.RAND_SEQ_LENGTH))
+    return lambda: crypto.decrypt(privKey, message), 100
+
+def _benchGenerateKeys():
+    crypto = CryptoUtils()
+    logins = _cycle(['login' + str(i) for i in xrange(10)])
+    return lambda: crypto.generateKeys(logins(), 'password'), 1
+
+def _benchKeyStoreLoad():
+    # node startup with stored keys, instead of generate_keys
+    path = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, path)
+    keyStore = KeyStore(path)
+    keyStore.save('login', 'password', *_getKeys(0))
+    return lambda: keyStore.load('login', 'password'), 20
+
+class _BenchNode:
+    # minimal DHT stand-in for a bare _Authorizator
+    def __init__(self, address, keys):
+        self.__address = address
+        self.__privKey, self.__pubKey = keys
+        self.__id = pubKeyToId(self.__pubKey)
+        self.received = 0
+
+    def getAddress(self):
+        return self.__address
+
+    def getId(self):
+        return self.__id
+
+    def getPubKey(self):
+        return self.__pubKey
+
+    def getPrivKey(self):
+        return self.__privKey
+
+    def _onPacketReceived(self, address, id, packet):
+        self.received += 1
+
+def _authorizeOnce(communicator, node):
+    received = node.received
+    communicator.send('addr2', 'addr1', {'type': 'ping'})
+    assert node.received == received + 1
+
+def _benchHandshake():
+    # full authorization of addr2 by a fresh authorizator of addr1
+    time = MockTime()
+    communicator = MockCommunicator()
+    node1 = _BenchNode('addr1', _getKeys(0))
+    node2 = _BenchNode('addr2', _getKeys(1))
+    authorizator2 = _Authorizator(communicator, node2, CryptoUtils(), time)
+    communicator.subscribe('addr2', authorizator2.onPacketReceived)
+    crypto1 = CryptoUtils()
+    def handshake():
+        authorizator1 = _Authorizator(communicator, node1, crypto1, time)
+        communicator.subscribe('addr1', authorizator1.onPacketReceived)
+        _authorizeOnce(communicator, node1)
+    return handshake, 50
+
+def _benchResume():
+    # authorization of addr2 with a session ticket, issued by the first handshake
+    time = MockTime()
+    communicator = MockCommunicator()
+    node1 = _BenchNode('addr1', _getKeys(0))
+    node2 = _BenchNode('addr2', _getKeys(1))
+    authorizator1 = _Authorizator(communicator, node1, CryptoUtils(), time)
+    authorizator2 = _Authorizator(communicator, node2, CryptoUtils(), time)
+    communicator.subscribe('addr1', authorizator1.onPacketReceived)
+    communicator.subscribe('addr2', authorizator2.onPacketReceived)
+    _authorizeOnce(communicator, node1)
+    def resume():
+        authorizator1.remove('addr2')
+        _authorizeOnce(communicator, node1)
+    return resume, 5000
+
+BENCHMARKS = [
+    ('distance', _benchDistance),
+    ('distance_miss', _benchDistanceMiss),
+    ('find_closest_60', _benchFindClosest(constants.MAX_FRIENDS)),
+    ('find_closest_1000', _benchFindClosest(1000)),
+    ('find_closest_10000', _benchFindClosest(10000)),
+    ('legacy_roundtrip', _benchLegacyRoundTrip),
+    ('codec_roundtrip', _benchCodecRoundTrip),
+    ('rsa_encrypt', _benchEncrypt),
+    ('rsa_decrypt', _benchDecrypt),
+    ('generate_keys', _benchGenerateKeys),
+    ('keystore_load', _benchKeyStoreLoad),
+    ('handshake', _benchHandshake),
+    ('resume', _benchResume),
+]
+
+def _reference():
+    # fixed pure python workload, speed of the machine at the moment
+    total = 0
+    for i in xrange(1000):
+        total += i * i
+    return total
+
+def runBenchmarks(nameFilter = '', rounds = 5, log = True):
+    # returns {benchmark name: score}. Score is ops/sec of the benchmark
+    # divided by ops/sec of _reference(), measured right after it, so
+    # scores from machines (and moments) with different speed are close.
+    # The median of rounds is reported.
+    results = {}
+    for name, bench in BENCHMARKS:
+        if nameFilter not in name:
+            continue
+        func, count = bench()
+        scores = []
+        for _ in xrange(rounds):
+            opsPerSec = _opsPerSec(func, count)
+            scores.append(opsPerSec / _opsPerSec(_reference, 2000))
+        results[name] = sorted(scores)[len(scores) / 2]
+        if log:
+            print '%-20s %14.1f ops/s %12.5f score' % (name, opsPerSec, results[name])
+    return results
+
+def compareResults(baseline, results, threshold):
+    # returns names of benchmarks, slower than baseline by more than threshold percent
+    regressions = []
+    print '%-20s %14s %14s %8s' % ('benchmark', 'baseline', 'score', 'change')
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        change = 100.0 * (results[name] - baseline[name]) / baseline[name]
+        regressed = change < -threshold
+        if regressed:
+            regressions.append(name)
+        print '%-20s %14.5f %14.5f %7.1f%%%s' % (name, baseline[name], results[name], change,
+                                                 '  REGRESSION' if regressed else '')
+    return regressions
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='wasp hot path benchmarks')
+    parser.add_argument('--filter', default='', help='run only benchmarks with this substring in name')
+    parser.add_argument('--rounds', type=int, default=5, help='rounds per benchmark, median is reported')
+    parser.add_argument('--save', default='', help='store results to this baseline file')
+    parser.add_argument('--compare', default='', help='compare results with this baseline file')
+    parser.add_argument('--threshold', type=float, default=25.0, help='max allowed slowdown, percent')
+    parser.add_argument('--codec-table', action='store_true', help='print legacy vs codec table for all packet types')
+    args = parser.parse_args(argv)
+
+    if args.codec_table:
+        codecBench()
+        return 0
+
+    results = runBenchmarks(args.filter, args.rounds)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compareResults(baseline, results, args.threshold):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
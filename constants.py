@@ -1,7 +1,20 @@
 
-# Length of private and public key (and id in DHT)
+# Length of private and public key
 KEY_LENGTH = 2048
 
+# Use sha256(public key) as node id in DHT instead of the public key itself.
+# Full public keys are then only transferred during authorization.
+HASHED_IDS = True
+
+# Size of node ids: sha256 digest or DER encoded public key of KEY_LENGTH bits
+ID_SIZE = 32 if HASHED_IDS else 294
+
+# Max public keys, cached by authorizator (id => public key)
+PUB_KEYS_CACHE_SIZE = 10000
+
+# Max parsed public keys with their ciphers, cached for encryption
+CIPHERS_CACHE_SIZE = 1024
+
 # Length of the random sequence, used for authorization
 RAND_SEQ_LENGTH = 128
 
@@ -20,3 +33,172 @@ PING_INTERVAL = 15
 # After this timeout friend considered as offline and removed from friendList
 FRIENDS_TIMEOUT = 90
 
+# Max (id, id) pairs kept in distance cache
+DISTANCE_CACHE_SIZE = 100000
+
+# Max datagrams, queued for sending on a single udp socket (the rest are dropped)
+UDP_SEND_QUEUE_LIMIT = 4096
+
+# Max datagrams, read from a socket in one event loop tick
+UDP_RECV_BATCH = 64
+
+# Max udp datagram size
+UDP_MAX_DATAGRAM = 65507
+
+# Packets to the same socket address are coalesced into datagrams up to this size
+UDP_MTU = 1400
+
+# Token bucket of bulk (not control) traffic to a socket address: rate,
+# bytes per second, and burst, bytes
+UDP_PEER_RATE = 256 * 1024
+UDP_PEER_BURST = 64 * 1024
+
+# Max socket addresses, whose token buckets are kept (forgotten ones start full)
+UDP_PEER_BUCKETS = 4096
+
+# Timer wheel resolution, seconds
+TIMER_WHEEL_TICK = 0.01
+
+# Timer wheel: 4 levels of 64 slots, covers 2^24 ticks (~46 hours)
+TIMER_WHEEL_BITS = 6
+TIMER_WHEEL_LEVELS = 4
+
+# Periodic timers are randomly shifted by up to this part of their interval
+TIMER_JITTER = 0.1
+
+# Packet field size limits, checked when packets are encoded and decoded
+# (ids are exactly ID_SIZE bytes)
+MAX_ADDRESS_SIZE = 100
+MAX_RAND_SEQ_SIZE = 512
+MAX_PUB_KEY_SIZE = 1024
+MAX_TICKET_SIZE = 256
+MAX_NONCE_SIZE = 32
+MAX_FILTER_SIZE = 512
+
+# Max rsa operations of a single node, running in the crypto executor at once
+MAX_CRYPTO_IN_FLIGHT = 8
+
+# Max rsa operations, waiting for the crypto executor (the rest are dropped)
+MAX_CRYPTO_BACKLOG = 256
+
+# Session ticket lifetime - during this time peer can be authorized again in
+# a single round trip with symmetric crypto, seconds
+SESSION_TICKET_LIFETIME = 7 * 24 * 3600
+
+# Max authorization sessions (resumable with tickets), kept in memory
+MAX_SESSIONS = 10000
+
+# Seconds between writes of buffered friends journal records to disk
+JOURNAL_FLUSH_INTERVAL = 5
+
+# Friends journal is compacted to a snapshot, when it has more than
+# max(JOURNAL_COMPACT_MIN_RECORDS, JOURNAL_COMPACT_RATIO * friends) records
+JOURNAL_COMPACT_MIN_RECORDS = 1000
+JOURNAL_COMPACT_RATIO = 8
+
+# Friends are checked for liveness in LIVENESS_SLOTS groups, one group per
+# PING_INTERVAL / LIVENESS_SLOTS seconds
+LIVENESS_SLOTS = 15
+
+# Max seconds without packets from a fully reliable friend before it is pinged
+LIVENESS_MAX_IDLE = 45
+
+# Weight of the last ping result in friend reliability (answered pings average)
+LIVENESS_RELIABILITY_ALPHA = 0.2
+
+# Reliability of a new friend
+LIVENESS_INITIAL_RELIABILITY = 0.5
+
+# Search requests, sent in parallel by a single node lookup
+LOOKUP_ALPHA = 3
+
+# Seconds to wait for a search response
+LOOKUP_TIMEOUT = 5
+
+# Extra search requests to a node, which didn't respond in LOOKUP_TIMEOUT
+LOOKUP_RETRIES = 1
+
+# Seconds between lookups of own id, repeated while the node has less than
+# MAX_FRIENDS friends
+SELF_LOOKUP_INTERVAL = 60
+
+# Seconds to wait for a friends exchange response
+EXCHANGE_TIMEOUT = 10
+
+# Length of random request nonces, echoed in responses
+REQUEST_NONCE_LENGTH = 8
+
+# Max peers in the middle of authorization, the oldest ones are dropped above it
+MAX_HALF_OPEN_AUTH = 1024
+
+# Max packets, queued from a peer while it is being authorized
+MAX_AUTH_QUEUE = 16
+
+# Seconds to wait for the next handshake packet from a peer, and for the
+# confirmation (which includes rsa operations on both sides)
+AUTH_HANDSHAKE_TIMEOUT = 10
+AUTH_CONFIRM_TIMEOUT = 30
+
+# Last handshake packet is sent again, when the peer keeps sending packets
+# while we wait for its answer (a lost handshake packet), at most once per
+# this many seconds
+AUTH_RESEND_INTERVAL = 1
+
+# Authorized peer is forgotten after this many seconds without packets
+AUTH_IDLE_TIMEOUT = 600
+
+# Seconds between checks for expired authorization state
+AUTH_EXPIRE_INTERVAL = 5
+
+# Upper bounds of latency histogram buckets, seconds
+METRICS_LATENCY_BUCKETS = [0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03, 0.1, 0.3, 1, 3, 10, 30]
+
+# Backup chunk size, bytes
+BACKUP_CHUNK_SIZE = 1024 * 1024
+
+# Max backup chunks, read ahead of storing (being sealed by the pool), per stream
+BACKUP_MAX_IN_FLIGHT = 8
+
+# Replicas of every placed chunk
+STORAGE_REPLICAS = 3
+
+# Chunks are uploaded in blocks of this size, one block per packet
+STORAGE_BLOCK_SIZE = 32 * 1024
+
+# Max unacknowledged blocks per peer
+STORAGE_WINDOW = 8
+
+# Max chunks being placed at the same time
+STORAGE_MAX_PLACEMENTS = 16
+
+# Seconds to wait for a block acknowledgement, and resends before the peer is given up
+STORAGE_BLOCK_TIMEOUT = 5
+STORAGE_BLOCK_RETRIES = 2
+
+# Max size of a stored chunk (sealed backup chunk)
+STORAGE_MAX_CHUNK_SIZE = BACKUP_CHUNK_SIZE + 1024
+
+# Max partially received chunks, and seconds they are kept without new blocks
+STORAGE_MAX_INCOMING = 64
+STORAGE_INCOMING_TIMEOUT = 60
+
+# Seconds between free space probes of chunk holders, probe timeout, and
+# failed probes in a row, after which the holder is replaced
+STORAGE_CHECK_INTERVAL = 60
+STORAGE_PROBE_TIMEOUT = 10
+STORAGE_PROBE_FAILURES = 2
+
+# Nodes with remembered free space, advertised in storage responses
+STORAGE_PEERS_CACHE_SIZE = 1024
+
+# PBKDF2-SHA256 iterations of the key store encryption key, and of the
+# test identities key store (see CryptoUtils._enableCache)
+KEYSTORE_KDF_ITERATIONS = 10000
+KEYSTORE_TEST_ITERATIONS = 1
+
+# Exchange requests carry a bloom filter of the requester's friends (and,
+# with a full table, the distance of its farthest friend), responses carry
+# only the friends it misses
+FRIENDS_DELTA_EXCHANGE = True
+FRIENDS_FILTER_BITS_PER_ID = 10
+FRIENDS_FILTER_HASHES = 7
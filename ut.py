@@ -1,127 +1,974 @@
-from random import randint
+import os
+import tempfile
+import socket
+import random
+import shutil
+import hashlib
+import struct
 
-from DHT import DHT
-from Time import Time
-from Communicator import Communicator
-from CryptoUtils import _enableCache, _enableFakeCrypto
+from DHT import DHT, _DHT_Friends
+from Time import TimerWheel, RealTime
+from LRUCache import LRUCache
+from EventLoop import EventLoop
+from UdpCommunicator import UdpCommunicator
+from Simulator import MockTime, MockCommunicator, Simulator, ShardedSimulator
+from Communicator import KEY_TO_ID
+from Journal import Journal
+from Backup import BackupEngine, BackupError, LocalChunkStore
+from Storage import Storage
+from BloomFilter import BloomFilter
+from Host import Host
+from KeyStore import KeyStore
+from Metrics import Histogram, MetricsHttpServer, formatText
+from PacketCodec import PacketCodec, PacketError
+from CryptoExecutor import ProcessCryptoExecutor
+from CryptoUtils import _enableCache, _enableFakeCrypto, distance, CryptoUtils, hmacSha256, deriveSessionKey
 
 import constants
 
-class MockTime(Time):
-    def __init__(self):
-        self.__ts = 12345678.0
+def simpleUt():
+    time = MockTime()
+    communicator = MockCommunicator()
 
-        # func_ts => [functions]
-        self.__funcs = {}
+    dht1 = DHT('login1', 'pass1', '', communicator, 'addr1', '', time)
+    dht2 = DHT('login2', 'pass2', '', communicator, 'addr2', 'addr1', time)
+    dht3 = DHT('login3', 'pass3', '', communicator, 'addr3', 'addr2', time)
 
-    def getCurrentTimestamp(self):
-        return self.__ts
+    time.scroll(constants.FRIENDS_EXCHANGE_INTERVAL)
 
-    def scheduleFunc(self, func, interval):
-        self.__funcs.setdefault(self.__ts + interval, []).append((func, interval))
+    assert dht1.getId() != dht2.getId()
+    assert dht2.getId() != dht3.getId()
+    assert dht3.getId() != dht1.getId()
+    if constants.HASHED_IDS:
+        assert len(dht1.getId()) == 32
 
-    def scroll(self, interval):
-        nextTs = self.__ts + interval
-        if len(self.__funcs) == 0:
-            self.__ts = nextTs
-            return
-        while True:
-            funcsToExecuteTs = sorted(self.__funcs.keys())[0]
-            if funcsToExecuteTs > nextTs:
-                self.__ts = nextTs
-                break
-            self.__ts = funcsToExecuteTs
-            funcsToExecute = self.__funcs[funcsToExecuteTs]
-            for func, interval in funcsToExecute:
-                func()
-                self.scheduleFunc(func, interval)
-            del self.__funcs[funcsToExecuteTs]
-
-class MockCommunicator(Communicator):
-    def __init__(self):
-        self.__addressToCallback = {}
-        self.__traffic = 0
+    assert dht1.getFriendsSize() == 2
+    assert dht2.getFriendsSize() == 2
+    assert dht3.getFriendsSize() == 2
 
-    def subscribe(self, selfAddress, onDataReceivedCallback):
-        self.__addressToCallback[selfAddress] = onDataReceivedCallback
+    # ids of a wrong size from an authorized peer are rejected by the codec
+    for data in _malformedIdPackets():
+        communicator._doSend('addr2', 'addr1', data)
+    assert communicator.getDecodeErrors() == 2
+    time.scroll(constants.FRIENDS_EXCHANGE_INTERVAL)
+    assert dht1.getFriendsSize() == 2
 
-    def unsubscribe(self, selfAddress):
-        del self.__addressToCallback[selfAddress]
+class _MockAuthorizator:
+    def __init__(self, authorized):
+        self.__authorized = authorized
 
-    def _doSend(self, selfAddress, address, data):
-        callback = self.__addressToCallback.get(address, None)
-        self.__traffic += len(data)
-        if callback is not None:
-            self._onReceived(selfAddress, data, callback)
+    def isAuthorized(self, id):
+        return id in self.__authorized
 
-    def getTraffic(self):
-        return self.__traffic
+def routingTableUt():
+    ids = [os.urandom(32) for _ in xrange(500)]
+    authorized = set(ids[::3])
+    friends = _DHT_Friends('', MockTime(), _MockAuthorizator(authorized))
+    for i, id in enumerate(ids):
+        friends.add(id, 'addr' + str(i))
+    for id in ids[::5]:
+        friends.remove(id)
+    ids = [id for id in ids if friends.has(id)]
+    bulkFriends = _DHT_Friends('', MockTime(), _MockAuthorizator(authorized))
+    assert bulkFriends.addMany([(id, 'addr') for id in ids[:100]]) == 100
+    assert bulkFriends.addMany([(id, 'addr') for id in ids]) == len(ids) - 100
 
-def simpleUt():
+    for _ in xrange(50):
+        target = os.urandom(32)
+        expected = sorted((distance(target, id), id) for id in ids)
+        closest = friends.findClosest(target, 10)
+        assert [f[:2] for f in closest] == expected[:10]
+        assert [f[:2] for f in bulkFriends.findClosest(target, 10)] == expected[:10]
+        farthest = friends.findClosest(target, 9.0, reverse=True)
+        assert [f[:2] for f in farthest] == sorted(expected, reverse=True)[:9]
+        expected = [e for e in expected if e[1] in authorized]
+        closest = friends.findClosest(target, 10, onlyAuthorized=True)
+        assert [f[:2] for f in closest] == expected[:10]
+
+def bloomFilterUt():
+    ids = [os.urandom(32) for _ in xrange(constants.MAX_FRIENDS)]
+    requesterId, responderId = os.urandom(32), os.urandom(32)
+    bloom = BloomFilter(constants.MAX_FRIENDS * constants.FRIENDS_FILTER_BITS_PER_ID / 8,
+                        constants.FRIENDS_FILTER_HASHES, requesterId + responderId)
+    for id in ids:
+        bloom.add(id)
+    loaded = BloomFilter(len(bloom.toBytes()), constants.FRIENDS_FILTER_HASHES, requesterId + responderId,
+                         bloom.toBytes())
+    assert all(id in loaded for id in ids)
+    assert sum(1 for _ in xrange(1000) if os.urandom(32) in loaded) < 30
+    # other pair of nodes - other false positives
+    other = BloomFilter(len(bloom.toBytes()), constants.FRIENDS_FILTER_HASHES, requesterId + os.urandom(32),
+                        bloom.toBytes())
+    assert sum(1 for id in ids if id in other) < len(ids)
+
+def lruCacheUt():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.size() == 2
+    assert cache.getHits() == 3
+    assert cache.getMisses() == 1
+    assert cache.getHitRate() == 0.75
+
+def _findFreeAddresses(count):
+    socks = []
+    for _ in xrange(count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        socks.append(sock)
+    addresses = ['127.0.0.1:%d' % sock.getsockname()[1] for sock in socks]
+    for sock in socks:
+        sock.close()
+    return addresses
+
+def udpUt():
+    loop = EventLoop()
+    time = MockTime()
+    communicator = UdpCommunicator(loop)
+    addresses = _findFreeAddresses(3)
+
+    dht1 = DHT('login1', 'pass1', '', communicator, addresses[0], '', time)
+    dht2 = DHT('login2', 'pass2', '', communicator, addresses[1], addresses[0], time)
+    for _ in xrange(100):
+        loop.runOnce(0.01)
+    dht3 = DHT('login3', 'pass3', '', communicator, addresses[2], addresses[1], time)
+    for _ in xrange(100):
+        loop.runOnce(0.01)
+
+    assert dht1.getFriendsSize() >= 1
+    assert dht2.getFriendsSize() >= 1
+    assert dht3.getFriendsSize() == 2
+
+    stats = communicator.getStats()
+    assert stats['packets_sent'] == stats['packets_received']
+    assert stats['packets_sent'] > stats['flushes'] > 0
+    assert stats['send_dropped'] == 0
+    assert stats['send_queue'] == 0
+
+    # broken addresses (e.g. from closest_friends) are dropped without blocking the queue
+    badAddresses = ['garbage', 'h:abc', '127.0.0.1:99999', '127.0.0.1:-1', 'bad\x00host:1']
+    for address in badAddresses:
+        communicator.send(addresses[0], address, {'type': 'ping'})
+    communicator.send(addresses[0], addresses[1], {'type': 'ping'})
+    sent = stats['packets_sent']
+    for _ in xrange(10):
+        loop.runOnce(0.01)
+    stats = communicator.getStats()
+    assert stats['send_errors'] == len(badAddresses)
+    assert stats['send_queue'] == 0
+    assert stats['packets_sent'] > sent
+    for address in addresses:
+        communicator.unsubscribe(address)
+
+def udpBatchUt():
+    loop = EventLoop()
+    time = MockTime()
+    src, dst = _findFreeAddresses(2)
+    received = []
+    communicator = UdpCommunicator(loop, time)
+    communicator.subscribe(src, lambda address, packet: None)
+    communicator.subscribe(dst, lambda address, packet: received.append(packet['type']))
+    communicator.subscribe(dst + '/t', lambda address, packet: received.append('t_' + packet['type']))
+
+    def run():
+        for _ in xrange(10):
+            loop.runOnce(0.01)
+
+    # packets of a tick to one socket address share a datagram, control first
+    for _ in xrange(10):
+        communicator.send(src, dst, {'type': 'exchange', 'nonce': 'x' * 8})
+    communicator.send(src, dst, {'type': 'ping'})
+    communicator.send(src, dst + '/t', {'type': 'pong'})
+    run()
+    assert received == ['ping', 't_pong'] + ['exchange'] * 10
+    stats = communicator.getStats()
+    assert stats['datagrams_sent'] == stats['datagrams_received'] == 1
+    assert stats['packets_sent'] == stats['packets_received'] == 12
+
+    # datagrams are split by UDP_MTU
+    store = {'type': 'store', 'chunk_id': os.urandom(32), 'offset': 0, 'size': 600, 'data': 'x' * 600,
+             'nonce': 'x' * 8}
+    for _ in xrange(10):
+        communicator.send(src, dst, store)
+    run()
+    stats = communicator.getStats()
+    assert stats['datagrams_sent'] == 6
+    assert stats['bytes_sent'] <= 6 * constants.UDP_MTU
+
+    # bulk packets wait for tokens, control ones don't
+    del received[:]
+    count = constants.UDP_PEER_BURST * 3 / 2 / 600
+    for _ in xrange(count):
+        communicator.send(src, dst, store)
+    run()
+    communicator.send(src, dst, {'type': 'ping'})
+    run()
+    assert 0 < received.count('store') < count
+    assert received[-1] == 'ping'
+    assert communicator.getStats()['rate_limited'] > 0
+    time.scroll(1)
+    run()
+    assert received.count('store') == count
+    assert communicator.getStats()['send_queue'] == 0
+
+    # broken batches are dropped
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.sendto(chr(255) + chr(0) + chr(200) + 'x', ('127.0.0.1', int(dst.split(':')[1])))
+    sock.close()
+    run()
+    assert communicator.getStats()['unroutable'] == 1
+    for address in [src, dst, dst + '/t']:
+        communicator.unsubscribe(address)
+
+def hostUt():
+    loop = EventLoop()
+    time = MockTime()
+    addresses = _findFreeAddresses(3)
+    hosts = [Host(loop, time, address) for address in addresses[:2]]
+    plain = UdpCommunicator(loop)
+    dht0 = DHT('login0', 'pass0', '', plain, addresses[2], '', time)
+    identities = []
+    for i in xrange(1, 9):
+        host = hosts[i % 2]
+        identities.append(host.addIdentity('n%d' % i, 'login%d' % i, 'pass%d' % i, '', addresses[2]))
+        for _ in xrange(20):
+            loop.runOnce(0.01)
+    # exchange responses have to arrive before their requests time out
+    for _ in xrange(constants.FRIENDS_EXCHANGE_INTERVAL):
+        time.scroll(1)
+        for _ in xrange(3):
+            loop.runOnce(0.001)
+    for _ in xrange(20):
+        loop.runOnce(0.01)
+
+    # identities of both hosts and the plain node find each other
+    assert dht0.getFriendsSize() == 8
+    for dht in identities:
+        assert dht.getFriendsSize() == 8
+    assert addresses[1] + '/n1' in identities[1].getFriendsAddresses()
+    stats = hosts[0].getStats()
+    assert stats['identities'] == 4
+    assert stats['communicator']['unroutable'] == 0
+    # a public key is cached once per host, not per identity, and identities
+    # use the keys verified by their neighbours
+    assert stats['pub_keys_cache']['size'] <= 9
+    assert sum(dht.getAuthStats()['known_keys'] for dht in hosts[0].getIdentities()) > 0
+
+    # datagrams for unknown identities are dropped
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.sendto("\x07unknown\x00" + chr(KEY_TO_ID['ping']), ('127.0.0.1', int(addresses[0].split(':')[1])))
+    sock.close()
+    for _ in xrange(10):
+        loop.runOnce(0.01)
+    assert hosts[0].getStats()['communicator']['unroutable'] == 1
+
+    for host in hosts:
+        host.stop()
+    dht0.stop()
+
+def timerWheelUt():
+    rand = random.Random(42)
+    wheel = TimerWheel(0.0, 0.01)
+    fired = []
+    expected = []
+    for i in xrange(3000):
+        delay = rand.choice([rand.uniform(0, 1), rand.uniform(0, 100), rand.uniform(0, 20000), 200000])
+        expected.append((i, max(1, int(round(delay / 0.01)))))
+        wheel.add(lambda i=i: fired.append((i, now)), delay)
+    cancelled = wheel.add(lambda: fired.append(('cancelled', now)), 5)
+    wheel.cancel(cancelled)
+    periodicFired = []
+    periodic = wheel.add(lambda: periodicFired.append(now), 10, lambda: 10)
+    assert wheel.size() == 3001
+
+    now = 0.0
+    while wheel.size() > 1:
+        now += rand.choice([0.01, 0.5, 37])
+        wheel.advance(now)
+    # every timer fired during the advance() call, covering its tick
+    firedTicks = dict(fired)
+    assert len(firedTicks) == len(expected)
+    for i, tick in expected:
+        assert tick * 0.01 <= firedTicks[i] < tick * 0.01 + 37.01
+    assert len(periodicFired) == int(now / 10)
+    wheel.cancel(periodic)
+    assert wheel.size() == 0
+
+    loop = EventLoop()
+    time = RealTime(loop, seed=1)
+    calls = []
+    time.scheduleOnce(lambda: calls.append('once'), 0.05)
+    handle = time.scheduleFunc(lambda: calls.append('periodic'), 0.02)
+    while len(calls) < 5:
+        loop.runOnce()
+    time.cancelFunc(handle)
+    count = len(calls)
+    for _ in xrange(5):
+        loop.runOnce(0.01)
+    assert len(calls) == count
+    assert 'once' in calls
+
+def latencyUt():
+    time = MockTime()
+    communicator = MockCommunicator(time, latency=0.05)
+
+    dht1 = DHT('login1', 'pass1', '', communicator, 'addr1', '', time)
+    dht2 = DHT('login2', 'pass2', '', communicator, 'addr2', 'addr1', time)
+    assert dht1.getFriendsSize() == 0
+    assert dht2.getFriendsSize() == 0
+    time.scroll(1)
+    assert dht1.getFriendsSize() == 1
+    assert dht2.getFriendsSize() == 1
+
+    order = []
+    for i in xrange(10):
+        time.scheduleOnce(lambda i=i: order.append(i), 1)
+    time.scroll(1)
+    assert order == range(10)
+
+def metricsUt():
     time = MockTime()
     communicator = MockCommunicator()
+    dht1 = DHT('login1', 'pass1', '', communicator, 'addr1', '', time)
+    dht2 = DHT('login2', 'pass2', '', communicator, 'addr2', 'addr1', time)
+    time.scroll(constants.FRIENDS_EXCHANGE_INTERVAL)
+    communicator.send('addr2', 'addr1', {'type': 'ping'})
+    communicator._onReceived('addr2', 'garbage', None)
+
+    metrics = dht1.getMetrics()
+    assert metrics['routing_table.size'] == 1
+    assert metrics['auth.authorized'] == 1
+    assert metrics['auth.handshake_seconds']['count'] == 1
+    assert metrics['handler_seconds.ping']['count'] >= 1
+    assert metrics['communicator.by_type.ping.packets_out'] == metrics['communicator.by_type.ping.packets_in']
+    assert metrics['communicator.decode_errors'] == 1
+    assert 'distance_cache.hit_rate' in metrics
+
+    histogram = Histogram([1, 10])
+    for value in [0.5, 1, 5, 100]:
+        histogram.observe(value)
+    assert histogram.getSnapshot()['buckets'] == [[1, 2], [10, 1], ['inf', 1]]
+
+    loop = EventLoop()
+    server = MetricsHttpServer(loop, ('127.0.0.1', 0), dht1.getMetrics)
+    client = socket.create_connection(server.getAddress())
+    client.sendall('GET /metrics HTTP/1.0\r\n\r\n')
+    client.settimeout(0.1)
+    response = ''
+    while True:
+        loop.runOnce(0.1)
+        try:
+            data = client.recv(65536)
+        except socket.timeout:
+            continue
+        if not data:
+            break
+        response += data
+    client.close()
+    server.close()
+    assert response.startswith('HTTP/1.0 200 OK')
+    assert 'wasp_routing_table_size 1\n' in response
+    assert 'wasp_handler_seconds_ping_bucket{le="+Inf"}' in response
+
+    # a client that doesn't read doesn't block the loop: the response,
+    # larger than socket buffers, is written as the client reads it
+    snapshot = dict(('metric%d_' % i + 'x' * 1000, i) for i in xrange(8000))
+    server = MetricsHttpServer(loop, ('127.0.0.1', 0), lambda: snapshot)
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    client.connect(server.getAddress())
+    client.sendall('GET /metrics HTTP/1.0\r\n\r\n')
+    for _ in xrange(20):
+        loop.runOnce(0.01)
+    client.settimeout(0.01)
+    response = ''
+    while True:
+        loop.runOnce(0.001)
+        try:
+            data = client.recv(65536)
+        except socket.timeout:
+            continue
+        if not data:
+            break
+        response += data
+    client.close()
+    server.close()
+    assert response.endswith(formatText(snapshot))
 
-    dht1 = DHT('login1', 'pass1', '/dev/non-exits', communicator, 'addr1', '', time)
-    dht2 = DHT('login2', 'pass2', '/dev/non-exits', communicator, 'addr2', 'addr1', time)
-    dht3 = DHT('login3', 'pass3', '/dev/non-exits', communicator, 'addr3', 'addr2', time)
+def _malformedIdPackets():
+    # search with a short target, search_response with short friend ids
+    return [chr(KEY_TO_ID['search']) + struct.pack('!BHH', 1, 5, 0) + 'short',
+            chr(KEY_TO_ID['search_response']) + struct.pack('!BBHHH', 0, 2, 5, 11, 0) + 'short' * 2 + 'addr1\0addr2']
 
+def codecUt():
+    codec = PacketCodec(KEY_TO_ID)
+    friends = [(os.urandom(32), 'addr' + str(i)) for i in xrange(constants.MAX_FRIENDS)]
+    packets = [
+        {'type': 'ping'},
+        {'type': 'response_id', 'id': os.urandom(32)},
+        {'type': 'response_id', 'id': os.urandom(32), 'pub_key': os.urandom(294)},
+        {'type': 'confirm', 'rand_seq': ''},
+        {'type': 'exchange', 'nonce': os.urandom(8), 'filter': os.urandom(constants.MAX_FILTER_SIZE),
+         'radius': os.urandom(32)},
+        {'type': 'exchange_response', 'closest_friends': []},
+        {'type': 'exchange_response', 'closest_friends': friends},
+        {'type': 'store', 'chunk_id': os.urandom(32), 'offset': 1 << 40, 'size': 5,
+         'data': os.urandom(constants.STORAGE_BLOCK_SIZE), 'nonce': os.urandom(8)},
+    ]
+    for packet in packets:
+        data = codec.encode(packet)
+        assert codec.decode(data).toDict() == packet
+        assert codec.decode(memoryview(data)).toDict() == packet
+        for bad in [data[:-1], data + 'x']:
+            try:
+                codec.decode(bad)['closest_friends']
+                assert False
+            except (PacketError, KeyError):
+                pass
+    assert codec.decode(codec.encode(packets[1])).get('pub_key') is None
+
+    for packet in [{'type': 'unknown'}, {'type': 'ping', 'id': 'x'}, {'type': 'confirm'},
+                   {'type': 'confirm', 'rand_seq': 'x' * 1000},
+                   {'type': 'search_response', 'closest_friends': [('a', 'addr1'), ('bb', 'addr2')]},
+                   {'type': 'search_response', 'closest_friends': [('a', 'addr\0')]},
+                   {'type': 'search_response', 'closest_friends': [(os.urandom(32), 'x' * 500)]},
+                   {'type': 'search_response',
+                    'closest_friends': [(os.urandom(32), 'x' * 500)] + friends[:6]},
+                   {'type': 'search_response', 'closest_friends': friends * 2},
+                   {'type': 'search_response', 'closest_friends': [('x' * 31, 'addr1'), ('x' * 33, 'addr2')]},
+                   {'type': 'search', 'target': 'short'},
+                   {'type': 'response_id', 'id': 'x' * 33},
+                   {'type': 'store', 'chunk_id': 'x', 'offset': 0, 'size': 0, 'data': '', 'nonce': 'x'},
+                   {'type': 'exchange', 'filter': 'x' * (constants.MAX_FILTER_SIZE + 1)},
+                   {'type': 'space_response', 'free_space': -1, 'nonce': 'x'},
+                   {'type': 'space_response', 'free_space': 'x', 'nonce': 'x'}]:
+        try:
+            codec.encode(packet)
+            assert False
+        except PacketError:
+            pass
+    # one long address hidden among short ones still fits the total addresses size
+    longAddresses = [(os.urandom(32), 'a' * 85) for _ in xrange(6)]
+    data = codec.encode({'type': 'search_response', 'closest_friends': longAddresses})
+    blob = '\0'.join(['a' * 85] * 6)
+    assert data.endswith(blob)
+    try:
+        codec.decode(data[:-len(blob)] + 'x' * 505 + '\0a' * 5)['closest_friends']
+        assert False
+    except PacketError:
+        pass
+    for data in ['', chr(255), chr(KEY_TO_ID['ping']) + 'x'] + _malformedIdPackets():
+        try:
+            codec.decode(data)
+            assert False
+        except PacketError:
+            pass
+
+def badPubKeyUt():
+    # garbage public keys fail the handshake, without leaking crypto slots
+    time = MockTime()
+    communicator = MockCommunicator()
+    dht1 = DHT('login1', 'pass1', '', communicator, 'addr1', '', time)
+    for blob in ['0\x00', 'x' * 10]:
+        for i in xrange(constants.MAX_CRYPTO_IN_FLIGHT + 1):
+            evil = 'evil%d' % i
+            communicator.subscribe(evil, lambda address, packet: None)
+            communicator.send(evil, 'addr1', {'type': 'ping'})
+            communicator.send(evil, 'addr1', {'type': 'response_id', 'id': hashlib.sha256(blob).digest(),
+                                              'pub_key': blob})
+            communicator.unsubscribe(evil)
+    assert dht1.getCryptoStats()['in_flight'] == 0
+    assert dht1.getAuthStats()['failed'] == 2 * (constants.MAX_CRYPTO_IN_FLIGHT + 1)
+    dht2 = DHT('login2', 'pass2', '', communicator, 'addr2', 'addr1', time)
     time.scroll(constants.FRIENDS_EXCHANGE_INTERVAL)
+    assert dht1.getFriendsSize() == 1
+    assert dht2.getFriendsSize() == 1
 
-    assert dht1.getId() != dht2.getId()
-    assert dht2.getId() != dht3.getId()
-    assert dht3.getId() != dht1.getId()
+def asyncAuthUt():
+    loop = EventLoop()
+    executor = ProcessCryptoExecutor(loop, 2)
+    time = MockTime()
+    communicator = MockCommunicator()
+
+    dht1 = DHT('login1', 'pass1', '', communicator, 'addr1', '', time, executor)
+    dht2 = DHT('login2', 'pass2', '', communicator, 'addr2', 'addr1', time, executor)
+    dht3 = DHT('login3', 'pass3', '', communicator, 'addr3', 'addr2', time, executor)
+    # handshakes are waiting for the process pool
+    assert dht1.getFriendsSize() == 0
+    nodes = [dht1, dht2, dht3]
+    for _ in xrange(constants.FRIENDS_EXCHANGE_INTERVAL / 10):
+        time.scroll(10)
+        while any(node.getCryptoStats()['in_flight'] for node in nodes):
+            loop.runOnce(1)
+    executor.close()
+    assert all(node.getCryptoStats()['dropped'] == 0 for node in nodes)
 
     assert dht1.getFriendsSize() == 2
     assert dht2.getFriendsSize() == 2
     assert dht3.getFriendsSize() == 2
 
-def bigUt():
+def livenessUt():
     time = MockTime()
     communicator = MockCommunicator()
+    dht1 = DHT('login1', 'pass1', '', communicator, 'addr1', '', time)
+    dht2 = DHT('login2', 'pass2', '', communicator, 'addr2', 'addr1', time)
+    dht3 = DHT('login3', 'pass3', '', communicator, 'addr3', 'addr2', time)
+    time.scroll(constants.FRIENDS_EXCHANGE_INTERVAL)
+    pings = communicator.getTrafficByType()['ping']['packets']
+    time.scroll(300)
+    # reliable idle friends are pinged rarely, a ping also refreshes its sender
+    pings = communicator.getTrafficByType()['ping']['packets'] - pings
+    assert pings <= 6 * 300 / constants.LIVENESS_MAX_IDLE
+    dht3.stop()
+    time.scroll(constants.FRIENDS_TIMEOUT + constants.PING_INTERVAL)
+    assert dht1.getFriendsSize() == 1
+    assert dht2.getFriendsSize() == 1
 
-    # Create network
+class _DroppingCommunicator(MockCommunicator):
+    # drops the first count packets of the given type
+    def __init__(self, time, dropType, count):
+        MockCommunicator.__init__(self, time)
+        self.__dropTypeId = chr(KEY_TO_ID[dropType])
+        self.__count = count
+        self.dropped = 0
+
+    def _doSend(self, selfAddress, address, data, control = False):
+        if self.dropped < self.__count and data[0] == self.__dropTypeId:
+            self.dropped += 1
+            return
+        MockCommunicator._doSend(self, selfAddress, address, data, control)
+
+def lossyAuthUt():
+    # a lost handshake packet is sent again on the search retry
+    for dropType in ['request_id', 'response_id', 'confirm', 'confirm_confirm']:
+        time = MockTime()
+        communicator = _DroppingCommunicator(time, dropType, 1)
+        dht1 = DHT('login1', 'pass1', '', communicator, 'addr1', '', time)
+        dht2 = DHT('login2', 'pass2', '', communicator, 'addr2', 'addr1', time)
+        time.scroll(constants.SELF_LOOKUP_INTERVAL / 2)
+        assert communicator.dropped == 1
+        assert dht1.getFriendsSize() == 1
+        assert dht2.getFriendsSize() == 1
+        dht1.stop()
+        dht2.stop()
+
+    # when the search and its retry are lost, own id is looked up again
+    time = MockTime()
+    communicator = _DroppingCommunicator(time, 'request_id', 2)
+    dht1 = DHT('login1', 'pass1', '', communicator, 'addr1', '', time)
+    dht2 = DHT('login2', 'pass2', '', communicator, 'addr2', 'addr1', time)
+    time.scroll(constants.SELF_LOOKUP_INTERVAL / 2)
+    assert dht2.getFriendsSize() == 0
+    time.scroll(constants.SELF_LOOKUP_INTERVAL)
+    assert dht1.getFriendsSize() == 1
+    assert dht2.getFriendsSize() == 1
+
+def unsolicitedResponseUt():
+    time = MockTime()
+    communicator = MockCommunicator()
+    dht1 = DHT('login1', 'pass1', '', communicator, 'addr1', '', time)
+    dht2 = DHT('login2', 'pass2', '', communicator, 'addr2', 'addr1', time)
+    time.scroll(constants.FRIENDS_EXCHANGE_INTERVAL)
+    assert dht1.getFriendsSize() == 1
+    unsolicited = dht1.getRequestStats()['unsolicited']
+
+    fakeFriends = [(os.urandom(32), 'fake' + str(i)) for i in xrange(constants.FRIENDS_PER_REQUEST)]
+    for packet in [
+        {'type': 'exchange_response', 'closest_friends': fakeFriends},
+        {'type': 'exchange_response', 'closest_friends': fakeFriends, 'nonce': 'x' * 8},
+        {'type': 'search_response', 'closest_friends': fakeFriends, 'nonce': 'x' * 8},
+    ]:
+        communicator.send('addr2', 'addr1', packet)
+    assert dht1.getFriendsSize() == 1
+    assert dht1.getRequestStats()['unsolicited'] == unsolicited + 3
+
+def authFloodUt():
+    time = MockTime()
+    communicator = MockCommunicator()
+    dht1 = DHT('login1', 'pass1', '', communicator, 'addr1', '', time)
+    dht2 = DHT('login2', 'pass2', '', communicator, 'addr2', 'addr1', time)
+    time.scroll(constants.FRIENDS_EXCHANGE_INTERVAL)
+
+    # packets from many spoofed addresses, which never answer
+    for i in xrange(constants.MAX_HALF_OPEN_AUTH * 2):
+        for _ in xrange(constants.MAX_AUTH_QUEUE + 1):
+            communicator.send('spoofed' + str(i), 'addr1', {'type': 'ping'})
+    stats = dht1.getAuthStats()
+    assert stats['half_open'] == constants.MAX_HALF_OPEN_AUTH
+    assert stats['evicted'] == constants.MAX_HALF_OPEN_AUTH
+    assert stats['queue_dropped'] == constants.MAX_HALF_OPEN_AUTH * 2
+
+    time.scroll(constants.AUTH_HANDSHAKE_TIMEOUT + constants.AUTH_EXPIRE_INTERVAL)
+    stats = dht1.getAuthStats()
+    assert stats['half_open'] == 0
+    assert stats['statuses'] == 1
+    assert dht1.getFriendsSize() == 1
+
+def journalUt():
+    path = tempfile.mktemp()
+    journal = Journal(path)
+    assert journal.load() == []
+    for i in xrange(10):
+        journal.append(('a', i))
+    journal.flush()
+    journal.close()
+    # torn write in the middle of the last record
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 2)
+    journal = Journal(path)
+    assert journal.load() == [['a', i] for i in xrange(9)]
+    journal.append(('a', 9))
+    journal.close()
+    journal = Journal(path)
+    assert len(journal.load()) == 10
+    journal.compact([('b',)])
+    journal.close()
+    journal = Journal(path)
+    assert journal.load() == [['b']]
+    journal.close()
+    os.remove(path)
+
+    # friends with liveness are restored, time the node was offline is not counted
+    time = MockTime()
+    communicator = MockCommunicator()
+    stateFile = tempfile.mktemp()
+    dht1 = DHT('login1', 'pass1', '', communicator, 'addr1', '', time)
+    dht2 = DHT('login2', 'pass2', '', communicator, 'addr2', 'addr1', time)
+    dht3 = DHT('login3', 'pass3', stateFile, communicator, 'addr3', 'addr2', time)
+    time.scroll(constants.FRIENDS_EXCHANGE_INTERVAL)
+    assert dht3.getFriendsSize() == 2
+    dht3.setData('backup root')
+    dht3.stop()
+    time.scroll(constants.FRIENDS_TIMEOUT * 2)
+    dht3 = DHT('login3', 'pass3', stateFile, communicator, 'addr3', '', time)
+    assert dht3.getFriendsSize() == 2
+    assert dht3.getData() == 'backup root'
+    time.scroll(constants.FRIENDS_TIMEOUT * 2)
+    assert dht3.getFriendsSize() == 2
+    dht3.stop()
+    os.remove(stateFile)
+
+def keyStoreUt():
+    path = tempfile.mkdtemp()
+    keyStore = KeyStore(path)
+    keys = CryptoUtils().deriveKeys('login1', 'pass1')
+    assert keyStore.load('login1', 'pass1') is None
+    keyStore.save('login1', 'pass1', *keys)
+    assert keyStore.load('login1', 'pass1') == keys
+    assert keyStore.getKeys('login1', 'pass1') == keys
+    assert keyStore.load('login1', 'pass2') is None
+    assert keyStore.load('login2', 'pass1') is None
+    # files are named by hashes, keys are encrypted
+    for name in os.listdir(path):
+        assert not 'login' in name and not 'pass' in name
+        with open(os.path.join(path, name), 'rb') as f:
+            assert not keys[1] in f.read()
+
+    keyStore.prederive([('login2', 'pass2'), ('login3', 'pass3')], processes=2)
+    assert len(os.listdir(path)) == 3
+    assert keyStore.load('login2', 'pass2') == CryptoUtils().deriveKeys('login2', 'pass2')
+
+    # plaintext keys of the old cache are moved to the store
+    legacy = [('login4_pass4', ('priv', 'pub')),
+              ('login5_pass_5', CryptoUtils().deriveKeys('login5', 'pass_5')),
+              ('login_6_pass6', ('priv6', 'pub6'))]
+    for credentials, (privKey, pubKey) in legacy:
+        with open(os.path.join(path, credentials + '_priv'), 'wb') as f:
+            f.write(privKey)
+        with open(os.path.join(path, credentials + '_pub'), 'wb') as f:
+            f.write(pubKey)
+    assert keyStore.migrateLegacy(path) == 2
+    assert keyStore.load('login4', 'pass4') == ('priv', 'pub')
+    assert keyStore.load('login5', 'pass_5') == legacy[1][1]
+    # ambiguous name with keys, not derived from any of its splits, stays as is
+    assert keyStore.load('login', '6_pass6') is None
+    assert keyStore.load('login_6', 'pass6') is None
+    assert sorted(name for name in os.listdir(path) if name.startswith('login')) == \
+        ['login_6_pass6_priv', 'login_6_pass6_pub']
+    assert len(os.listdir(path)) == 7
+    shutil.rmtree(path)
+
+def backupUt():
+    workDir = tempfile.mkdtemp()
+    source = os.path.join(workDir, 'source')
+    os.makedirs(os.path.join(source, 'sub'))
+    chunk = os.urandom(1000)
+    with open(os.path.join(source, 'big'), 'wb') as f:
+        f.write(chunk * 3 + os.urandom(1000) + chunk[:500])
+    with open(os.path.join(source, 'sub', 'small'), 'wb') as f:
+        f.write('small file')
+    open(os.path.join(source, 'empty'), 'wb').close()
+
+    for processes in (0, 2):
+        store = LocalChunkStore(os.path.join(workDir, 'store%d' % processes))
+        engine = BackupEngine('login1', 'pass1', store, processes, chunkSize=1000)
+        root = engine.backup([source])
+        engine.close()
+        stats = engine.getStats()
+        assert stats['files'] == 3
+        # repeated chunks of the big file are stored once
+        assert stats['chunks_deduplicated'] == 2
+
+        engine = BackupEngine('login1', 'pass1', store, chunkSize=1000)
+        assert sorted(engine.listFiles(root)) == [('source/big', 4500), ('source/empty', 0), ('source/sub/small', 10)]
+        target = os.path.join(workDir, 'target%d' % processes)
+        engine.restore(root, target)
+        for name in ('big', 'empty', 'sub/small'):
+            with open(os.path.join(source, name), 'rb') as f1, open(os.path.join(target, 'source', name), 'rb') as f2:
+                assert f1.read() == f2.read()
+
+        # nothing is readable without the password
+        try:
+            BackupEngine('login1', 'pass2', store).listFiles(root)
+            assert False
+        except BackupError:
+            pass
+    shutil.rmtree(workDir)
+
+def sessionResumeUt():
+    time = MockTime()
+    communicator = MockCommunicator()
+    stateFile = tempfile.mktemp()
+
+    dht1 = DHT('login1', 'pass1', '', communicator, 'addr1', '', time)
+    dht2 = DHT('login2', 'pass2', stateFile, communicator, 'addr2', 'addr1', time)
+    time.scroll(constants.FRIENDS_EXCHANGE_INTERVAL)
+    assert dht2.getFriendsSize() == 1
+    dht2.stop()
+
+    # restarted node authorizes its friend with the saved ticket, without rsa
+    dht2 = DHT('login2', 'pass2', stateFile, communicator, 'addr2', '', time)
+    os.remove(stateFile)
+    assert dht2.getFriendsSize() == 1
+    time.scroll(constants.FRIENDS_EXCHANGE_INTERVAL)
+    stats = dht2.getAuthStats()
+    assert stats['resumed'] == 1
+    assert stats['handshakes'] == 0
+    assert dht2.getFriendsSize() == 1
+    assert dht1.getFriendsSize() == 1
+
+class _EavesdroppingCommunicator(MockCommunicator):
+    def __init__(self):
+        MockCommunicator.__init__(self)
+        self.__codec = PacketCodec(KEY_TO_ID)
+        self.packets = []
+
+    def _doSend(self, selfAddress, address, data, control = False):
+        self.packets.append((selfAddress, address, self.__codec.decode(data).toDict()))
+        MockCommunicator._doSend(self, selfAddress, address, data, control)
+
+def sessionKeyUt():
+    # a third party, that saw the whole handshake, can't answer resume
+    time = MockTime()
+    communicator = _EavesdroppingCommunicator()
+    stateFile = tempfile.mktemp()
+    dht1 = DHT('login1', 'pass1', '', communicator, 'addr1', '', time)
+    dht2 = DHT('login2', 'pass2', stateFile, communicator, 'addr2', 'addr1', time)
+    time.scroll(constants.FRIENDS_EXCHANGE_INTERVAL)
+    assert dht2.getFriendsSize() == 1
+    dht1.stop()
+    dht2.stop()
+    # confirm_confirm of the handshake, that gave dht2 its ticket from dht1
+    seen = [packet['rand_seq'] for _, address, packet in communicator.packets
+            if packet['type'] == 'confirm_confirm' and address == 'addr2']
+    assert len(seen) == 1
+
+    # the eavesdropper takes the address of dht1 and answers resume with
+    # the key it can derive from what it saw
+    def onPacket(address, packet):
+        if packet['type'] == 'resume':
+            response = {
+                'type': 'resume_response',
+                'rand_seq': hmacSha256(deriveSessionKey(seen[0]), packet['rand_seq']),
+            }
+            communicator.send('addr1', address, response)
+    communicator.subscribe('addr1', onPacket)
+    dht2 = DHT('login2', 'pass2', stateFile, communicator, 'addr2', '', time)
+    os.remove(stateFile)
+    communicator.send('addr1', 'addr2', {'type': 'ping'})
+    stats = dht2.getAuthStats()
+    assert stats['resumed'] == 0
+    assert stats['resume_failed'] == 1
+    dht2.stop()
+
+def knownKeyUt():
+    # with a stale session and the key in cache, the handshake skips sending the public key
+    time = MockTime()
+    communicator = _EavesdroppingCommunicator()
+    stateFile = tempfile.mktemp()
+    pubKeys = LRUCache(constants.PUB_KEYS_CACHE_SIZE)
+    dht1 = DHT('login1', 'pass1', '', communicator, 'addr1', '', time)
+    dht2 = DHT('login2', 'pass2', stateFile, communicator, 'addr2', 'addr1', time, pubKeys=pubKeys)
+    time.scroll(constants.FRIENDS_EXCHANGE_INTERVAL)
+    assert dht2.getFriendsSize() == 1
+    dht2.stop()
+
+    # restarted node with an expired ticket
+    laterTime = MockTime()
+    laterTime.scroll(constants.SESSION_TICKET_LIFETIME + 1)
+    dht2 = DHT('login2', 'pass2', stateFile, communicator, 'addr2', '', laterTime, pubKeys=pubKeys)
+    os.remove(stateFile)
+    del communicator.packets[:]
+    communicator.send('addr1', 'addr2', {'type': 'ping'})
+    stats = dht2.getAuthStats()
+    assert stats['handshakes'] == 1
+    assert stats['known_keys'] == 1
+    assert stats['authorized'] == 1
+    responses = [packet for _, _, packet in communicator.packets if packet['type'] == 'response_id']
+    assert len(responses) == 1 and not 'pub_key' in responses[0]
+    dht1.stop()
+    dht2.stop()
+
+def lookupUt():
+    sim = Simulator(seed=1, latency=0.05)
+    sim.addNodes(300, joinRate=100)
+    sim.run(120)
+    rand = sim.getTime().getRandom()
+    nodes = sim.getNodes()
+    found = 0
+    for _ in xrange(20):
+        node, targetNode = rand.sample(nodes, 2)
+        results = []
+        node.lookup(targetNode.getId(), results.append)
+        sim.getTime().scroll(constants.LOOKUP_TIMEOUT)
+        assert len(results) == 1
+        assert len(results[0]) == constants.FRIENDS_PER_REQUEST
+        found += results[0][0] == (targetNode.getId(), targetNode.getAddress())
+    # a node, not yet authorized by its neighbours, is not returned by them
+    assert found >= 18
+
+    # dead nodes time out, lookup still completes
+    sim.removeRandomNodes(100)
+    nodes = sim.getNodes()
+    node, targetNode = rand.sample(nodes, 2)
+    results = []
+    node.lookup(targetNode.getId(), results.append)
+    sim.getTime().scroll(constants.LOOKUP_TIMEOUT * (constants.LOOKUP_RETRIES + 1) * 10)
+    assert len(results) == 1
+
+def storageUt():
+    time = MockTime()
+    communicator = MockCommunicator()
+    workDir = tempfile.mkdtemp()
+    chunkSize = constants.STORAGE_BLOCK_SIZE * 2 + 100
     nodes = []
-    nodes.append(DHT('login0', 'pass0', '/dev/non-exits', communicator, 'addr0', '', time))
-    while len(nodes) < 1000:
-        time.scroll(0.01)
-        selfAddr = 'addr' + str(len(nodes))
-        otherAddr = 'addr' + str(randint(0, len(nodes) - 1))
-        login = 'login' + str(len(nodes))
-        password = 'password' + str(len(nodes))
-        nodes.append(DHT(login, password, '/dev/non-exits', communicator, selfAddr, otherAddr, time))
-        if len(nodes) % 100 == 0:
-            print '[STATUS] added', len(nodes), 'nodes'
+    for i in xrange(12):
+        dht = DHT('login%d' % i, 'pass%d' % i, '', communicator, 'addr%d' % i, 'addr0' if i else '', time)
+        # node 5 has no free space
+        capacity = 0 if i == 5 else chunkSize * 20
+        ownStore = LocalChunkStore(os.path.join(workDir, 'own%d' % i))
+        hostedStore = LocalChunkStore(os.path.join(workDir, 'hosted%d' % i))
+        nodes.append((dht, Storage(dht, time, ownStore, hostedStore, capacity), ownStore, hostedStore))
+    time.scroll(constants.FRIENDS_EXCHANGE_INTERVAL * 2)
+
+    dht, storage, ownStore, _ = nodes[0]
+    chunks = {}
+    for _ in xrange(10):
+        chunkId, data = os.urandom(32), os.urandom(chunkSize)
+        ownStore.put(chunkId, data)
+        chunks[chunkId] = data
+        storage.place(chunkId)
+    time.scroll(constants.STORAGE_BLOCK_TIMEOUT)
+    hostedStores = {node[0].getAddress(): node[3] for node in nodes}
+    for chunkId, data in chunks.iteritems():
+        holders = storage.getHolders(chunkId)
+        assert len(holders) == constants.STORAGE_REPLICAS
+        for _, address in holders:
+            assert address not in ('addr0', 'addr5')
+            assert hostedStores[address].get(chunkId) == data
+    stats = storage.getStats()
+    assert stats['placed'] == 10
+    assert stats['placing'] == 0
+    assert dht.getMetrics()['storage.replicas'] == 10 * constants.STORAGE_REPLICAS
+
+    # chunks of a lost holder are placed to other nodes
+    lostAddress = storage.getHolders(chunks.keys()[0])[0][1]
+    for lostDht, lostStorage, _, _ in nodes:
+        if lostDht.getAddress() == lostAddress:
+            lostStorage.stop()
+            lostDht.stop()
+    time.scroll(constants.STORAGE_CHECK_INTERVAL * (constants.STORAGE_PROBE_FAILURES + 1))
+    assert storage.getStats()['rebalanced'] >= 1
+    for chunkId, data in chunks.iteritems():
+        holders = storage.getHolders(chunkId)
+        assert len(holders) == constants.STORAGE_REPLICAS
+        for _, address in holders:
+            assert address != lostAddress
+            assert hostedStores[address].get(chunkId) == data
+    for dht, storage, _, _ in nodes:
+        if dht.getAddress() != lostAddress:
+            storage.stop()
+            dht.stop()
+    shutil.rmtree(workDir)
+
+def shardedSimUt():
+    reports = []
+    for _ in xrange(2):
+        sim = ShardedSimulator(3, seed=5, latency=0.05)
+        sim.addNodes(60, joinRate=100)
+        sim.run(60)
+        report = sim.getReport()
+        sim.stop()
+        del report['wall_time'], report['events_per_sec']
+        reports.append(report)
+    # same seed - same results, whatever the processes scheduling
+    assert reports[0] == reports[1]
+    assert reports[0]['nodes'] == 60
+    assert reports[0]['cross_shard_packets'] > 0
+    # and close to the single process simulation
+    sim = Simulator(seed=5, latency=0.05)
+    sim.addNodes(60, joinRate=100)
+    sim.run(60)
+    expected = sim.getFriendsStats()['avg_friends']
+    assert abs(reports[0]['avg_friends'] - expected) < expected * 0.2
+
+def deltaExchangeUt():
+    sim = Simulator(seed=7)
+    sim.addNodes(100, joinRate=100)
+    sim.run(300)
+    assert sim.getFriendsStats()['avg_friends'] >= constants.MAX_FRIENDS
+    responses = sim.getReport()['traffic_by_type']['exchange_response']
+    # converged nodes exchange only the few friends they miss, full response
+    # takes more than MAX_FRIENDS ids
+    assert responses['bytes'] < responses['packets'] * constants.MAX_FRIENDS * 32 / 4
+
+def lossySimUt():
+    # nodes, that lost handshake packets while joining, get their friends
+    sim = Simulator(seed=3, latency=0.05, loss=0.02)
+    sim.addNodes(100, joinRate=100)
+    sim.run(300)
+    report = sim.getReport()
+    assert report['packets_lost'] > 0
+    assert report['convergence_time'] is not None
+    assert report['min_friends'] >= constants.MAX_FRIENDS / 2
+
+def bigUt():
+    sim = Simulator(log=True)
+    communicator = sim.getCommunicator()
+
+    # Create network
+    sim.addNodes(1000, joinRate=100)
 
     # Wait few minutes for friends exchange
-    avg = 0
     print '[STATUS] added all nodes!'
-    for i in xrange(1, 23):
-        time.scroll(10)
-        avg = 0
-        for node in nodes:
-            avg += node.getFriendsSize()
-        avg = float(avg) / len(nodes)
-        print '[STATUS] modeled', i * 10, 'seconds, avg friends:', avg, 'traffic:', communicator.getTraffic()
+    sim.run(220)
+    avg = sim.getFriendsStats()['avg_friends']
 
     assert avg >= constants.MAX_FRIENDS
     assert avg < constants.MAX_FRIENDS * 2
 
     # Remove half of the friends
-    while len(nodes) > 500:
-        nodeNum = randint(0, len(nodes) - 1)
-        node = nodes[nodeNum]
-        communicator.unsubscribe(node.getAddress())
-        del nodes[nodeNum]
+    sim.removeRandomNodes(500)
 
     # Wait and ensure that have enough friends and all friends are online
-    for i in xrange(23, 54):
-        time.scroll(10)
-        avg = 0
-        for node in nodes:
-            avg += node.getFriendsSize()
-        avg = float(avg) / len(nodes)
-        print '[STATUS] modeled', i * 10, 'seconds, avg friends:', avg, 'traffic:', communicator.getTraffic()
+    sim.run(310)
 
+    nodes = sim.getNodes()
     onlineAddresses = set()
     for node in nodes:
         onlineAddresses.add(node.getAddress())
@@ -131,17 +978,51 @@ def bigUt():
         for addr in friendsAddressed:
             assert addr in onlineAddresses
 
+    report = sim.getReport()
+    assert report['convergence_time'] is not None
+    assert report['traffic'] == communicator.getTraffic()
+    assert sum(t['bytes'] for t in report['traffic_by_type'].itervalues()) == report['traffic']
+
 
 def runUt():
     print '[RUNNING]'
     simpleUt()
+    livenessUt()
+    unsolicitedResponseUt()
+    lossyAuthUt()
+    authFloodUt()
+    badPubKeyUt()
+    asyncAuthUt()
+    sessionResumeUt()
+    sessionKeyUt()
+    knownKeyUt()
     print '[UT  #1]: OK'
+    routingTableUt()
+    bloomFilterUt()
+    lruCacheUt()
+    journalUt()
+    keyStoreUt()
+    backupUt()
+    print '[UT  #2]: OK'
+    udpUt()
+    udpBatchUt()
+    timerWheelUt()
+    latencyUt()
+    codecUt()
+    metricsUt()
+    print '[UT  #3]: OK'
 
 
     _enableCache()
     _enableFakeCrypto()
+    lookupUt()
+    storageUt()
+    hostUt()
+    shardedSimUt()
+    deltaExchangeUt()
+    lossySimUt()
     bigUt()
-    print '[UT  #2]: OK'
+    print '[UT  #4]: OK'
     print '[DONE]'
 
 if __name__ == '__main__':